@@ -0,0 +1,356 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Coalescing of the same operation on many node instances into batch calls.
+
+Uninstalling many instances runs a ``delete`` operation for each of them, each making its own cloud
+API call, while cloud APIs accept many resource IDs per call. A plugin may declare a batch handler
+for an operation function, as its ``batch_handler`` attribute::
+
+    @operation
+    def delete(ctx, **kwargs):
+        ...
+
+    def delete_all(ctx, instances):
+        ...
+
+    delete.batch_handler = delete_all
+
+When the ``ARIA_CLOUDIFY_BATCH_WINDOW`` environment variable is set (to a number of seconds), node
+operations with a batch handler don't call their function. Instead, operations of the same function
+and plugin, with the same cloud credentials (see :data:`CREDENTIAL_KEYS`), which start within the
+window are grouped into a batch, and the first of them calls the handler once for the whole batch.
+It is passed its own Cloudify context, and a :class:`BatchInstance` for every operation of the
+batch. The handler changes the runtime properties of the instances, and returns the exceptions of
+those which failed, by instance ID. Every operation then applies the changes to its own runtime
+properties, and succeeds, or fails with its exception (``RecoverableError`` retries it, and its
+next attempt is batched again).
+
+Operations are batched through an SQLite database (``ARIA_CLOUDIFY_BATCH_DB``, under the system
+temporary directory by default), so only operations running on the same host are batched together.
+The process handling a batch holds a lock file of the batch until its results are written, which
+the other operations of the batch block on. An operation whose batch was lost, since the process
+handling it died (releasing the lock), calls its function on its own.
+"""
+
+import os
+import copy
+import json
+import time
+import errno
+import hashlib
+import tempfile
+
+from . import (context_adapter, utils)
+
+
+BATCH_WINDOW_ENV_VAR = 'ARIA_CLOUDIFY_BATCH_WINDOW'
+BATCH_DB_ENV_VAR = 'ARIA_CLOUDIFY_BATCH_DB'
+
+# Properties and inputs holding the credentials of cloud APIs, which are not stored in the database
+CREDENTIAL_KEYS = (
+    'aws_config',
+    'openstack_config',
+    'azure_config',
+    'gcp_config',
+    'vsphere_config',
+    'client_config',
+)
+MAX_BATCH_SIZE = 100
+
+# Failures of batch members, as stored in the database
+RECOVERABLE = 'recoverable'
+NON_RECOVERABLE = 'non_recoverable'
+ERROR = 'error'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    leader_pid INTEGER NOT NULL,
+    closed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS batches_key ON batches (key, closed);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    batch_id INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS items_batch ON items (batch_id);
+"""
+
+
+def from_environment(env=None):
+    """
+    Returns the batch coordinator configured through ``ARIA_CLOUDIFY_BATCH_WINDOW``, or ``None``.
+    """
+    env = os.environ if env is None else env
+    window = env.get(BATCH_WINDOW_ENV_VAR)
+    if not window:
+        return None
+    path = env.get(BATCH_DB_ENV_VAR) or os.path.join(tempfile.gettempdir(),
+                                                     'aria-cloudify-batches.db')
+    return BatchCoordinator(path, window=float(window))
+
+
+def call_operation(function, ctx, operation_inputs, env=None):
+    """
+    Calls the function of a Cloudify-based operation, or has it handled in a batch, if its plugin
+    declared a batch handler for it and batching is enabled.
+
+    :param ctx: Cloudify context adapter of the operation
+    """
+    from cloudify import exceptions
+
+    handler = getattr(function, 'batch_handler', None)
+    coordinator = from_environment(env) if handler is not None else None
+    if coordinator is None or ctx.type != context_adapter.NODE_INSTANCE:
+        return function(ctx=ctx, **operation_inputs)
+
+    runtime_properties = utils.plain_value(ctx.instance.runtime_properties)
+    item = {
+        'id': ctx.instance.id,
+        'properties': _without_credentials(ctx.node.properties),
+        'runtime_properties': runtime_properties,
+        'inputs': _without_credentials(operation_inputs)
+    }
+    try:
+        result = coordinator.submit(batch_key(ctx, operation_inputs), item,
+                                    lambda items: handle_batch(handler, ctx, items))
+    except (TypeError, ValueError) as e:
+        # Not serializable as JSON
+        ctx.logger.debug(u'Could not batch the operation: {0}'.format(e))
+        result = None
+    if result is None:
+        return function(ctx=ctx, **operation_inputs)
+
+    for key in result.get('removed', ()):
+        del ctx.instance.runtime_properties[key]
+    for key, value in result.get('changed', {}).iteritems():
+        ctx.instance.runtime_properties[key] = value
+    error = result.get('error')
+    if error is not None:
+        if error['type'] == RECOVERABLE:
+            raise exceptions.RecoverableError(error['message'],
+                                              retry_after=error.get('retry_after'))
+        elif error['type'] == NON_RECOVERABLE:
+            raise exceptions.NonRecoverableError(error['message'])
+        raise BatchOperationError(error['message'])
+
+
+def batch_key(ctx, operation_inputs):
+    """
+    Returns the key of the batches an operation may join: its function, plugin and credentials
+    (hashed).
+    """
+    credentials = {}
+    for source in (ctx.node.properties, operation_inputs):
+        for key in CREDENTIAL_KEYS:
+            if key in source:
+                credentials[key] = utils.plain_value(source[key])
+    digest = hashlib.sha1(json.dumps(credentials, sort_keys=True, default=repr)).hexdigest()
+    plugin = ctx.task.plugin
+    return u'{0}@{1}:{2}'.format(ctx.task.function, plugin.name if plugin else u'', digest)
+
+
+def handle_batch(handler, ctx, items):
+    """
+    Calls the batch handler for the items of a batch, and returns the result of each item.
+    """
+    instances = [BatchInstance(item['id'], item['properties'],
+                               copy.deepcopy(item['runtime_properties']), item['inputs'])
+                 for item in items]
+    try:
+        failures = handler(ctx, instances) or {}
+    except Exception as e:
+        failures = dict((instance.id, e) for instance in instances)
+
+    results = []
+    for item, instance in zip(items, instances):
+        old = item['runtime_properties']
+        new = instance.runtime_properties
+        result = {
+            'changed': dict((key, value) for key, value in new.iteritems()
+                            if key not in old or old[key] != value),
+            'removed': [key for key in old if key not in new]
+        }
+        failure = failures.get(instance.id)
+        if failure is not None:
+            result['error'] = _error(failure)
+        results.append(result)
+    return results
+
+
+def _error(exception):
+    from cloudify import exceptions
+
+    if isinstance(exception, exceptions.RecoverableError):
+        return {'type': RECOVERABLE, 'message': str(exception),
+                'retry_after': exception.retry_after}
+    elif isinstance(exception, exceptions.NonRecoverableError):
+        return {'type': NON_RECOVERABLE, 'message': str(exception)}
+    return {'type': ERROR, 'message': u'{0}: {1}'.format(type(exception).__name__, exception)}
+
+
+def _without_credentials(values):
+    return dict((key, utils.plain_value(value)) for key, value in dict.iteritems(values)
+                if key not in CREDENTIAL_KEYS)
+
+
+class BatchOperationError(Exception):
+    """
+    Failure of an operation handled in a batch, other than a Cloudify error.
+    """
+    pass
+
+
+class BatchInstance(object):
+    """
+    Node instance of an operation handled in a batch.
+
+    :ivar id: ID of the node instance
+    :ivar properties: properties of its node (without credentials)
+    :ivar runtime_properties: its runtime properties, to be changed by the batch handler
+    :ivar inputs: inputs of its operation (without credentials)
+    """
+
+    def __init__(self, id, properties, runtime_properties, inputs):
+        self.id = id
+        self.properties = properties
+        self.runtime_properties = runtime_properties
+        self.inputs = inputs
+
+    def __repr__(self):
+        return u'BatchInstance({0})'.format(self.id)
+
+
+class BatchCoordinator(object):
+    """
+    Groups items of the same key, submitted by processes within a time window, into batches
+    handled at once, through an SQLite database shared by the processes.
+    """
+
+    def __init__(self, path, window, max_size=MAX_BATCH_SIZE):
+        self._path = path
+        self._window = window
+        self._max_size = max_size
+        utils.makedirs(os.path.dirname(os.path.abspath(path)))
+        if not os.path.exists(path):
+            # Items hold the properties of nodes
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def submit(self, key, item, handle):
+        """
+        Adds the item to the open batch of the key (opening one, if there is none), and waits for
+        the batch to be handled.
+
+        :param item: JSON-serializable item
+        :param handle: function returning the results of the items of a batch, in order, called if
+         this process opened the batch
+        :return: result of the item, or ``None`` if its batch was lost
+        """
+        content = json.dumps(item)
+        batch_id = None
+        batch_lock = None
+        try:
+            with self._connect() as connection:
+                # Batches opened by processes which died are never handled
+                for open_id, leader_pid in connection.execute(
+                        'SELECT id, leader_pid FROM batches WHERE key = ? AND closed = 0',
+                        (key,)).fetchall():
+                    if not utils.is_alive(leader_pid):
+                        connection.execute('UPDATE batches SET closed = 1 WHERE id = ?', (open_id,))
+                # A single statement, so the batch can't be closed in between
+                cursor = connection.execute(
+                    'INSERT INTO items (batch_id, item) '
+                    'SELECT id, ? FROM batches WHERE key = ? AND closed = 0 AND '
+                    '(SELECT COUNT(*) FROM items WHERE batch_id = batches.id) < ? '
+                    'ORDER BY id LIMIT 1', (content, key, self._max_size))
+                if cursor.rowcount == 1:
+                    item_id = cursor.lastrowid
+                else:
+                    batch_id = connection.execute(
+                        'INSERT INTO batches (key, leader_pid) VALUES (?, ?)',
+                        (key, os.getpid())).lastrowid
+                    item_id = connection.execute(
+                        'INSERT INTO items (batch_id, item) VALUES (?, ?)',
+                        (batch_id, content)).lastrowid
+                    # Locked before the batch is committed, so no member can find it unlocked
+                    batch_lock = utils.file_lock(self._lock_path(batch_id))
+                    batch_lock.__enter__()
+        except BaseException:
+            if batch_lock is not None:
+                batch_lock.__exit__(None, None, None)
+            raise
+
+        if batch_lock is not None:
+            try:
+                time.sleep(self._window)
+                self._lead(batch_id, handle)
+            finally:
+                batch_lock.__exit__(None, None, None)
+                _remove(self._lock_path(batch_id))
+        return self._wait(item_id)
+
+    def _lead(self, batch_id, handle):
+        with self._connect() as connection:
+            connection.execute('UPDATE batches SET closed = 1 WHERE id = ?', (batch_id,))
+            rows = connection.execute('SELECT id, item FROM items WHERE batch_id = ? ORDER BY id',
+                                      (batch_id,)).fetchall()
+        results = []
+        try:
+            results = handle([json.loads(item) for _, item in rows])
+        finally:
+            # Without its batch, an item with no result is lost
+            with self._connect() as connection:
+                connection.executemany('UPDATE items SET result = ? WHERE id = ?',
+                                       [(json.dumps(result), item_id)
+                                        for (item_id, _), result in zip(rows, results)])
+                connection.execute('DELETE FROM batches WHERE id = ?', (batch_id,))
+
+    def _wait(self, item_id):
+        with self._connect() as connection:
+            batch_id, = connection.execute('SELECT batch_id FROM items WHERE id = ?',
+                                           (item_id,)).fetchone()
+        # Released once the results are written, or the process handling the batch died
+        lock_path = self._lock_path(batch_id)
+        with utils.file_lock(lock_path):
+            pass
+        _remove(lock_path)
+        with self._connect() as connection:
+            result, = connection.execute('SELECT result FROM items WHERE id = ?',
+                                         (item_id,)).fetchone()
+            connection.execute('DELETE FROM items WHERE id = ?', (item_id,))
+        return json.loads(result) if result is not None else None
+
+    def _lock_path(self, batch_id):
+        return '{0}.{1}.lock'.format(self._path, batch_id)
+
+    def _connect(self):
+        return utils.sqlite_transaction(self._path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        # Removed by another member of the batch
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,243 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Checkpoints of Cloudify-based operations, for resuming executions after the orchestrator crashed.
+
+Operations report their completion to the orchestrator through a socket; when the orchestrator
+dies, the completion of the operations that were running is lost, and ARIA (which only resumes
+cancelled executions) would run them again. When the ``ARIA_CLOUDIFY_CHECKPOINT_DIR`` environment
+variable is set, every Cloudify-based operation instead writes a checkpoint when it exits, once its
+runtime properties were committed: whether it succeeded, and the runtime properties of its nodes.
+Each checkpoint is written to a temporary file, synced and renamed over the previous checkpoint of
+the task, so a checkpoint is either entirely written or not at all.
+
+:func:`resume` (and the ``aria-cloudify-resume`` command) marks the operations which checkpointed
+their success as succeeded, restores the nodes of the operations which were still running to their
+last checkpointed runtime properties, and resumes the execution with ARIA's engine, which runs only
+the operations that didn't end.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from aria.modeling import models
+from aria.orchestrator import execution_preparer
+from aria.orchestrator.workflows.core import engine
+from aria.orchestrator.workflows.executor import process
+
+from . import utils
+
+
+CHECKPOINT_DIR_ENV_VAR = 'ARIA_CLOUDIFY_CHECKPOINT_DIR'
+
+_SUFFIX = '.json'
+
+
+def get_checkpoint_dir(env=None):
+    return (os.environ if env is None else env).get(CHECKPOINT_DIR_ENV_VAR) or None
+
+
+def operation_ended(ctx, succeeded, env=None):
+    """
+    Writes the checkpoint of the operation, if checkpoints are enabled.
+    """
+    checkpoint_dir = get_checkpoint_dir(env)
+    if checkpoint_dir is None:
+        return
+    CheckpointStore(checkpoint_dir).write(
+        execution_id=ctx.task.execution.id,
+        task_id=ctx.task.id,
+        succeeded=succeeded,
+        runtime_properties=dict(
+            (node.id, dict((name, attribute.value)
+                           for name, attribute in node.attributes.iteritems()))
+            for node in utils.task_nodes(ctx.task)))
+
+
+def clear(execution_id, env=None):
+    checkpoint_dir = get_checkpoint_dir(env)
+    if checkpoint_dir is not None:
+        CheckpointStore(checkpoint_dir).clear(execution_id)
+
+
+class CheckpointStore(object):
+    """
+    Checkpoints of the tasks of executions, a file per task.
+    """
+
+    def __init__(self, checkpoint_dir):
+        self._checkpoint_dir = checkpoint_dir
+
+    def write(self, execution_id, task_id, succeeded, runtime_properties):
+        execution_dir = self._execution_dir(execution_id)
+        utils.makedirs(execution_dir)
+        checkpoint = {
+            'task_id': task_id,
+            'succeeded': succeeded,
+            'time': time.time(),
+            # JSON keys are strings
+            'runtime_properties': dict((str(node_id), properties)
+                                       for node_id, properties in runtime_properties.iteritems()),
+        }
+        file_descriptor, temp_path = tempfile.mkstemp(dir=execution_dir, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_path, os.path.join(execution_dir, '{0}{1}'.format(task_id, _SUFFIX)))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        _fsync_dir(execution_dir)
+
+    def read(self, execution_id):
+        """
+        Returns the checkpoints of the execution, by task ID.
+        """
+        execution_dir = self._execution_dir(execution_id)
+        if not os.path.isdir(execution_dir):
+            return {}
+        checkpoints = {}
+        for name in os.listdir(execution_dir):
+            if name.endswith(_SUFFIX):
+                with open(os.path.join(execution_dir, name)) as f:
+                    checkpoint = json.load(f)
+                checkpoints[checkpoint['task_id']] = checkpoint
+        return checkpoints
+
+    def clear(self, execution_id):
+        shutil.rmtree(self._execution_dir(execution_id), ignore_errors=True)
+
+    def _execution_dir(self, execution_id):
+        return os.path.join(self._checkpoint_dir, str(execution_id))
+
+
+def restore(model, execution, store):
+    """
+    Applies the checkpoints of an interrupted execution to its tasks and nodes, and marks it as
+    cancelled, so it can be resumed.
+
+    :return: tuple of the IDs of the tasks marked as succeeded, and of the nodes restored
+    """
+    checkpoints = store.read(execution.id)
+    succeeded = []
+    in_flight = []
+    for task in execution.tasks:
+        if task.has_ended():
+            continue
+        checkpoint = checkpoints.get(task.id)
+        if checkpoint is not None and checkpoint['succeeded']:
+            task.status = task.SUCCESS
+            model.task.update(task)
+            succeeded.append(task.id)
+        else:
+            in_flight.append(task)
+
+    # The last runtime properties checkpointed for each node, by any of its operations
+    runtime_properties = {}
+    for checkpoint in sorted(checkpoints.itervalues(), key=lambda c: c['time']):
+        runtime_properties.update(checkpoint['runtime_properties'])
+
+    restored = set()
+    for task in in_flight:
+        for node in utils.task_nodes(task):
+            properties = runtime_properties.get(str(node.id))
+            if properties is None or node.id in restored:
+                continue
+            for name, value in properties.iteritems():
+                if name in node.attributes:
+                    node.attributes[name].value = value
+                else:
+                    node.attributes[name] = models.Attribute.wrap(name, value)
+            model.node.update(node)
+            restored.add(node.id)
+
+    # ARIA resumes cancelled executions only, while a crashed execution is left active
+    if execution.status in (execution.STARTED, execution.CANCELLING):
+        execution.status = execution.CANCELLED
+        model.execution.update(execution)
+    return succeeded, sorted(restored)
+
+
+def resume(model, resource, plugin_manager, execution_id, checkpoint_dir, executor=None,
+           retry_failed=False):
+    """
+    Resumes an interrupted execution, skipping the operations which checkpointed their success.
+    """
+    execution = model.execution.get(execution_id)
+    restore(model, execution, CheckpointStore(checkpoint_dir))
+    executor = executor or process.ProcessExecutor(plugin_manager=plugin_manager)
+    ctx = execution_preparer.ExecutionPreparer(
+        model, resource, plugin_manager, execution.service, execution.workflow_name
+    ).prepare(execution_id=execution.id)
+    try:
+        engine.Engine(executor).execute(ctx, resuming=True, retry_failed=retry_failed)
+    finally:
+        executor.close()
+    return ctx
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='aria-cloudify-resume',
+        description='Resume an interrupted execution, skipping the Cloudify-based operations which '
+                    'completed before the interruption.')
+    parser.add_argument('execution_id', type=int, help='ID of the execution to resume')
+    parser.add_argument('--checkpoint-dir', default=get_checkpoint_dir(),
+                        help='checkpoint directory (defaults to ${0})'.format(
+                            CHECKPOINT_DIR_ENV_VAR))
+    parser.add_argument('--retry-failed-tasks', action='store_true',
+                        help='retry the tasks which failed')
+    args = parser.parse_args(args)
+
+    if not args.checkpoint_dir:
+        parser.error('no checkpoint directory given, and ${0} is not set'.format(
+            CHECKPOINT_DIR_ENV_VAR))
+
+    import aria
+    from aria.cli.env import env
+    aria.install_aria_extensions()
+    ctx = resume(env.model_storage, env.resource_storage, env.plugin_manager, args.execution_id,
+                 args.checkpoint_dir, retry_failed=args.retry_failed_tasks)
+    sys.stdout.write('Execution {0} ended with status {1}\n'.format(
+        ctx.execution.id, ctx.execution.status))
+    return 0
+
+
+def _fsync_dir(path):
+    # Makes the rename durable; not supported on all platforms
+    try:
+        file_descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(file_descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(file_descriptor)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
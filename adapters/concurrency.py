@@ -0,0 +1,120 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Limits on the number of tasks an execution runs at the same time.
+
+ARIA's engine sends every task as soon as its dependencies have ended. When a limit is set for an
+execution, sending a task blocks until one of the tasks already running for that execution ends,
+or the execution is cancelled: the engine only notices the cancellation once the task was sent.
+The waiting is done by :func:`adapters.scheduling.task_sent`, together with the waiting for a
+worker of the scheduler.
+"""
+
+import threading
+
+
+# Seconds between checks of whether the execution was cancelled, while waiting
+CANCEL_CHECK_INTERVAL = 1.0
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def set_limit(execution_id, max_concurrent_tasks):
+    """
+    Limits the number of tasks of the execution which run at the same time.
+
+    :param max_concurrent_tasks: maximum number of running tasks, or ``None`` for no limit
+    """
+    with _limits_lock:
+        if max_concurrent_tasks:
+            _limits[execution_id] = ConcurrencyLimit(int(max_concurrent_tasks))
+        else:
+            _limits.pop(execution_id, None)
+
+
+def get_limit(execution_id):
+    with _limits_lock:
+        return _limits.get(execution_id)
+
+
+def clear_limit(execution_id):
+    with _limits_lock:
+        limit = _limits.pop(execution_id, None)
+    if limit is not None:
+        limit.close()
+
+
+def task_ended(task):
+    limit = get_limit(task.execution.id)
+    if limit is not None:
+        limit.release(task.id)
+
+
+class ConcurrencyLimit(object):
+
+    def __init__(self, max_concurrent_tasks):
+        if max_concurrent_tasks < 1:
+            raise ValueError(u'A concurrency limit must be positive, not {0}'.format(
+                max_concurrent_tasks))
+        self._max_concurrent_tasks = max_concurrent_tasks
+        self._running = set()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def max_concurrent_tasks(self):
+        return self._max_concurrent_tasks
+
+    @property
+    def running(self):
+        with self._condition:
+            return len(self._running)
+
+    def try_acquire(self, task_id):
+        """
+        Takes a slot for the task, if one is free.
+
+        :return: whether the task took a slot
+        """
+        with self._condition:
+            if len(self._running) >= self._max_concurrent_tasks and not self._closed:
+                return False
+            self._running.add(task_id)
+            return True
+
+    def wait(self, timeout):
+        """
+        Waits until a slot may have been freed, for at most ``timeout`` seconds.
+        """
+        with self._condition:
+            if len(self._running) >= self._max_concurrent_tasks and not self._closed:
+                self._condition.wait(timeout)
+
+    def release(self, task_id):
+        with self._condition:
+            if task_id in self._running:
+                self._running.discard(task_id)
+                self._condition.notify()
+
+    def close(self):
+        """
+        Lets all waiting tasks through, e.g. once the execution ended.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
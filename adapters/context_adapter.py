@@ -15,10 +15,17 @@
 #
 
 import os
+import copy
+import shutil
 import tempfile
 
+from sqlalchemy import event
+
+from aria.modeling import models
 from aria.orchestrator.context import operation
 
+from . import (plugin_cache, runtime_index, ssh_pool, staging, utils)
+
 
 DEPLOYMENT = 'deployment'
 NODE_INSTANCE = 'node-instance'
@@ -27,31 +34,44 @@ RELATIONSHIP_INSTANCE = 'relationship-instance'
 
 class CloudifyContextAdapter(object):
 
-    def __init__(self, ctx):
+    def __init__(self, ctx, node_properties=None, operation_history=None, logger=None):
+        """
+        :param node_properties: properties of the operation's nodes, by node ID, if already loaded
+         (otherwise they're read from the model)
+        :param operation_history: :class:`adapters.retry_history.OperationHistory` of the operation,
+         if kept
+        :param logger: :class:`adapters.operation_logging.BufferedLogger` of the operation, if used
+         instead of ARIA's operation logger
+        """
+        node_properties = node_properties or {}
         self._ctx = ctx
+        self._logger = logger
         self._blueprint = BlueprintAdapter(ctx)
         self._deployment = DeploymentAdapter(ctx)
-        self._operation = OperationAdapter(ctx)
+        self._operation = OperationAdapter(ctx, operation_history)
         self._bootstrap_context = BootstrapAdapter(ctx)
         self._plugin = PluginAdapter(ctx)
-        self._agent = CloudifyAgentAdapter()
+        self._agent = CloudifyAgentAdapter(ctx)
         self._node = None
         self._node_instance = None
         self._source = None
         self._target = None
         if isinstance(ctx, operation.NodeOperationContext):
-            self._node = NodeAdapter(ctx, ctx.node_template, ctx.node)
+            self._node = NodeAdapter(ctx, ctx.node_template, ctx.node,
+                                     node_properties.get(ctx.node.id))
             self._instance = NodeInstanceAdapter(ctx, ctx.node)
         elif isinstance(ctx, operation.RelationshipOperationContext):
             self._source = RelationshipTargetAdapter(
                 ctx,
                 ctx.source_node_template,
-                ctx.source_node
+                ctx.source_node,
+                node_properties.get(ctx.source_node.id)
             )
             self._target = RelationshipTargetAdapter(
                 ctx,
                 ctx.target_node_template,
-                ctx.target_node
+                ctx.target_node,
+                node_properties.get(ctx.target_node.id)
             )
 
     def __getattr__(self, item):
@@ -143,7 +163,7 @@ class CloudifyContextAdapter(object):
 
     @property
     def logger(self):
-        return self._ctx.logger
+        return self._logger if self._logger is not None else self._ctx.logger
 
     def send_event(self, event):
         self.logger.info(event)
@@ -153,6 +173,10 @@ class CloudifyContextAdapter(object):
         return {}
 
     def get_resource(self, resource_path):
+        staged_path = self._get_staged_resource(resource_path)
+        if staged_path:
+            with open(staged_path, 'rb') as f:
+                return f.read()
         return self._ctx.get_resource(resource_path)
 
     def get_resource_and_render(self, resource_path, template_variables=None):
@@ -160,10 +184,14 @@ class CloudifyContextAdapter(object):
 
     def download_resource(self, resource_path, target_path=None):
         target_path = self._get_target_path(target_path, resource_path)
-        self._ctx.download_resource(
-            destination=target_path,
-            path=resource_path
-        )
+        staged_path = self._get_staged_resource(resource_path)
+        if staged_path:
+            shutil.copyfile(staged_path, target_path)
+        else:
+            self._ctx.download_resource(
+                destination=target_path,
+                path=resource_path
+            )
         return target_path
 
     def download_resource_and_render(self,
@@ -178,6 +206,29 @@ class CloudifyContextAdapter(object):
         )
         return target_path
 
+    def get_node_instances_by_runtime_property(self, key, value):
+        """
+        Returns the node instances of the service whose runtime property ``key`` is ``value``.
+
+        Looked up in the runtime properties index, if enabled for the key (see
+        :mod:`adapters.runtime_index`), and otherwise by scanning all node instances.
+        """
+        index = runtime_index.from_environment()
+        if index is not None and key in index.keys:
+            nodes = runtime_index.find_nodes(index, self._ctx.model, self._ctx.service.id, key,
+                                             value)
+        else:
+            nodes = [node for node in self._ctx.service.nodes.itervalues()
+                     if key in node.attributes
+                     and getattr(node.attributes[key], 'value', node.attributes[key]) == value]
+        return [NodeInstanceAdapter(self._ctx, node) for node in nodes]
+
+    def _get_staged_resource(self, resource_path):
+        if not self._ctx.task.plugin:
+            return None
+        return staging.get_staged_resource(self._plugin.workdir, self._ctx.task.execution.id,
+                                           resource_path)
+
     @staticmethod
     def _get_target_path(target_path, resource_path):
         if target_path:
@@ -224,10 +275,13 @@ class DeploymentAdapter(object):
 
 class NodeAdapter(object):
 
-    def __init__(self, ctx, node_template, node):
+    def __init__(self, ctx, node_template, node, properties=None):
         self._ctx = ctx
         self._node_template = node_template
         self._node = node
+        self._properties = properties
+        self._properties_view = None
+        self._properties_generation = None
 
     @property
     def id(self):
@@ -239,7 +293,16 @@ class NodeAdapter(object):
 
     @property
     def properties(self):
-        return self._node.properties
+        # Plugins dereference the properties repeatedly, so their plain values are built once, and
+        # again only when properties changed in the model
+        if self._properties_view is None or \
+                self._properties_generation != _properties_generation[0]:
+            properties = self._properties if self._properties is not None \
+                else self._node.properties
+            self._properties_view = PropertiesView(utils.plain_value(properties))
+            # Loading the properties is not a change
+            self._properties_generation = _properties_generation[0]
+        return self._properties_view
 
     @property
     def type(self):
@@ -259,6 +322,42 @@ class NodeAdapter(object):
         return [type_name.replace('aria', 'cloudify') for type_name in type_hierarchy_names]
 
 
+class PropertiesView(dict):
+    """
+    Read-only dict of the plain values of node properties, like Cloudify's
+    ``ImmutableProperties``. Copies of it are plain dicts.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(u'Node properties are read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+# Increased on any change of node properties in the model, to invalidate the cached views
+_properties_generation = [0]
+
+
+def _properties_changed(*args, **kwargs):
+    _properties_generation[0] += 1
+
+
+event.listen(models.Property._value, 'set', _properties_changed)
+event.listen(models.Node.properties, 'append', _properties_changed)
+event.listen(models.Node.properties, 'remove', _properties_changed)
+event.listen(models.Node, 'refresh', _properties_changed)
+event.listen(models.Property, 'refresh', _properties_changed)
+
+
 class NodeInstanceAdapter(object):
 
     def __init__(self, ctx, node):
@@ -279,6 +378,7 @@ class NodeInstanceAdapter(object):
 
     def update(self, on_conflict=None):
         self._ctx.model.node.update(self._node)
+        runtime_index.index_nodes(self._ctx.service.id, [self._node])
 
     def refresh(self, force=False):
         self._ctx.model.node.refresh(self._node)
@@ -313,16 +413,18 @@ class RelationshipAdapter(object):
 
 class RelationshipTargetAdapter(object):
 
-    def __init__(self, ctx, node_template, node):
+    def __init__(self, ctx, node_template, node, properties=None):
         self._ctx = ctx
-        self.node = NodeAdapter(ctx, node_template=node_template, node=node)
+        self.node = NodeAdapter(ctx, node_template=node_template, node=node,
+                                properties=properties)
         self.instance = NodeInstanceAdapter(ctx, node=node)
 
 
 class OperationAdapter(object):
 
-    def __init__(self, ctx):
+    def __init__(self, ctx, history=None):
         self._ctx = ctx
+        self._history = history
 
     @property
     def name(self):
@@ -346,8 +448,19 @@ class OperationAdapter(object):
             return task.max_attempts - 1 if task.max_attempts > 0 else 0
 
     def retry(self, message=None, retry_after=None):
+        if self._history is not None:
+            retry_after = self._history.retry_after(retry_after)
         self._ctx.task.retry(message, retry_after)
 
+    def suggested_retry_after(self, default=None):
+        """
+        Returns the retry interval suggested by the history of past runs of the operation, or
+        ``default`` if there's none (see :mod:`adapters.retry_history`).
+        """
+        if self._history is None:
+            return default
+        return self._history.suggested_retry_after(default)
+
 
 class BootstrapAdapter(object):
 
@@ -362,9 +475,41 @@ class BootstrapAdapter(object):
 
 class CloudifyAgentAdapter(object):
 
+    def __init__(self, ctx):
+        self._ctx = ctx
+
     def init_script(self, *args, **kwargs):
         return None
 
+    def ssh_session(self, host=None, user=None, key_filename=None, port=None):
+        """
+        Returns an SSH session over a persistent connection to the host (see
+        :mod:`adapters.ssh_pool`).
+
+        Unless given, the host is the address of the host of the operation's node, and the user,
+        key and port are the ``ssh_username``, ``private_key_path`` and ``ssh_port`` properties of
+        the node.
+        """
+        node = self._node
+        properties = utils.node_properties(self._ctx)
+        host = host or (node.host.host_address if node is not None and node.host else None)
+        user = user or properties.get('ssh_username')
+        if not host or not user:
+            raise ValueError(u'SSH session needs a host and a user (got host {0!r}, user '
+                             u'{1!r})'.format(host, user))
+        return ssh_pool.get_pool().session(
+            host=host,
+            user=user,
+            key_filename=key_filename or properties.get('private_key_path'),
+            port=port or properties.get('ssh_port') or ssh_pool.DEFAULT_PORT)
+
+    @property
+    def _node(self):
+        if isinstance(self._ctx, operation.NodeOperationContext):
+            return self._ctx.node
+        elif isinstance(self._ctx, operation.RelationshipOperationContext):
+            return self._ctx.source_node
+
 
 class PluginAdapter(object):
 
@@ -386,6 +531,9 @@ class PluginAdapter(object):
 
     @property
     def prefix(self):
+        prefix = plugin_cache.plugin_prefix(self._ctx)
+        if prefix:
+            return prefix
         # TODO
         return self._plugin_attr('prefix')
 
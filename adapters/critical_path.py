@@ -0,0 +1,335 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Critical-path priority scheduling of executions with a limit on their running tasks.
+
+ARIA's engine sends ready tasks in no particular order, so when an execution may only run a few
+tasks at the same time (see :mod:`adapters.concurrency`, and the caps of
+:mod:`adapters.scheduling`), a long operation such as creating a VM may wait behind short ones, and
+start the longest chain of the execution late.
+
+When the ``ARIA_CLOUDIFY_DURATION_HISTORY`` environment variable names an SQLite database file,
+the duration of every operation (from its first attempt being sent to its success) is recorded there
+per node type and operation name. The tasks of executions with a limit are then sent longest
+remaining chain first: the priority of a task is the estimated duration of the longest
+chain of tasks from it to the end of the execution, with each operation estimated by the median of
+its recorded durations.
+
+Tasks waiting for their turn are held back by moving their ``due_at`` to :data:`HELD`, so the
+engine doesn't consider them ready, and are released when running tasks end, up to the lowest of
+the limits that apply to the execution.
+"""
+
+import os
+import time
+import heapq
+import threading
+from datetime import datetime
+
+from aria.orchestrator import exceptions
+
+from . import (concurrency, scheduling, utils)
+
+
+DURATION_HISTORY_ENV_VAR = 'ARIA_CLOUDIFY_DURATION_HISTORY'
+
+# Estimated duration of operations without recorded durations, in seconds
+DEFAULT_DURATION = 1.0
+MAX_SAMPLES = 100
+HELD = datetime(9999, 1, 1)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS durations (
+    node_type TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    duration REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS durations_key ON durations (node_type, operation, recorded);
+"""
+
+_gates = {}
+# Time the first attempt of each task was sent
+_sent = {}
+_lock = threading.Lock()
+
+
+def from_environment(env=None):
+    """
+    Returns the duration history configured through ``ARIA_CLOUDIFY_DURATION_HISTORY``, or
+    ``None``.
+    """
+    path = (os.environ if env is None else env).get(DURATION_HISTORY_ENV_VAR)
+    return DurationHistory(path) if path else None
+
+
+def workflow_started(model, execution, env=None):
+    """
+    Holds back the waiting tasks of the execution, and releases those with the highest priority,
+    if the number of its running tasks is limited.
+    """
+    tasks = list(execution.tasks)
+    # Tasks held by an orchestrator which died
+    for task in tasks:
+        if task.due_at == HELD:
+            task.due_at = datetime.utcnow()
+            model.task.update(task)
+
+    history = from_environment(env)
+    limit = concurrency.get_limit(execution.id)
+    limits = [max_running for max_running in (
+        limit.max_concurrent_tasks if limit is not None else None,
+        scheduling.execution_limit(execution, env)) if max_running]
+    if history is None or not limits:
+        return
+    gate = PriorityGate(model, tasks, critical_paths(tasks, history.estimator()), min(limits))
+    with _lock:
+        _gates[execution.id] = gate
+    gate.start()
+
+
+def task_sent(task, env=None):
+    if from_environment(env) is not None:
+        with _lock:
+            _sent.setdefault(task.id, time.time())
+
+
+def task_ended(task, exception=None, env=None):
+    """
+    Records the duration of a task which succeeded, and releases the tasks which may run next.
+
+    :param exception: exception the task failed with, or ``None`` if it succeeded
+    """
+    retrying = exception is not None and will_retry(task, exception)
+    if not retrying:
+        with _lock:
+            sent = _sent.pop(task.id, None)
+        history = from_environment(env)
+        if exception is None and sent is not None and history is not None:
+            history.record(node_type(task), operation(task), time.time() - sent)
+    with _lock:
+        gate = _gates.get(task.execution.id)
+    if gate is not None:
+        gate.task_ended(task, retrying)
+
+
+def execution_ended(execution_id):
+    with _lock:
+        gate = _gates.pop(execution_id, None)
+    if gate is not None:
+        gate.close()
+
+
+def will_retry(task, exception):
+    """
+    Returns whether ARIA retries a task which failed with the exception.
+    """
+    # Mirrors aria.orchestrator.workflows.core.events_handler._task_failed, which may run after
+    # the receivers of this module
+    return (not isinstance(exception, exceptions.TaskAbortException) and
+            (task.attempts_count < task.max_attempts or
+             task.max_attempts == task.INFINITE_RETRIES) and
+            not task.ignore_failure)
+
+
+def node_type(task):
+    actor = task.actor
+    return actor.type.name if actor is not None and actor.type is not None else u''
+
+
+def operation(task):
+    return u'{0}.{1}'.format(task.interface_name, task.operation_name)
+
+
+def critical_paths(tasks, estimate):
+    """
+    Returns the estimated duration of the longest chain of tasks from each task to the end, by
+    task ID.
+
+    :param tasks: all tasks of an execution
+    :param estimate: function returning the estimated duration of a task
+    """
+    dependents = dict((task.id, []) for task in tasks)
+    remaining = {}
+    for task in tasks:
+        remaining[task.id] = len(task.dependencies)
+        for dependency in task.dependencies:
+            dependents[dependency.id].append(task)
+
+    # Topological order, from the start to the end
+    order = [task for task in tasks if not task.dependencies]
+    for task in order:
+        for dependent in dependents[task.id]:
+            remaining[dependent.id] -= 1
+            if not remaining[dependent.id]:
+                order.append(dependent)
+
+    paths = {}
+    for task in reversed(order):
+        paths[task.id] = estimate(task) + max(
+            [paths[dependent.id] for dependent in dependents[task.id]] or [0])
+    return paths
+
+
+class DurationHistory(object):
+    """
+    Durations of operations, kept in an SQLite database shared by orchestrator processes.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        utils.create_sqlite_schema(path, _SCHEMA)
+
+    def record(self, node_type, operation, duration, now=None):
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT INTO durations (node_type, operation, duration, recorded) '
+                'VALUES (?, ?, ?, ?)', (node_type, operation, duration, now or time.time()))
+
+    def median(self, node_type, operation):
+        """
+        Returns the median of the recent durations of the operation, or ``None``.
+        """
+        with self._connect() as connection:
+            durations = sorted(duration for duration, in connection.execute(
+                'SELECT duration FROM durations WHERE node_type = ? AND operation = ? '
+                'ORDER BY recorded DESC LIMIT ?', (node_type, operation, MAX_SAMPLES)))
+        return utils.percentile(durations, 0.5) if durations else None
+
+    def estimator(self, default=DEFAULT_DURATION):
+        """
+        Returns a function estimating the duration of tasks.
+        """
+        medians = {}
+
+        def estimate(task):
+            if _is_passthrough(task):
+                return 0
+            key = (node_type(task), operation(task))
+            if key not in medians:
+                medians[key] = self.median(*key)
+            return medians[key] if medians[key] is not None else default
+        return estimate
+
+    def _connect(self):
+        return utils.sqlite_transaction(self._path)
+
+
+class PriorityGate(object):
+    """
+    Releases the waiting tasks of an execution in order of priority, so that no more than
+    ``max_running`` of them are running at the same time.
+
+    The held tasks whose dependencies all ended are kept in a heap by priority, and each task
+    which ends only updates the count of unended dependencies of its dependents.
+    """
+
+    def __init__(self, model, tasks, priorities, max_running):
+        self._model = model
+        self._tasks = tasks
+        self._priorities = priorities
+        self._max_running = max_running
+        # Original due time of the held tasks, by ID
+        self._held = {}
+        # IDs of the released tasks which didn't end yet (retrying ones included)
+        self._running = set()
+        self._ended = set()
+        # Number of dependencies which didn't end, and dependents, by task ID
+        self._remaining = {}
+        self._dependents = dict((task.id, []) for task in tasks)
+        # Held tasks whose dependencies all ended, highest priority first
+        self._ready = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            for task in self._tasks:
+                if task.has_ended():
+                    self._ended.add(task.id)
+                elif not _is_passthrough(task) and task.is_waiting():
+                    self._held[task.id] = task.due_at
+                    task.due_at = HELD
+                    self._model.task.update(task)
+            for task in self._tasks:
+                for dependency in task.dependencies:
+                    self._dependents[dependency.id].append(task)
+                self._remaining[task.id] = sum(1 for dependency in task.dependencies
+                                               if dependency.id not in self._ended)
+                if task.id in self._held and not self._remaining[task.id]:
+                    self._push(task)
+            # Stub tasks, and those without a function, end as soon as their dependencies did
+            for task in self._tasks:
+                if _is_passthrough(task) and task.id not in self._ended and \
+                        not self._remaining[task.id]:
+                    self._end(task)
+            self._release()
+
+    def task_ended(self, task, retrying=False):
+        with self._lock:
+            if retrying:
+                # Its slot is kept for its next attempt
+                return
+            self._running.discard(task.id)
+            # The ended task may not be marked as such yet
+            self._end(task)
+            self._release()
+
+    def close(self):
+        """
+        Releases all held tasks.
+        """
+        with self._lock:
+            for task in self._tasks:
+                if task.id in self._held:
+                    task.due_at = self._held.pop(task.id)
+                    self._model.task.update(task)
+            self._ready = []
+
+    def held(self):
+        with self._lock:
+            return set(self._held)
+
+    def _release(self):
+        while self._ready and len(self._running) < self._max_running:
+            task = heapq.heappop(self._ready)[2]
+            task.due_at = self._held.pop(task.id)
+            self._running.add(task.id)
+            self._model.task.update(task)
+
+    def _end(self, task):
+        ended = [task]
+        while ended:
+            task = ended.pop()
+            if task.id in self._ended:
+                continue
+            self._ended.add(task.id)
+            for dependent in self._dependents.get(task.id, []):
+                self._remaining[dependent.id] -= 1
+                if self._remaining[dependent.id]:
+                    continue
+                if dependent.id in self._held:
+                    self._push(dependent)
+                elif _is_passthrough(dependent):
+                    ended.append(dependent)
+
+    def _push(self, task):
+        heapq.heappush(self._ready, (-self._priorities.get(task.id, 0), task.id, task))
+
+
+def _is_passthrough(task):
+    # Stub tasks, and operations without an implementation, take no time, and aren't held
+    return bool(task._stub_type) or not task.function
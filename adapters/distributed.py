@@ -0,0 +1,517 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Execution of Cloudify-based operations by worker daemons on other hosts.
+
+:class:`DistributedProcessExecutor` sends the tasks of Cloudify-based operations over TCP to worker
+daemons (``aria-cloudify-worker``), instead of starting their processes on the orchestrator host.
+A worker starts the same operation process as ARIA's process executor, which runs the operation
+through the executor extension and :class:`~adapters.context_adapter.CloudifyContextAdapter`. The
+worker relays the status messages of the process (started, succeeded, and failed, retry requests
+included) back to the orchestrator, which handles them as those of a local process.
+
+Operation processes load their context from the model storage, and commit runtime properties
+there, as they do on the orchestrator host. Workers must therefore reach the model storage of the
+orchestrator, and see its resource storage and plugins at the same paths (e.g. on a shared
+filesystem). An SQLite model storage is a file that can't safely be written from more than one
+host, so with one, tasks are only sent to workers on the orchestrator host; workers on other hosts
+require the model storage to be a database server.
+
+Messages are pickled, so they are signed with the ``ARIA_CLOUDIFY_WORKER_SECRET`` environment
+variable (HMAC-SHA256), and workers reject messages with another signature. The secret is required
+by both the orchestrator and the workers, as any local user could otherwise have a worker unpickle
+a message of theirs.
+"""
+
+import os
+import sys
+import json
+import hmac
+import errno
+import logging
+import socket
+import signal
+import struct
+import pickle
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from contextlib import closing
+
+import psutil
+import jsonpickle
+
+from aria import logger
+from aria.orchestrator.workflows.executor import process
+from aria.utils import exceptions
+
+from . import utils
+
+
+WORKERS_ENV_VAR = 'ARIA_CLOUDIFY_WORKERS'
+WORKER_SECRET_ENV_VAR = 'ARIA_CLOUDIFY_WORKER_SECRET'
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7711
+DEFAULT_CONNECT_TIMEOUT = 10
+POLL_INTERVAL = 0.1
+
+# Environment variables of the orchestrator that are not passed to operation processes on workers
+_LOCAL_ENV_VARS = (WORKERS_ENV_VAR, WORKER_SECRET_ENV_VAR)
+
+_HEADER = struct.Struct('!I')
+_DIGEST_SIZE = hashlib.sha256().digest_size
+_ENDED_MESSAGES = ('succeeded', 'failed')
+
+
+class DistributedProcessExecutor(process.ProcessExecutor):
+    """
+    Process executor running Cloudify-based operations on worker daemons.
+
+    Tasks are sent to the worker running the fewest tasks of this executor. Workers which can't be
+    connected to are skipped, and a task fails if none can be.
+
+    :param workers: ``host:port`` addresses of workers (defaults to the comma-separated
+     ``ARIA_CLOUDIFY_WORKERS`` environment variable)
+    :param secret: secret messages are signed with (defaults to ``ARIA_CLOUDIFY_WORKER_SECRET``,
+     one of which is required)
+    :param distribute: function deciding whether a task is sent to a worker (by default, the tasks
+     of Cloudify-based plugins are), other tasks run on the orchestrator host
+    """
+
+    def __init__(self, workers=None, secret=None, distribute=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, *args, **kwargs):
+        if workers is None:
+            workers = [worker.strip() for worker in os.environ.get(WORKERS_ENV_VAR, '').split(',')
+                       if worker.strip()]
+        if not workers:
+            raise ValueError(u'No workers given, and ${0} is not set'.format(WORKERS_ENV_VAR))
+        super(DistributedProcessExecutor, self).__init__(*args, **kwargs)
+        self._workers = [parse_address(worker) for worker in workers]
+        self._secret = _get_secret(secret)
+        self._distribute = distribute or utils.is_cloudify_dependent
+        self._connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._load = dict((worker, 0) for worker in self._workers)
+        # Worker of each task sent to one
+        self._remote_tasks = {}
+        # Workers an SQLite model storage can be shared with
+        self._local_workers = [worker for worker in self._workers
+                               if is_local_address(worker[0])]
+
+    def terminate(self, task_id):
+        with self._lock:
+            worker = self._remote_tasks.get(task_id)
+        if worker is None:
+            return super(DistributedProcessExecutor, self).terminate(task_id)
+        self._remove_task(task_id)
+        try:
+            with closing(self._connect(worker)) as connection:
+                send_frame(connection, pickle.dumps({'type': 'terminate', 'task_id': task_id}),
+                           self._secret)
+        except socket.error as e:
+            self.logger.debug(u'Could not terminate task {0} on worker {1}: {2}'.format(
+                task_id, format_address(worker), e))
+
+    def _execute(self, ctx):
+        task = ctx.task
+        if not self._distribute(task):
+            return super(DistributedProcessExecutor, self)._execute(ctx)
+        self._check_closed()
+
+        request = pickle.dumps({'type': 'execute',
+                                'task_id': task.id,
+                                'arguments': self._create_arguments_dict(ctx),
+                                'env': self._worker_env(task)},
+                               pickle.HIGHEST_PROTOCOL)
+        self._tasks[task.id] = process._Task(proc=None, ctx=ctx)
+        workers = self._workers
+        if _is_sqlite(ctx.model):
+            workers = self._local_workers
+            if not workers:
+                self._forward(failure_message(task.id, RuntimeError(
+                    u'The model storage is an SQLite database, which only workers on the '
+                    u'orchestrator host may use; workers on other hosts require a database '
+                    u'server')))
+                return
+        try:
+            worker, connection = self._send(request, workers)
+        except socket.error as e:
+            self._forward(failure_message(task.id, e))
+            return
+        with self._lock:
+            self._remote_tasks[task.id] = worker
+        relay = threading.Thread(target=self._relay, args=(task.id, worker, connection))
+        relay.daemon = True
+        relay.start()
+
+    def _worker_env(self, task):
+        # Only the variables set for the task (e.g. the Python path of its plugin), and those of
+        # the extension, are passed on: the rest of the environment is the worker's
+        env = self._construct_subprocess_env(task=task)
+        return dict((name, value) for name, value in env.iteritems()
+                    if name not in _LOCAL_ENV_VARS and
+                    (os.environ.get(name) != value or name.startswith('ARIA_CLOUDIFY_')))
+
+    def _send(self, request, workers):
+        with self._lock:
+            workers = sorted(workers, key=lambda worker: self._load[worker])
+        error = None
+        for worker in workers:
+            connection = None
+            try:
+                connection = self._connect(worker)
+                send_frame(connection, request, self._secret)
+            except socket.error as e:
+                if connection is not None:
+                    connection.close()
+                self.logger.debug(u'Could not send task to worker {0}: {1}'.format(
+                    format_address(worker), e))
+                error = e
+                continue
+            with self._lock:
+                self._load[worker] += 1
+            return worker, connection
+        raise error
+
+    def _connect(self, worker):
+        connection = socket.create_connection(worker, timeout=self._connect_timeout)
+        connection.settimeout(None)
+        return connection
+
+    def _relay(self, task_id, worker, connection):
+        ended = False
+        try:
+            with closing(connection):
+                while not ended:
+                    message = recv_frame(connection, self._secret)
+                    if message is None:
+                        break
+                    send_frame(connection, self._forward(message), self._secret)
+                    ended = json.loads(message)['type'] in _ENDED_MESSAGES
+        except (socket.error, ValueError) as e:
+            self.logger.debug(u'Lost task {0} on worker {1}: {2}'.format(
+                task_id, format_address(worker), e))
+        finally:
+            with self._lock:
+                self._load[worker] -= 1
+                self._remote_tasks.pop(task_id, None)
+        if not ended and task_id in self._tasks and not self._stopped:
+            self._forward(failure_message(task_id, RuntimeError(
+                u'Lost connection to worker {0}'.format(format_address(worker)))))
+
+    def _forward(self, message):
+        # Messages are handled by the listener thread of the executor, as those of local processes
+        with closing(socket.create_connection(('localhost', self._server_port))) as connection:
+            _send_local_message(connection, message)
+            return _recv_local_message(connection)
+
+
+class Worker(logger.LoggerMixin):
+    """
+    Worker daemon running the operations sent by :class:`DistributedProcessExecutor`.
+
+    :param max_processes: maximum number of operation processes running at the same time (defaults
+     to the number of CPUs); tasks sent while all are running wait for one to end
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, max_processes=None, secret=None,
+                 *args, **kwargs):
+        super(Worker, self).__init__(*args, **kwargs)
+        self._secret = _get_secret(secret)
+        self._slots = threading.BoundedSemaphore(max_processes or multiprocessing.cpu_count())
+        self._processes = {}
+        # Tasks terminated before their process started
+        self._terminated = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_socket.bind((host, port))
+        self._server_socket.listen(64)
+
+    @property
+    def address(self):
+        return self._server_socket.getsockname()
+
+    def serve_forever(self):
+        while not self._stopped:
+            try:
+                connection = self._server_socket.accept()[0]
+            except socket.error as e:
+                if self._stopped:
+                    break
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            thread = threading.Thread(target=self._handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        try:
+            # Wakes up serve_forever
+            self._server_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._server_socket.close()
+        for task_id in self._processes.keys():
+            self.terminate(task_id)
+
+    def terminate(self, task_id):
+        with self._lock:
+            proc = self._processes.get(task_id)
+            if proc is None:
+                self._terminated.add(task_id)
+        if proc is not None:
+            _kill(proc)
+
+    def _handle(self, connection):
+        with closing(connection):
+            try:
+                request = recv_frame(connection, self._secret)
+                if request is None:
+                    return
+                request = pickle.loads(request)
+                if request['type'] == 'terminate':
+                    self.terminate(request['task_id'])
+                elif request['type'] == 'execute':
+                    self._execute(connection, request)
+            except Exception as e:
+                self.logger.warning(u'Error handling a request: {0}'.format(e))
+
+    def _execute(self, connection, request):
+        task_id = request['task_id']
+        # Operation processes send their messages to a port on the local host (see
+        # process._Messenger), from which they're relayed to the orchestrator
+        relay = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        with closing(relay):
+            relay.bind(('localhost', 0))
+            relay.listen(1)
+            relay.settimeout(POLL_INTERVAL)
+            arguments = dict(request['arguments'], port=relay.getsockname()[1])
+            with self._slots:
+                with self._lock:
+                    if task_id in self._terminated or self._stopped:
+                        self._terminated.discard(task_id)
+                        return
+                    proc = self._processes[task_id] = \
+                        self._start_process(arguments, request['env'])
+                try:
+                    ended = self._relay(connection, relay, proc)
+                    proc.wait()
+                    if not ended:
+                        # The process died before reporting its result
+                        send_frame(connection, failure_message(task_id, RuntimeError(
+                            u'Operation process exited with code {0} on worker {1}'.format(
+                                proc.returncode, format_address(self.address)))),
+                            self._secret)
+                        recv_frame(connection, self._secret)
+                finally:
+                    with self._lock:
+                        del self._processes[task_id]
+                    if proc.poll() is None:
+                        _kill(proc)
+
+    def _relay(self, connection, relay, proc):
+        while True:
+            try:
+                child = relay.accept()[0]
+            except socket.timeout:
+                if proc.poll() is not None:
+                    return False
+                continue
+            with closing(child):
+                child.settimeout(None)
+                message = _recv_local_message(child)
+                send_frame(connection, message, self._secret)
+                response = recv_frame(connection, self._secret)
+                if response is None:
+                    raise socket.error(u'Orchestrator closed the connection')
+                _send_local_message(child, response)
+            if json.loads(message)['type'] in _ENDED_MESSAGES:
+                return True
+
+    @staticmethod
+    def _start_process(arguments, env):
+        file_descriptor, arguments_path = tempfile.mkstemp(prefix='executor-', suffix='.json')
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(pickle.dumps(arguments))
+        process_env = os.environ.copy()
+        process_env.update(env)
+        return subprocess.Popen(
+            [sys.executable, os.path.splitext(process.__file__)[0] + '.py', arguments_path],
+            env=process_env)
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(u'Invalid worker address (expected host:port): {0}'.format(address))
+    return host, int(port)
+
+
+def format_address(address):
+    return u'{0}:{1}'.format(*address)
+
+
+def is_local_address(host):
+    """
+    Whether the host name or address is one of the local host.
+    """
+    try:
+        address = socket.gethostbyname(host)
+    except socket.error:
+        return False
+    if address.startswith('127.'):
+        return True
+    return any(interface_address.address == address
+               for interface_addresses in psutil.net_if_addrs().itervalues()
+               for interface_address in interface_addresses)
+
+
+def failure_message(task_id, exception):
+    """
+    Returns a task failure message, as sent by operation processes.
+    """
+    return jsonpickle.dumps({'type': 'failed',
+                             'task_id': task_id,
+                             'exception': exceptions.wrap_if_needed(exception),
+                             'traceback': u''})
+
+
+def send_frame(connection, data, secret):
+    connection.sendall(_HEADER.pack(len(data)) + _sign(data, secret) + data)
+
+
+def recv_frame(connection, secret):
+    """
+    Returns the data of the next frame, or ``None`` if the connection was closed.
+
+    :raises ValueError: if the frame is not signed with the secret
+    """
+    header = _recv_exactly(connection, _HEADER.size)
+    if header is None:
+        return None
+    length, = _HEADER.unpack(header)
+    digest = _recv_exactly(connection, _DIGEST_SIZE)
+    data = _recv_exactly(connection, length)
+    if digest is None or data is None:
+        raise socket.error(u'Connection closed within a message')
+    if not hmac.compare_digest(digest, _sign(data, secret)):
+        raise ValueError(u'Message not signed with the worker secret')
+    return data
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='aria-cloudify-worker',
+        description='Run the Cloudify-based operations sent by orchestrators using '
+                    'adapters.distributed.DistributedProcessExecutor.')
+    parser.add_argument('--host', default=DEFAULT_HOST,
+                        help='address to listen on (defaults to {0})'.format(DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on (defaults to {0})'.format(DEFAULT_PORT))
+    parser.add_argument('--max-processes', type=int,
+                        help='maximum number of operations running at the same time (defaults to '
+                             'the number of CPUs)')
+    args = parser.parse_args(args)
+
+    secret = os.environ.get(WORKER_SECRET_ENV_VAR)
+    if not secret:
+        parser.error('${0} must be set'.format(WORKER_SECRET_ENV_VAR))
+
+    # Terminates the running operations on exit
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.create_logger(handlers=[logger.create_console_log_handler(level=logging.INFO)],
+                         level=logging.INFO)
+    worker = Worker(args.host, args.port, args.max_processes, secret)
+    sys.stdout.write('Listening on {0}\n'.format(format_address(worker.address)))
+    sys.stdout.flush()
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+    return 0
+
+
+def _get_secret(secret):
+    secret = secret if secret is not None else os.environ.get(WORKER_SECRET_ENV_VAR)
+    if not secret:
+        raise ValueError(u'No worker secret given, and ${0} is not set'.format(
+            WORKER_SECRET_ENV_VAR))
+    return secret
+
+
+def _is_sqlite(model):
+    engine = model._all_api_kwargs.get('engine') if model is not None else None
+    return engine is not None and engine.url.drivername.startswith('sqlite')
+
+
+def _sign(data, secret):
+    return hmac.new(secret, data, hashlib.sha256).digest()
+
+
+def _recv_exactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _send_local_message(connection, message):
+    # Framing of the messages of ARIA's operation processes (see process._send_message)
+    connection.sendall(struct.pack(process._INT_FMT, len(message)) + message)
+
+
+def _recv_local_message(connection):
+    header = _recv_exactly(connection, process._INT_SIZE)
+    if header is None:
+        raise socket.error(u'Connection closed before a message')
+    message = _recv_exactly(connection, struct.unpack(process._INT_FMT, header)[0])
+    if message is None:
+        raise socket.error(u'Connection closed within a message')
+    return message
+
+
+def _kill(proc):
+    try:
+        parent = psutil.Process(proc.pid)
+        for child in reversed(parent.children(recursive=True)):
+            try:
+                child.kill()
+            except psutil.Error:
+                pass
+        parent.kill()
+    except psutil.Error:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
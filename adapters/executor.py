@@ -0,0 +1,153 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Cloudify-based operations, run by the executor extension (see :mod:`adapters.extension`).
+"""
+
+import importlib
+from contextlib import contextmanager
+
+from aria.orchestrator import exceptions
+
+from . import (batching, checkpoint, operation_logging, rate_limiting, retry_history,
+               runtime_index, shared_memory, tracing, utils)
+from .context_adapter import CloudifyContextAdapter
+
+
+# Modules of Cloudify's plugins-common used to run operations
+CLOUDIFY_MODULES = ('cloudify.context', 'cloudify.exceptions', 'cloudify.state')
+
+
+def import_cloudify():
+    """
+    Imports the modules of Cloudify's plugins-common used to run operations.
+    """
+    for name in CLOUDIFY_MODULES:
+        importlib.import_module(name)
+
+
+def run_operation(function, ctx, operation_inputs, tracer):
+    """
+    Runs the function of a Cloudify-based operation with a Cloudify context adapter.
+    """
+    logger = operation_logging.operation_logger(ctx)
+    try:
+        _run_cloudify_operation(function, ctx, operation_inputs, tracer, logger)
+    except BaseException:
+        _operation_ended(ctx, succeeded=False, logger=logger)
+        raise
+    _operation_ended(ctx, succeeded=True, logger=logger)
+
+
+def _run_cloudify_operation(function, ctx, operation_inputs, tracer, logger=None):
+    from cloudify import context
+    from cloudify.exceptions import (NonRecoverableError, RecoverableError)
+
+    with tracer.traced_exit(tracing.MODEL_FLUSH,
+                            ctx.model.instrument(*ctx.INSTRUMENTATION_FIELDS)):
+        with tracer.span(tracing.ADAPTER_SETUP):
+            # Arguments passed by SharedMemoryProcessExecutor are references to be loaded
+            operation_inputs, node_properties = \
+                shared_memory.resolve_arguments(operation_inputs)
+            history = retry_history.operation_history(ctx, operation_inputs)
+            # We need to create a new class dynamically, since CloudifyContextAdapter
+            # doesn't exist at runtime
+            ctx_adapter = type('_CloudifyContextAdapter',
+                               (CloudifyContextAdapter, context.CloudifyContext),
+                               {}, )(ctx, node_properties, history, logger)
+
+        with retry_history.attempt(history):
+            bucket = rate_limiting.limit_operation(ctx, operation_inputs)
+            if bucket is not None:
+                with tracer.span(tracing.RATE_LIMIT_WAIT):
+                    bucket.acquire()
+
+            exception = None
+            with _push_cfy_ctx(ctx_adapter, operation_inputs):
+                try:
+                    with tracer.span(tracing.PLUGIN_FUNCTION):
+                        batching.call_operation(function, ctx_adapter, operation_inputs)
+                except NonRecoverableError as e:
+                    ctx.task.abort(str(e))
+                except RecoverableError as e:
+                    retry_after = e.retry_after
+                    if history is not None:
+                        retry_after = history.retry_after(retry_after)
+                    _retrying(tracer, bucket, str(e), retry_after)
+                    ctx.task.retry(str(e), retry_interval=retry_after)
+                except exceptions.TaskRetryException as e:
+                    # Retried through ctx.operation.retry(), which applied the history already
+                    _retrying(tracer, bucket, str(e), e.retry_interval)
+                    exception = e
+                except BaseException as e:
+                    # Keep exception and raise it outside of "with", because
+                    # contextmanager does not allow raising exceptions
+                    exception = e
+            if exception is not None:
+                raise exception
+
+
+def _retrying(tracer, bucket, message, retry_after):
+    tracer.instant(tracing.RETRY, retry_after=retry_after)
+    if bucket is not None:
+        bucket.throttled(message)
+
+
+def _operation_ended(ctx, succeeded, logger=None):
+    # Runs once the runtime properties were committed, when the instrumentation ended
+    if logger is not None:
+        try:
+            # A retry is a failure of the attempt, whose details are worth keeping as well
+            logger.flush(failed=not succeeded)
+        except Exception as e:
+            ctx.logger.warning(u'Could not write the logs of the operation: {0}'.format(e))
+    try:
+        checkpoint.operation_ended(ctx, succeeded)
+    except Exception as e:
+        ctx.logger.warning(u'Could not write the checkpoint of the operation: {0}'.format(e))
+    try:
+        runtime_index.index_nodes(ctx.service.id, utils.task_nodes(ctx.task))
+    except Exception as e:
+        ctx.logger.warning(u'Could not index the runtime properties of the operation: {0}'
+                           .format(e))
+
+
+@contextmanager
+def _push_cfy_ctx(ctx, params):
+    from cloudify import state
+
+    try:
+        # Support for Cloudify > 4.0
+        with state.current_ctx.push(ctx, params) as current_ctx:
+            yield current_ctx
+
+    except AttributeError:
+        # Support for Cloudify < 4.0
+        try:
+            original_ctx = state.current_ctx.get_ctx()
+        except RuntimeError:
+            original_ctx = None
+        try:
+            original_params = state.current_ctx.get_parameters()
+        except RuntimeError:
+            original_params = None
+
+        state.current_ctx.set(ctx, params)
+        try:
+            yield state.current_ctx.get_ctx()
+        finally:
+            state.current_ctx.set(original_ctx, original_params)
@@ -14,12 +14,18 @@
 # under the License.
 #
 
+"""
+Entry point of the extension, loaded by every ARIA command and every operation process.
+
+Loading it only registers the executor decorator and the signal receivers, with what ARIA already
+imported: the adapters (and through them, Cloudify's modules and the rest of ARIA's orchestrator)
+are imported by the receivers and the decorator, once an execution or an operation runs.
+"""
+
 from functools import wraps
-from contextlib import contextmanager
 
 from aria import extension as aria_extension
-
-from .context_adapter import CloudifyContextAdapter
+from aria.orchestrator import events
 
 
 @aria_extension.process_executor
@@ -29,64 +35,166 @@ class CloudifyExecutorExtension(object):
         def decorator(function):
             @wraps(function)
             def wrapper(ctx, **operation_inputs):
-                # We assume that any Cloudify-based plugin would use the plugins-common, thus two
-                # different paths are created
-                is_cloudify_dependent = ctx.task.plugin and any(
-                    'cloudify_plugins_common' in w for w in ctx.task.plugin.wheels)
-
-                if is_cloudify_dependent:
-                    from cloudify import context
-                    from cloudify.exceptions import (NonRecoverableError, RecoverableError)
-
-                    with ctx.model.instrument(*ctx.INSTRUMENTATION_FIELDS):
-                        # We need to create a new class dynamically, since CloudifyContextAdapter
-                        # doesn't exist at runtime
-                        ctx_adapter = type('_CloudifyContextAdapter',
-                                           (CloudifyContextAdapter, context.CloudifyContext),
-                                           {}, )(ctx)
-
-                        exception = None
-                        with _push_cfy_ctx(ctx_adapter, operation_inputs):
-                            try:
-                                function(ctx=ctx_adapter, **operation_inputs)
-                            except NonRecoverableError as e:
-                                ctx.task.abort(str(e))
-                            except RecoverableError as e:
-                                ctx.task.retry(str(e), retry_interval=e.retry_after)
-                            except BaseException as e:
-                                # Keep exception and raise it outside of "with", because
-                                # contextmanager does not allow raising exceptions
-                                exception = e
-                        if exception is not None:
-                            raise exception
-                else:
-                    function(ctx=ctx, **operation_inputs)
+                from . import (memory_profiling, tracing, utils)
+
+                # We assume that any Cloudify-based plugin would use the plugins-common,
+                # thus two different paths are created
+                cloudify_dependent = utils.is_cloudify_dependent(ctx.task)
+                if cloudify_dependent:
+                    # Imported before the memory profiler takes its baseline, so that what they
+                    # load doesn't count as retained by the operation
+                    from . import executor
+                    executor.import_cloudify()
+
+                tracer = tracing.operation_tracer(ctx)
+                try:
+                    with memory_profiling.operation_profiler(ctx):
+                        if cloudify_dependent:
+                            executor.run_operation(function, ctx, operation_inputs, tracer)
+                        else:
+                            with tracer.span(tracing.PLUGIN_FUNCTION):
+                                function(ctx=ctx, **operation_inputs)
+                finally:
+                    tracer.flush()
             return wrapper
         return decorator
 
 
-@contextmanager
-def _push_cfy_ctx(ctx, params):
-    from cloudify import state
+@events.start_workflow_signal.connect
+def _stage_resources(workflow_context, *args, **kwargs):
+    from . import staging
+
+    # Staging is an optimization only; any resource that couldn't be staged is still fetched from
+    # the resource storage by the operation itself
+    try:
+        staged = staging.stage_resources(workflow_context)
+    except Exception as e:
+        workflow_context.logger.debug(u'Could not stage resources: {0}'.format(e))
+    else:
+        if staged:
+            workflow_context.logger.debug(
+                u'Staged resources: {0}'.format(u', '.join(staged)))
+
+
+@events.start_workflow_signal.connect
+@events.on_resume_workflow_signal.connect
+def _cache_plugin_environments(workflow_context, *args, **kwargs):
+    from . import plugin_cache
 
+    # Operations use the installed plugin environments when they aren't cached
     try:
-        # Support for Cloudify > 4.0
-        with state.current_ctx.push(ctx, params) as current_ctx:
-            yield current_ctx
-
-    except AttributeError:
-        # Support for Cloudify < 4.0
-        try:
-            original_ctx = state.current_ctx.get_ctx()
-        except RuntimeError:
-            original_ctx = None
-        try:
-            original_params = state.current_ctx.get_parameters()
-        except RuntimeError:
-            original_params = None
-
-        state.current_ctx.set(ctx, params)
-        try:
-            yield state.current_ctx.get_ctx()
-        finally:
-            state.current_ctx.set(original_ctx, original_params)
+        cached = plugin_cache.cache_plugins(workflow_context)
+    except Exception as e:
+        workflow_context.logger.debug(u'Could not cache plugin environments: {0}'.format(e))
+    else:
+        if cached:
+            workflow_context.logger.debug(
+                u'Cached plugin environments: {0}'.format(u', '.join(cached)))
+
+
+@events.sent_task_signal.connect
+def _trace_task_sent(ctx, *args, **kwargs):
+    from . import tracing
+
+    tracer = tracing.orchestrator_tracer()
+    if tracer:
+        tracer.task_sent(ctx.task)
+
+
+@events.on_failure_task_signal.connect
+def _trace_task_failed(ctx, *args, **kwargs):
+    from . import tracing
+
+    tracer = tracing.orchestrator_tracer()
+    if tracer:
+        tracer.task_failed(ctx.task)
+
+
+@events.on_success_workflow_signal.connect
+@events.on_failure_workflow_signal.connect
+@events.on_cancelled_workflow_signal.connect
+def _export_trace(workflow_context, *args, **kwargs):
+    from . import tracing
+
+    tracer = tracing.orchestrator_tracer()
+    if tracer:
+        tracer.execution_ended(workflow_context.execution)
+
+
+@events.on_success_workflow_signal.connect
+@events.on_failure_workflow_signal.connect
+@events.on_cancelled_workflow_signal.connect
+def _report_memory_profile(workflow_context, *args, **kwargs):
+    from . import memory_profiling
+
+    memory_profiling.execution_ended(workflow_context.execution, workflow_context.logger)
+
+
+@events.on_success_workflow_signal.connect
+def _mark_scaled_in_nodes(workflow_context, *args, **kwargs):
+    from . import workflows
+
+    workflows.mark_scaled_in_nodes(workflow_context)
+
+
+@events.sent_task_signal.connect
+def _wait_for_task_slot(ctx, *args, **kwargs):
+    from . import (scheduling, utils)
+
+    # Runs in the engine's thread, which only checks for cancellation between tasks
+    scheduling.task_sent(ctx.task, cancelled=lambda: utils.is_cancelled(ctx))
+
+
+@events.on_success_task_signal.connect
+@events.on_failure_task_signal.connect
+def _release_task_slot(ctx, *args, **kwargs):
+    from . import (concurrency, scheduling)
+
+    scheduling.task_ended(ctx.task)
+    concurrency.task_ended(ctx.task)
+
+
+@events.start_workflow_signal.connect
+def _prioritize_tasks(workflow_context, *args, **kwargs):
+    from . import critical_path
+
+    critical_path.workflow_started(workflow_context.model, workflow_context.execution)
+
+
+@events.sent_task_signal.connect
+def _record_task_sent(ctx, *args, **kwargs):
+    from . import critical_path
+
+    critical_path.task_sent(ctx.task)
+
+
+@events.on_success_task_signal.connect
+def _release_next_tasks(ctx, *args, **kwargs):
+    from . import critical_path
+
+    critical_path.task_ended(ctx.task)
+
+
+@events.on_failure_task_signal.connect
+def _release_next_tasks_on_failure(ctx, exception, *args, **kwargs):
+    from . import critical_path
+
+    critical_path.task_ended(ctx.task, exception)
+
+
+@events.on_success_workflow_signal.connect
+@events.on_failure_workflow_signal.connect
+@events.on_cancelled_workflow_signal.connect
+def _clear_concurrency_limit(workflow_context, *args, **kwargs):
+    from . import (concurrency, critical_path, scheduling)
+
+    critical_path.execution_ended(workflow_context.execution.id)
+    concurrency.clear_limit(workflow_context.execution.id)
+    scheduling.execution_ended(workflow_context.execution.id)
+
+
+@events.on_success_workflow_signal.connect
+def _clear_checkpoints(workflow_context, *args, **kwargs):
+    from . import checkpoint
+
+    checkpoint.clear(workflow_context.execution.id)
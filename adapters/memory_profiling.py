@@ -0,0 +1,261 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Memory profiling of operations, for finding the operations which leak.
+
+When the ``ARIA_CLOUDIFY_MEMORY_PROFILE_DIR`` environment variable is set, every operation run
+through the executor extension records:
+
+* the RSS of its process before and after it ran (after a garbage collection), and the memory it
+  retained: the difference between the two;
+* the peak RSS of its process while it ran, sampled every :data:`SAMPLE_INTERVAL` seconds;
+* the types of objects whose number of live instances grew the most while it ran (a snapshot diff
+  of the garbage collector's objects, since Python 2 has no ``tracemalloc``);
+* the files it left in the system temporary directory.
+
+Each operation process writes its record to a fragment file of its own, and the records of an
+execution are aggregated by operation name into ``<profile dir>/<execution id>.json`` when the
+execution ends (or explicitly, by calling :func:`report`). An operation is flagged as growing when
+it was invoked at least :data:`MIN_INVOCATIONS` times, and the memory it retained increased by at
+least :data:`RETAINED_THRESHOLD` bytes over its invocations (see :func:`retained_growth`): memory
+retained in the same amount by every invocation of its own process is the cost of what it loads,
+not a leak.
+"""
+
+import os
+import gc
+import time
+import tempfile
+import threading
+import collections
+from contextlib import contextmanager
+
+import psutil
+
+from . import utils
+
+
+MEMORY_PROFILE_DIR_ENV_VAR = 'ARIA_CLOUDIFY_MEMORY_PROFILE_DIR'
+
+SAMPLE_INTERVAL = 0.05
+TOP_OBJECT_TYPES = 10
+MIN_INVOCATIONS = 3
+RETAINED_THRESHOLD = 1024 * 1024
+
+
+def get_profile_dir(env=None):
+    return (os.environ if env is None else env).get(MEMORY_PROFILE_DIR_ENV_VAR) or None
+
+
+@contextmanager
+def operation_profiler(ctx, env=None):
+    """
+    Profiles the memory of the operation run within, if profiling is enabled.
+    """
+    profile_dir = get_profile_dir(env)
+    if not profile_dir:
+        yield
+        return
+    task = ctx.task
+    actor = task.actor
+    profiler = MemoryProfiler(profile_dir, execution_id=task.execution.id, task_id=task.id, args={
+        'operation': u'{0}.{1}'.format(task.interface_name, task.operation_name),
+        'function': task.function,
+        'node': actor.name if actor is not None else None,
+        'attempt': task.attempts_count
+    })
+    with profiler.profile():
+        yield
+
+
+def report(profile_dir, execution_id):
+    """
+    Merges the records of the execution into ``<profile dir>/<execution id>.json``, and aggregates
+    them by operation name.
+
+    Records which were already merged are kept, so this may be called more than once.
+
+    :return: the report
+    """
+    def merge(report, fragments):
+        invocations = (report['invocations'] if report else []) + fragments
+        invocations.sort(key=lambda invocation: invocation['started'])
+        return {'operations': aggregate(invocations), 'invocations': invocations}
+
+    _, result = utils.merge_fragments(profile_dir, execution_id, merge, indent=2)
+    return result
+
+
+def aggregate(invocations):
+    """
+    Returns the profile of each operation name, from the records of its invocations.
+    """
+    by_operation = collections.OrderedDict()
+    for invocation in invocations:
+        by_operation.setdefault(invocation['operation'], []).append(invocation)
+
+    operations = {}
+    for name, records in by_operation.iteritems():
+        retained = [record['retained'] for record in records]
+        object_growth = collections.Counter()
+        for record in records:
+            object_growth.update(record['object_growth'])
+        growth = retained_growth(records)
+        operations[name] = {
+            'invocations': len(records),
+            'functions': sorted(set(record['function'] for record in records
+                                    if record['function'])),
+            'peak_rss': max(record['peak_rss'] for record in records),
+            'retained': retained,
+            'median_retained': utils.percentile(sorted(retained), 0.5),
+            'retained_growth': growth,
+            'object_growth': dict(object_growth.most_common(TOP_OBJECT_TYPES)),
+            'temp_files': sum(len(record['temp_files']) for record in records),
+            'growing': len(records) >= MIN_INVOCATIONS and growth >= RETAINED_THRESHOLD
+        }
+    return operations
+
+
+def retained_growth(records):
+    """
+    Returns how much the memory retained by an operation increased over its invocations, in
+    bytes: the least-squares slope of the memory retained after each invocation, times the number
+    of invocations after the first.
+
+    Invocations in the same process add up, as the memory retained by one of them is still held
+    when the next one runs.
+
+    :param records: records of the invocations of the operation, in the order they started
+    """
+    levels = []
+    by_process = {}
+    for record in records:
+        by_process[record['pid']] = by_process.get(record['pid'], 0) + record['retained']
+        levels.append(by_process[record['pid']])
+    count = len(levels)
+    if count < 2:
+        return 0
+    mean_index = (count - 1) / 2.0
+    mean_level = sum(levels) / float(count)
+    slope = sum((index - mean_index) * (level - mean_level)
+                for index, level in enumerate(levels)) / \
+        sum((index - mean_index) ** 2 for index in range(count))
+    return int(slope * (count - 1))
+
+
+def execution_ended(execution, logger, env=None):
+    """
+    Writes the report of the execution, and warns of the operations flagged as growing.
+    """
+    profile_dir = get_profile_dir(env)
+    if not profile_dir:
+        return None
+    profile = report(profile_dir, execution.id)
+    for name in growing_operations(profile):
+        operation = profile['operations'][name]
+        logger.warning(u'Memory retained by operation {0} increased by {1} bytes over {2} '
+                       u'invocations (see {3})'.format(
+                           name, operation['retained_growth'], operation['invocations'],
+                           os.path.join(profile_dir, '{0}.json'.format(execution.id))))
+    return profile
+
+
+def growing_operations(profile):
+    """
+    Returns the names of the operations of a report flagged as growing.
+    """
+    return sorted(name for name, operation in profile['operations'].iteritems()
+                  if operation['growing'])
+
+
+class MemoryProfiler(object):
+    """
+    Records the memory used and retained by an operation, and writes it as a fragment of the
+    execution's report.
+    """
+
+    def __init__(self, profile_dir, execution_id, task_id, args=None):
+        self._profile_dir = profile_dir
+        self._execution_id = execution_id
+        self._task_id = task_id
+        self._args = args or {}
+        self._process = psutil.Process(os.getpid())
+        self._peak_rss = 0
+        self._sampling = threading.Event()
+
+    @contextmanager
+    def profile(self):
+        temp_files = _temp_files()
+        rss_before = self._rss()
+        objects = _object_counts()
+        self._peak_rss = rss_before
+        started = time.time()
+        sampler = threading.Thread(target=self._sample, name='memory-profiler')
+        sampler.daemon = True
+        self._sampling.set()
+        sampler.start()
+        try:
+            yield
+        finally:
+            self._sampling.clear()
+            sampler.join()
+            duration = time.time() - started
+            rss_after = self._rss()
+            growth = collections.Counter(_object_counts())
+            growth.subtract(objects)
+            self._write(dict(
+                self._args,
+                task_id=self._task_id,
+                pid=os.getpid(),
+                started=started,
+                duration=duration,
+                rss_before=rss_before,
+                rss_after=rss_after,
+                retained=rss_after - rss_before,
+                peak_rss=max(self._peak_rss, rss_after),
+                object_growth=dict((name, count) for name, count
+                                   in growth.most_common(TOP_OBJECT_TYPES) if count > 0),
+                temp_files=sorted(_temp_files() - temp_files)))
+
+    def _sample(self):
+        while self._sampling.is_set():
+            self._peak_rss = max(self._peak_rss, self._process.memory_info().rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def _rss(self):
+        # Only memory still referenced counts as retained
+        gc.collect()
+        return self._process.memory_info().rss
+
+    def _write(self, record):
+        utils.write_fragment(self._profile_dir, self._execution_id, self._task_id, record)
+
+
+def _object_counts():
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        obj_type = type(obj)
+        counts[u'{0}.{1}'.format(obj_type.__module__, obj_type.__name__)] += 1
+    return counts
+
+
+def _temp_files():
+    directory = tempfile.gettempdir()
+    try:
+        return set(os.path.join(directory, name) for name in os.listdir(directory))
+    except OSError:
+        return set()
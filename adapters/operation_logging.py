@@ -0,0 +1,259 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Buffered, level-filtered logging of Cloudify-based operations.
+
+ARIA's operation logger writes every record to the model storage as it is logged, and verbose
+plugins log thousands of DEBUG records per operation. When the ``ARIA_CLOUDIFY_LOG_LEVELS``
+environment variable is set, ``ctx.logger`` of Cloudify-based plugins is instead a
+:class:`BufferedLogger`, in front of ARIA's logger:
+
+* Records at or above the level of the operation are passed to the handlers of ARIA's logger in
+  batches, of up to :data:`FLUSH_SIZE` records or every :data:`FLUSH_INTERVAL` seconds, and when
+  the operation ends. The records of a batch are written to the model storage with a single
+  commit, in a session of their own, so the changes the operation hasn't committed yet aren't
+  committed with them; the other handlers (such as the file and console handlers of the CLI)
+  handle them one at a time.
+* Records below the level are kept in a ring buffer of the last ``ARIA_CLOUDIFY_LOG_BUFFER``
+  records (:data:`DEFAULT_BUFFER_SIZE` by default), which is passed on only if the operation fails
+  (or retries), and dropped otherwise.
+
+``ARIA_CLOUDIFY_LOG_LEVELS`` is a comma-separated list of a default level, and of levels by plugin
+name or by operation, e.g. ``INFO,cloudify-aws-plugin=DEBUG,cloudify_aws.ec2.*=WARNING``. Operation
+patterns match the function (e.g. ``cloudify_aws.ec2.instance.create``) or the name (e.g.
+``Standard.create``) of the operation, and the first matching one applies, before the level of the
+plugin and then the default (``DEBUG``, if none is given).
+"""
+
+import os
+import sys
+import time
+import fnmatch
+import logging
+import threading
+import collections
+from datetime import datetime
+
+from sqlalchemy import orm
+
+from aria import logger as aria_logger
+
+
+LOG_LEVELS_ENV_VAR = 'ARIA_CLOUDIFY_LOG_LEVELS'
+LOG_BUFFER_ENV_VAR = 'ARIA_CLOUDIFY_LOG_BUFFER'
+
+DEFAULT_BUFFER_SIZE = 1000
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 1.0
+
+
+def operation_logger(ctx, env=None):
+    """
+    Returns the buffered logger of the operation, or ``None`` if ``ARIA_CLOUDIFY_LOG_LEVELS`` is
+    not set.
+
+    :param ctx: ARIA operation context
+    """
+    env = os.environ if env is None else env
+    spec = env.get(LOG_LEVELS_ENV_VAR)
+    if not spec:
+        return None
+    task = ctx.task
+    level = operation_level(parse_levels(spec), function=task.function,
+                            operation=u'{0}.{1}'.format(task.interface_name, task.operation_name),
+                            plugin=task.plugin.name if task.plugin else None)
+    return BufferedLogger(ctx.logger, task_id=task.id, level=level,
+                          buffer_size=int(env.get(LOG_BUFFER_ENV_VAR) or DEFAULT_BUFFER_SIZE))
+
+
+def parse_levels(spec):
+    """
+    Parses ``ARIA_CLOUDIFY_LOG_LEVELS``.
+
+    :return: default level, and list of names (or patterns) and their levels
+    :raises ValueError: on an unknown level
+    """
+    default = logging.DEBUG
+    levels = []
+    for entry in spec.split(','):
+        name, _, level_name = entry.strip().rpartition('=')
+        if not level_name:
+            continue
+        level = logging.getLevelName(level_name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError(u'Unknown log level in {0}: {1}'.format(LOG_LEVELS_ENV_VAR, entry))
+        if name.strip():
+            levels.append((name.strip(), level))
+        else:
+            default = level
+    return default, levels
+
+
+def operation_level(levels, function, operation, plugin=None):
+    """
+    Returns the level of an operation.
+
+    :param levels: default level and levels by name, as returned by :func:`parse_levels`
+    """
+    default, named = levels
+    for pattern, level in named:
+        if (function and fnmatch.fnmatchcase(function, pattern)) or \
+                fnmatch.fnmatchcase(operation, pattern):
+            return level
+    for name, level in named:
+        if name == plugin:
+            return level
+    return default
+
+
+class BufferedLogger(object):
+    """
+    Logger passing records at or above its level to the handlers of the operation's logger in
+    batches, and keeping the last records below it, to be passed on if the operation fails.
+
+    :param logger: the operation's logger, whose handlers the records are passed to, and whose
+     other attributes are passed through
+    """
+
+    def __init__(self, logger, task_id=None, level=logging.DEBUG,
+                 buffer_size=DEFAULT_BUFFER_SIZE, flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self._logger = logger
+        self._task_id = task_id
+        self._level = level
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._buffer = collections.deque(maxlen=buffer_size)
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+
+    def __getattr__(self, item):
+        return getattr(self._logger, item)
+
+    @property
+    def level(self):
+        return self._level
+
+    def setLevel(self, level):
+        self._level = logging.getLevelName(level) if isinstance(level, basestring) else level
+
+    def isEnabledFor(self, level):
+        # Records below the level are still kept for failures
+        return self._buffer.maxlen > 0 or level >= self._level
+
+    def getEffectiveLevel(self):
+        return self._level
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    warn = warning
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        kwargs.setdefault('exc_info', True)
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self.log(logging.CRITICAL, msg, *args, **kwargs)
+
+    fatal = critical
+
+    def log(self, level, msg, *args, **kwargs):
+        record = self._make_record(level, msg, args, **kwargs)
+        with self._lock:
+            if level < self._level:
+                self._buffer.append(record)
+                return
+            self._pending.append(record)
+            if len(self._pending) >= self._flush_size or \
+                    time.time() - self._last_flush >= self._flush_interval:
+                self._flush()
+
+    def flush(self, failed=False):
+        """
+        Passes on the pending records, and the buffered records below the level if the operation
+        failed (dropping them otherwise).
+        """
+        with self._lock:
+            if failed:
+                self._pending.extend(self._buffer)
+                self._pending.sort(key=lambda record: record.created)
+            self._buffer.clear()
+            self._flush()
+
+    def _flush(self):
+        records, self._pending = self._pending, []
+        self._last_flush = time.time()
+        if not records:
+            return
+        # Same handlers as logging.Logger.callHandlers, with the storage handlers writing the
+        # batch at once
+        logger = self._logger
+        while logger is not None:
+            for handler in logger.handlers:
+                handled = [record for record in records if record.levelno >= handler.level]
+                if isinstance(handler, aria_logger._SQLAlchemyHandler):
+                    _write_logs(handler, [record for record in handled if handler.filter(record)])
+                else:
+                    for record in handled:
+                        handler.handle(record)
+            logger = logger.parent if logger.propagate else None
+
+    def _make_record(self, level, msg, args, exc_info=None, extra=None, **kwargs):
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        record = logging.LogRecord(getattr(self._logger, 'name', __name__), level, '', 0, msg,
+                                   args, exc_info)
+        # ARIA's handlers write the message without its arguments, and the traceback only from an
+        # attribute of their own
+        record.msg, record.args = record.getMessage(), None
+        if exc_info:
+            record.traceback = logging.Formatter().formatException(exc_info)
+        record.task_id = self._task_id
+        record.__dict__.update(extra or {})
+        return record
+
+
+def _write_logs(handler, records):
+    # Mirrors aria.logger._SQLAlchemyHandler.emit, which commits a record at a time
+    if not records:
+        return
+    session = orm.Session(bind=handler._model._all_api_kwargs['engine'])
+    try:
+        session.add_all([handler._cls(
+            execution_fk=handler._execution_id,
+            task_fk=getattr(record, 'task_id', None),
+            level=record.levelname,
+            msg=record.getMessage(),
+            created_at=datetime.fromtimestamp(record.created),
+            traceback=getattr(record, 'traceback', None)) for record in records])
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
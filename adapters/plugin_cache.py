@@ -0,0 +1,376 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Shared, read-only cache of plugin environments.
+
+ARIA installs every plugin once, into ``<workdir>/plugins/<package_name>-<package_version>``. When
+an execution starts, the orchestrator copies the environment of each plugin its Cloudify operations
+use into the cache (once per installation of the plugin), keyed by a hash of its content, so
+plugins whose environments have the same content share one copy. It also records that the plugin
+workdir of the service uses the environment (see :meth:`PluginEnvironmentCache.add_reference`), so
+it is kept for as long as the workdir exists. Operations only look the environment up, as their
+``ctx.plugin.prefix``; the per-service plugin workdir is left to the plugin as scratch space.
+
+The cache is enabled by setting the ``ARIA_CLOUDIFY_PLUGIN_CACHE_DIR`` environment variable, and
+unused environments are removed with ``aria-plugin-cache gc``.
+"""
+
+import os
+import sys
+import stat
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from . import utils
+
+
+CACHE_DIR_ENV_VAR = 'ARIA_CLOUDIFY_PLUGIN_CACHE_DIR'
+
+_ENVIRONMENTS_DIR = 'environments'
+_REFERENCES_DIR = 'references'
+_INSTALLATIONS_DIR = 'installations'
+_LOCK_FILE = '.lock'
+_TEMP_PREFIX = '.tmp-'
+# Compiled by the Python processes which load the plugin
+_IGNORED_SUFFIXES = ('.pyc', '.pyo')
+
+
+def from_environment(env=None):
+    """
+    Returns the cache configured through ``ARIA_CLOUDIFY_PLUGIN_CACHE_DIR``, or ``None``.
+    """
+    cache_dir = (os.environ if env is None else env).get(CACHE_DIR_ENV_VAR)
+    return PluginEnvironmentCache(cache_dir) if cache_dir else None
+
+
+def cache_plugins(ctx, env=None):
+    """
+    Caches the environments of the plugins used by the Cloudify operations of the execution, and
+    references them from the plugin workdirs of the service.
+
+    :param ctx: workflow context
+    :return: keys of the environments of the plugins
+    """
+    cache = from_environment(env)
+    if cache is None or ctx._workdir is None:
+        return []
+    plugins = {}
+    for task in ctx.execution.tasks:
+        if not task._stub_type and utils.is_cloudify_dependent(task):
+            plugins[task.plugin.id] = task.plugin
+    keys = []
+    for plugin in plugins.itervalues():
+        installed_dir = installed_plugin_dir(ctx._workdir, plugin)
+        if not os.path.isdir(installed_dir):
+            continue
+        key = cache.add_plugin(plugin, installed_dir)
+        workdir = utils.plugin_workdir(ctx._workdir, ctx.service.id, plugin.name)
+        utils.makedirs(workdir)
+        cache.add_reference(key, workdir)
+        keys.append(key)
+    return sorted(keys)
+
+
+def plugin_prefix(ctx, env=None):
+    """
+    Returns the environment of the operation's plugin: the cached one, or else the one it is
+    installed in, or ``None`` if the cache isn't enabled.
+
+    :param ctx: operation context
+    """
+    cache = from_environment(env)
+    plugin = ctx.task.plugin
+    if cache is None or plugin is None or ctx._workdir is None:
+        return None
+    installed_dir = installed_plugin_dir(ctx._workdir, plugin)
+    key = cache.plugin_key(plugin, installed_dir)
+    return (key and cache.get_environment(key)) or \
+        (installed_dir if os.path.isdir(installed_dir) else None)
+
+
+def installed_plugin_dir(workdir, plugin):
+    # Mirrors aria.orchestrator.plugin.PluginManager.get_plugin_dir, with the plugins directory of
+    # ARIA's CLI
+    return os.path.join(workdir, 'plugins',
+                        u'{0}-{1}'.format(plugin.package_name, plugin.package_version))
+
+
+def environment_key(environment_dir):
+    """
+    Hash of the content of a plugin environment: of the path and content of every file in it, and
+    the target of every symbolic link, except for compiled Python modules.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(environment_dir):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, environment_dir)
+            if os.path.islink(path):
+                entry = u'link:{0}:{1}'.format(relative_path, os.readlink(path))
+            elif os.path.isfile(path) and not name.endswith(_IGNORED_SUFFIXES):
+                entry = u'file:{0}:{1}'.format(relative_path, _file_hash(path))
+            else:
+                continue
+            digest.update(entry.encode('utf-8'))
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class PluginEnvironmentCache(object):
+
+    def __init__(self, cache_dir):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._environments_dir = os.path.join(self._cache_dir, _ENVIRONMENTS_DIR)
+        self._references_dir = os.path.join(self._cache_dir, _REFERENCES_DIR)
+        self._installations_dir = os.path.join(self._cache_dir, _INSTALLATIONS_DIR)
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def environments(self):
+        if not os.path.isdir(self._environments_dir):
+            return []
+        return sorted(key for key in os.listdir(self._environments_dir)
+                      if not key.startswith(_TEMP_PREFIX))
+
+    def get_environment(self, key):
+        environment_dir = os.path.join(self._environments_dir, key)
+        return environment_dir if os.path.isdir(environment_dir) else None
+
+    def add_environment(self, key, source_dir):
+        """
+        Copies ``source_dir`` into the cache, unless an environment with the same key exists.
+
+        The copy is made read-only and is published atomically, so concurrent callers either see
+        the complete environment or none at all.
+        """
+        environment_dir = self.get_environment(key)
+        if environment_dir:
+            return environment_dir
+
+        utils.makedirs(self._environments_dir)
+        temp_dir = tempfile.mkdtemp(prefix=_TEMP_PREFIX, dir=self._environments_dir)
+        temp_environment_dir = os.path.join(temp_dir, key)
+        try:
+            shutil.copytree(source_dir, temp_environment_dir, symlinks=True)
+            # copytree copies the modification time of the source, by which garbage collection
+            # tells how long ago the environment was added
+            os.utime(temp_environment_dir, None)
+            _set_read_only(temp_environment_dir)
+            environment_dir = os.path.join(self._environments_dir, key)
+            try:
+                os.rename(temp_environment_dir, environment_dir)
+            except OSError:
+                # Another process published the same environment first
+                if not os.path.isdir(environment_dir):
+                    raise
+        finally:
+            _remove_tree(temp_dir)
+        return environment_dir
+
+    def add_plugin(self, plugin, installed_dir):
+        """
+        Caches the environment a plugin is installed in, hashing it only once per installation of
+        the plugin.
+
+        :return: key of the environment
+        """
+        key = self.plugin_key(plugin, installed_dir)
+        if key is None or not self.get_environment(key):
+            key = environment_key(installed_dir)
+            self.add_environment(key, installed_dir)
+            utils.makedirs(self._installations_dir)
+            path = self._installation_path(plugin, installed_dir)
+            temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump({'installed_dir': installed_dir, 'key': key}, f)
+            utils.replace_file(temp_path, path)
+        return key
+
+    def plugin_key(self, plugin, installed_dir):
+        """
+        Returns the key of the environment of a plugin installation, if it was cached.
+        """
+        try:
+            with open(self._installation_path(plugin, installed_dir)) as f:
+                return json.load(f)['key']
+        except (IOError, ValueError):
+            return None
+
+    def add_reference(self, key, workdir):
+        """
+        Records that the plugin workdir of a service uses the cached environment, which is kept
+        for as long as the workdir exists.
+        """
+        with self._lock():
+            environment_dir = self.get_environment(key)
+            if not environment_dir:
+                raise ValueError(u'Plugin environment {0} is not cached'.format(key))
+            # Garbage collection keeps environments used recently, even once unreferenced
+            os.utime(environment_dir, None)
+            references_dir = os.path.join(self._references_dir, key)
+            utils.makedirs(references_dir)
+            workdir = os.path.abspath(workdir)
+            reference = os.path.join(
+                references_dir, hashlib.sha1(workdir.encode('utf-8')).hexdigest())
+            if not os.path.exists(reference):
+                with open(reference, 'wb') as f:
+                    f.write(workdir.encode('utf-8'))
+
+    def collect_garbage(self, min_age=0, dry_run=False):
+        """
+        Removes the environments which are no longer referenced by any existing workdir.
+
+        :param min_age: environments added or referenced less than that many seconds ago are kept,
+         as they might be about to be referenced
+        :param dry_run: only return what would have been removed
+        :return: keys of the removed environments
+        """
+        removed = []
+        with self._lock():
+            now = time.time()
+            for key in self.environments():
+                environment_dir = os.path.join(self._environments_dir, key)
+                if self._live_references(key, prune=not dry_run):
+                    continue
+                if now - os.path.getmtime(environment_dir) < min_age:
+                    continue
+                removed.append(key)
+                if not dry_run:
+                    _remove_tree(environment_dir)
+                    _remove_tree(os.path.join(self._references_dir, key))
+
+            if removed and not dry_run and os.path.isdir(self._installations_dir):
+                for name in os.listdir(self._installations_dir):
+                    path = os.path.join(self._installations_dir, name)
+                    try:
+                        with open(path) as f:
+                            if json.load(f)['key'] in removed:
+                                os.remove(path)
+                    except (IOError, OSError, ValueError):
+                        pass
+
+            # Leftovers of interrupted add_environment calls
+            if not dry_run and os.path.isdir(self._environments_dir):
+                for name in os.listdir(self._environments_dir):
+                    temp_dir = os.path.join(self._environments_dir, name)
+                    if name.startswith(_TEMP_PREFIX) and \
+                            now - os.path.getmtime(temp_dir) >= min_age:
+                        _remove_tree(temp_dir)
+        return removed
+
+    def _live_references(self, key, prune):
+        references_dir = os.path.join(self._references_dir, key)
+        if not os.path.isdir(references_dir):
+            return []
+        live = []
+        for name in os.listdir(references_dir):
+            reference = os.path.join(references_dir, name)
+            with open(reference, 'rb') as f:
+                workdir = f.read().decode('utf-8')
+            if os.path.isdir(workdir):
+                live.append(workdir)
+            elif prune:
+                os.remove(reference)
+        return live
+
+    def _installation_path(self, plugin, installed_dir):
+        # A plugin reinstalled into the same directory is another installation
+        installation = u'{0}\0{1}'.format(os.path.abspath(installed_dir), plugin.uploaded_at)
+        return os.path.join(self._installations_dir,
+                            hashlib.sha1(installation.encode('utf-8')).hexdigest())
+
+    def _lock(self):
+        utils.makedirs(self._cache_dir)
+        return utils.file_lock(os.path.join(self._cache_dir, _LOCK_FILE))
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _set_read_only(path):
+    _chmod_tree(path, ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH), 0)
+
+
+def _set_writable(path):
+    _chmod_tree(path, ~0, stat.S_IWUSR)
+
+
+def _chmod_tree(path, mask, flags):
+    def chmod(p):
+        if not os.path.islink(p):
+            os.chmod(p, (stat.S_IMODE(os.stat(p).st_mode) & mask) | flags)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                chmod(os.path.join(root, name))
+    chmod(path)
+
+
+def _remove_tree(path):
+    if not os.path.lexists(path):
+        return
+    _set_writable(path)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='aria-plugin-cache',
+        description='Manage the shared plugin environment cache of the ARIA Cloudify extension.')
+    parser.add_argument('--cache-dir', default=os.environ.get(CACHE_DIR_ENV_VAR),
+                        help='cache directory (defaults to ${0})'.format(CACHE_DIR_ENV_VAR))
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='list the cached environments')
+    gc_parser = commands.add_parser('gc', help='remove environments no service uses')
+    gc_parser.add_argument('--min-age', type=float, default=3600,
+                           help='keep environments added or used less than this many seconds '
+                                'ago '
+                                '(default: %(default)s)')
+    gc_parser.add_argument('--dry-run', action='store_true',
+                           help='only print what would be removed')
+    args = parser.parse_args(args)
+
+    if not args.cache_dir:
+        parser.error('no cache directory given, and ${0} is not set'.format(CACHE_DIR_ENV_VAR))
+    cache = PluginEnvironmentCache(args.cache_dir)
+
+    if args.command == 'list':
+        for key in cache.environments():
+            sys.stdout.write('{0}\n'.format(key))
+    elif args.command == 'gc':
+        for key in cache.collect_garbage(min_age=args.min_age, dry_run=args.dry_run):
+            sys.stdout.write('{0}{1}\n'.format('would remove ' if args.dry_run else 'removed ',
+                                               key))
+    else:
+        parser.error('a command is required')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Rate limiting of cloud API calls, shared by all the operation processes on a host.
+
+Limits are read from the JSON file named by the ``ARIA_CLOUDIFY_RATE_LIMITS`` environment
+variable, e.g.::
+
+    {
+        "limits": [
+            {"family": "ec2", "functions": ["cloudify_aws.ec2.*"], "rate": 5, "burst": 10},
+            {"family": "ec2", "region": "us-east-1", "functions": ["cloudify_aws.ec2.*"],
+             "rate": 20, "burst": 40}
+        ]
+    }
+
+An operation whose function matches a limit takes a token (``cost`` tokens, if set) from the token
+bucket of the limit's API family and of the region the operation works in, before the plugin
+function is called. The region is read from the operation inputs, or from the properties of the
+node, at the first of the ``region_keys`` found (see :data:`DEFAULT_REGION_KEYS`); limits with no
+``region`` apply to any region, each region still having its own bucket.
+
+Each bucket is a small file under the ``state_dir`` of the configuration (a directory under the
+system temporary directory by default), updated under an exclusive file lock. When an operation is
+throttled nonetheless (its retry message matches one of the ``throttling_errors``), the bucket is
+emptied and stops refilling for ``throttle_backoff`` seconds, so that all the processes back off
+together instead of retrying into the limit.
+"""
+
+import os
+import json
+import time
+import fnmatch
+import tempfile
+
+from . import utils
+
+
+RATE_LIMITS_ENV_VAR = 'ARIA_CLOUDIFY_RATE_LIMITS'
+
+DEFAULT_REGION_KEYS = (
+    'aws_config.ec2_region_name',
+    'aws_config.region_name',
+    'openstack_config.region',
+    'region',
+)
+DEFAULT_THROTTLING_ERRORS = (
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'Rate exceeded',
+    'TooManyRequests',
+    'OverLimit',
+)
+DEFAULT_THROTTLE_BACKOFF = 5
+ANY_REGION = '*'
+
+
+def from_environment(env=None):
+    """
+    Returns the rate limiter configured through ``ARIA_CLOUDIFY_RATE_LIMITS``, or ``None``.
+    """
+    path = (os.environ if env is None else env).get(RATE_LIMITS_ENV_VAR)
+    return RateLimiter.from_file(path) if path else None
+
+
+def limit_operation(ctx, operation_inputs, env=None):
+    """
+    Returns the bucket limiting the operation, or ``None`` if it isn't rate limited.
+    """
+    rate_limiter = from_environment(env)
+    if rate_limiter is None:
+        return None
+    return rate_limiter.get_bucket(ctx.task.function, operation_inputs,
+                                   utils.node_properties(ctx))
+
+
+class RateLimiter(object):
+
+    def __init__(self, limits, state_dir=None, region_keys=DEFAULT_REGION_KEYS,
+                 throttling_errors=DEFAULT_THROTTLING_ERRORS,
+                 throttle_backoff=DEFAULT_THROTTLE_BACKOFF):
+        self._limits = [dict(limit) for limit in limits]
+        for limit in self._limits:
+            if not limit.get('family') or not limit.get('rate'):
+                raise ValueError(u'A rate limit must have a "family" and a "rate": {0}'.format(
+                    limit))
+        self._state_dir = state_dir or os.path.join(tempfile.gettempdir(),
+                                                    'aria-cloudify-rate-limits')
+        self._region_keys = region_keys
+        self._throttling_errors = throttling_errors
+        self._throttle_backoff = throttle_backoff
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        return cls(limits=config.get('limits', []),
+                   state_dir=config.get('state_dir'),
+                   region_keys=config.get('region_keys', DEFAULT_REGION_KEYS),
+                   throttling_errors=config.get('throttling_errors', DEFAULT_THROTTLING_ERRORS),
+                   throttle_backoff=config.get('throttle_backoff', DEFAULT_THROTTLE_BACKOFF))
+
+    def get_bucket(self, function, inputs=None, properties=None):
+        """
+        Returns the bucket of the first limit matching the function and its region (a limit for
+        the specific region comes before one for any region), or ``None``.
+        """
+        region = self._region(inputs or {}, properties or {})
+        matching = [limit for limit in self._limits
+                    if any(fnmatch.fnmatchcase(function or '', pattern)
+                           for pattern in limit.get('functions', ['*']))
+                    and limit.get('region', ANY_REGION) in (region, ANY_REGION)]
+        if not matching:
+            return None
+        limit = sorted(matching, key=lambda l: l.get('region', ANY_REGION) == ANY_REGION)[0]
+        return TokenBucket(
+            path=os.path.join(self._state_dir, _bucket_file_name(limit['family'], region)),
+            rate=float(limit['rate']),
+            burst=float(limit.get('burst', limit['rate'])),
+            cost=float(limit.get('cost', 1)),
+            throttling_errors=self._throttling_errors,
+            throttle_backoff=self._throttle_backoff)
+
+    def _region(self, inputs, properties):
+        for source in (inputs, properties):
+            for key in self._region_keys:
+                value = utils.get_path(source, key)
+                if isinstance(value, basestring) and value:
+                    return value
+        return ANY_REGION
+
+
+class TokenBucket(object):
+    """
+    Token bucket whose state is kept in a file, and is shared by all processes using that file.
+    """
+
+    def __init__(self, path, rate, burst, cost=1, throttling_errors=DEFAULT_THROTTLING_ERRORS,
+                 throttle_backoff=DEFAULT_THROTTLE_BACKOFF):
+        self._path = path
+        self._rate = rate
+        self._burst = max(burst, cost)
+        self._cost = cost
+        self._throttling_errors = throttling_errors
+        self._throttle_backoff = throttle_backoff
+
+    @property
+    def path(self):
+        return self._path
+
+    def acquire(self):
+        """
+        Waits until the tokens of one call are available, and takes them.
+
+        :return: time waited, in seconds
+        """
+        start = time.time()
+        while True:
+            with self._state() as state:
+                now = time.time()
+                self._refill(state, now)
+                if state['tokens'] >= self._cost:
+                    state['tokens'] -= self._cost
+                    return time.time() - start
+                wait = max(state['updated'] - now, 0) + \
+                    (self._cost - state['tokens']) / self._rate
+            time.sleep(wait)
+
+    def throttled(self, message):
+        """
+        Empties the bucket if ``message`` is that of a throttling error.
+
+        :return: whether it was a throttling error
+        """
+        if not any(error in (message or '') for error in self._throttling_errors):
+            return False
+        with self._state() as state:
+            state['tokens'] = 0
+            state['updated'] = max(state['updated'], time.time() + self._throttle_backoff)
+        return True
+
+    def _refill(self, state, now):
+        # "updated" is in the future while backing off from throttling
+        if now > state['updated']:
+            state['tokens'] = min(self._burst,
+                                  state['tokens'] + (now - state['updated']) * self._rate)
+            state['updated'] = now
+
+    def _state(self):
+        return utils.LockedJSONState(self._path,
+                                     default={'tokens': self._burst, 'updated': time.time()})
+
+
+def _bucket_file_name(family, region):
+    return u'{0}@{1}.bucket'.format(family, region).replace(os.sep, '_')
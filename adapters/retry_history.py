@@ -0,0 +1,269 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Retry intervals learned from the history of past operations.
+
+When the ``ARIA_CLOUDIFY_RETRY_HISTORY`` environment variable names an SQLite database file, the
+number of attempts and the wall time (from the start of the first attempt) each Cloudify-based
+operation took to succeed are recorded there, per operation function and per region and flavor of
+the resource it works on.
+
+From these, the retry interval of an operation which is still polling is suggested as the time left
+until the next of the 50th, 75th, 90th and 100th percentiles of its past durations, so that it polls
+around the time past operations completed. Plugins may ask for the suggestion with
+``ctx.operation.suggested_retry_after(default)``; when ``ARIA_CLOUDIFY_ADAPTIVE_RETRY`` is set to
+``override``, the suggestion replaces the ``retry_after`` of every retry.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from aria.orchestrator import exceptions
+
+from . import (rate_limiting, utils)
+
+
+RETRY_HISTORY_ENV_VAR = 'ARIA_CLOUDIFY_RETRY_HISTORY'
+ADAPTIVE_RETRY_ENV_VAR = 'ARIA_CLOUDIFY_ADAPTIVE_RETRY'
+OVERRIDE = 'override'
+
+REGION_KEYS = rate_limiting.DEFAULT_REGION_KEYS
+FLAVOR_KEYS = (
+    'instance_type',
+    'flavor',
+    'server.flavor',
+    'server.flavor_name',
+)
+ANY = '*'
+
+MIN_SAMPLES = 3
+MAX_SAMPLES = 100
+MIN_RETRY_INTERVAL = 1
+PERCENTILES = (0.5, 0.75, 0.9, 1.0)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS attempts (
+    task_id TEXT PRIMARY KEY,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    operation TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_key ON samples (operation, dimension, recorded);
+"""
+
+
+def from_environment(env=None):
+    """
+    Returns the retry history configured through ``ARIA_CLOUDIFY_RETRY_HISTORY``, or ``None``.
+    """
+    path = (os.environ if env is None else env).get(RETRY_HISTORY_ENV_VAR)
+    return RetryHistory(path) if path else None
+
+
+def operation_history(ctx, operation_inputs, env=None):
+    """
+    Returns the history of the operation, or ``None`` if no history is kept.
+    """
+    env = os.environ if env is None else env
+    history = from_environment(env)
+    if history is None:
+        return None
+    return OperationHistory(history,
+                            task=ctx.task,
+                            dimension=dimension(operation_inputs, utils.node_properties(ctx)),
+                            override=env.get(ADAPTIVE_RETRY_ENV_VAR) == OVERRIDE,
+                            key=attempt_key(ctx.model, ctx.task))
+
+
+def attempt_key(model, task):
+    """
+    Returns the key of the attempts of a task, unique across the model storages sharing the
+    history.
+    """
+    return u'{0}:{1}:{2}'.format(utils.model_storage_id(model), task.execution.id, task.id)
+
+
+@contextmanager
+def attempt(history):
+    """
+    Records an attempt of the operation run within, and its outcome, if a history is kept.
+
+    The attempts are forgotten once the operation ends, unless it is retried, as the duration is
+    measured from the start of the first attempt.
+
+    :param history: :class:`OperationHistory`, or ``None``
+    """
+    if history is None:
+        yield
+        return
+    history.attempt_started()
+    try:
+        yield
+    except exceptions.TaskRetryException:
+        raise
+    except BaseException:
+        history.ended()
+        raise
+    history.succeeded()
+    history.ended()
+
+
+def dimension(inputs, properties):
+    """
+    Returns the region and flavor of the resource an operation works on, as ``<region>/<flavor>``
+    (``*`` for either, if unknown).
+    """
+    def find(keys):
+        for source in (inputs or {}, properties or {}):
+            for key in keys:
+                value = utils.get_path(source, key)
+                if isinstance(value, basestring) and value:
+                    return value
+        return ANY
+    return u'{0}/{1}'.format(find(REGION_KEYS), find(FLAVOR_KEYS))
+
+
+class RetryHistory(object):
+    """
+    History of operation attempts, kept in an SQLite database shared by all operation processes.
+    """
+
+    def __init__(self, path, min_samples=MIN_SAMPLES):
+        self._path = path
+        self._min_samples = min_samples
+        utils.create_sqlite_schema(path, _SCHEMA)
+
+    def attempt_started(self, task_id, now=None):
+        """
+        Records the start of an attempt of the task, unless an earlier attempt was recorded.
+        """
+        with self._connect() as connection:
+            connection.execute('INSERT OR IGNORE INTO attempts (task_id, started) VALUES (?, ?)',
+                               (str(task_id), now or time.time()))
+
+    def elapsed(self, task_id, now=None):
+        """
+        Returns the time since the first attempt of the task started, or ``None``.
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT started FROM attempts WHERE task_id = ?',
+                                     (str(task_id),)).fetchone()
+        return (now or time.time()) - row[0] if row else None
+
+    def succeeded(self, task_id, operation, dimension, attempts, now=None):
+        """
+        Records the attempts and the time the task took to succeed, as a sample of the operation.
+        """
+        now = now or time.time()
+        duration = self.elapsed(task_id, now)
+        if duration is None:
+            return
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT INTO samples (operation, dimension, attempts, duration, recorded) '
+                'VALUES (?, ?, ?, ?, ?)', (operation, dimension, attempts, duration, now))
+
+    def ended(self, task_id):
+        """
+        Forgets the attempts of the task, once it won't be retried, whatever its outcome.
+        """
+        with self._connect() as connection:
+            connection.execute('DELETE FROM attempts WHERE task_id = ?', (str(task_id),))
+
+    def statistics(self, operation, dimension):
+        """
+        Returns the number of samples of the operation, and the median attempts and duration it
+        took to succeed, or ``None`` if it has no samples.
+        """
+        samples = self._samples(operation, dimension)
+        if not samples:
+            return None
+        return {
+            'samples': len(samples),
+            'attempts': utils.percentile(sorted(attempts for attempts, _ in samples), 0.5),
+            'duration': utils.percentile(sorted(duration for _, duration in samples), 0.5),
+        }
+
+    def suggest_retry_after(self, operation, dimension, elapsed, default=None):
+        """
+        Returns the time left until the next percentile of the operation's past durations, or
+        ``default`` if there aren't enough samples, or the operation is already slower than all of
+        them.
+        """
+        durations = sorted(duration for _, duration in self._samples(operation, dimension))
+        if len(durations) < self._min_samples:
+            return default
+        for percentile in PERCENTILES:
+            duration = utils.percentile(durations, percentile)
+            if duration > elapsed:
+                return max(MIN_RETRY_INTERVAL, duration - elapsed)
+        return default
+
+    def _samples(self, operation, dimension):
+        with self._connect() as connection:
+            return connection.execute(
+                'SELECT attempts, duration FROM samples WHERE operation = ? AND dimension = ? '
+                'ORDER BY recorded DESC LIMIT ?', (operation, dimension, MAX_SAMPLES)).fetchall()
+
+    def _connect(self):
+        return utils.sqlite_transaction(self._path)
+
+
+class OperationHistory(object):
+    """
+    History of an operation, bound to its task.
+    """
+
+    def __init__(self, history, task, dimension, override=False, key=None):
+        self._history = history
+        self._task = task
+        self._key = task.id if key is None else key
+        self._dimension = dimension
+        self._override = override
+
+    @property
+    def dimension(self):
+        return self._dimension
+
+    def attempt_started(self):
+        self._history.attempt_started(self._key)
+
+    def succeeded(self):
+        self._history.succeeded(self._key, self._task.function, self._dimension,
+                                self._task.attempts_count)
+
+    def ended(self):
+        self._history.ended(self._key)
+
+    def suggested_retry_after(self, default=None):
+        elapsed = self._history.elapsed(self._key)
+        if elapsed is None:
+            return default
+        return self._history.suggest_retry_after(self._task.function, self._dimension, elapsed,
+                                                 default)
+
+    def retry_after(self, retry_after):
+        """
+        Returns the retry interval to use instead of the plugin's ``retry_after``.
+        """
+        return self.suggested_retry_after(retry_after) if self._override else retry_after
@@ -0,0 +1,260 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Index of nodes by the values of some of their runtime properties.
+
+When the ``ARIA_CLOUDIFY_RUNTIME_INDEX`` environment variable names an SQLite database file, the
+runtime properties listed in ``ARIA_CLOUDIFY_RUNTIME_INDEX_KEYS`` (comma-separated, by default
+:data:`DEFAULT_KEYS`) of the nodes of Cloudify-based operations are indexed there, whenever a
+plugin calls ``ctx.instance.update()`` and when an operation ends. Nodes can then be found by the
+value of an indexed runtime property (e.g. the node whose ``aws_resource_id`` is ``i-1234``) with
+``ctx.get_node_instances_by_runtime_property(key, value)``, without loading every node of the
+service.
+
+Only scalar values (strings, numbers and booleans) are indexed. Hits are checked against the
+model, as runtime properties may have been changed by operations which don't update the index, and
+nodes removed (see :func:`find_nodes`). Runtime properties set while the index wasn't enabled are
+indexed by :func:`rebuild`, and the rows of removed nodes are removed by :func:`prune`, both of
+which ``aria-cloudify-runtime-index`` runs.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from aria.modeling import models
+from aria.storage import exceptions as storage_exceptions
+
+from . import utils
+
+
+RUNTIME_INDEX_ENV_VAR = 'ARIA_CLOUDIFY_RUNTIME_INDEX'
+RUNTIME_INDEX_KEYS_ENV_VAR = 'ARIA_CLOUDIFY_RUNTIME_INDEX_KEYS'
+DEFAULT_KEYS = ('aws_resource_id', 'external_id')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runtime_properties (
+    service_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    PRIMARY KEY (service_id, key, value, node_id)
+);
+CREATE INDEX IF NOT EXISTS runtime_properties_node ON runtime_properties (node_id);
+"""
+
+
+def from_environment(env=None):
+    """
+    Returns the index configured through ``ARIA_CLOUDIFY_RUNTIME_INDEX``, or ``None``.
+    """
+    env = os.environ if env is None else env
+    path = env.get(RUNTIME_INDEX_ENV_VAR)
+    if not path:
+        return None
+    keys = env.get(RUNTIME_INDEX_KEYS_ENV_VAR)
+    return RuntimePropertiesIndex(
+        path, keys=[key.strip() for key in keys.split(',') if key.strip()] if keys
+        else DEFAULT_KEYS)
+
+
+def index_nodes(service_id, nodes, env=None):
+    """
+    Indexes the runtime properties of nodes, if the index is enabled.
+    """
+    index = from_environment(env)
+    if index is not None:
+        for node in nodes:
+            index.update(service_id, node.id, node.attributes)
+
+
+def find_nodes(index, model, service_id, key, value):
+    """
+    Returns the nodes of the service whose runtime property ``key`` is ``value``, as found in the
+    index.
+
+    Hits of nodes which were removed from the model or deleted, or whose runtime property no
+    longer has the value, are skipped, and the nodes indexed again.
+    """
+    nodes = []
+    for node_id in index.lookup(service_id, key, value):
+        try:
+            node = model.node.get(node_id)
+        except storage_exceptions.NotFoundError:
+            index.remove(node_id)
+            continue
+        if node.state == node.DELETED:
+            index.remove(node_id)
+        elif key in node.attributes and \
+                getattr(node.attributes[key], 'value', node.attributes[key]) == value:
+            nodes.append(node)
+        else:
+            index.update(service_id, node.id, node.attributes)
+    return nodes
+
+
+def rebuild(model, service, env=None):
+    """
+    Indexes the runtime properties of all nodes of the service, which weren't deleted.
+    """
+    index = from_environment(env)
+    if index is None:
+        return
+    index.clear(service.id)
+    for node in service.nodes.itervalues():
+        if node.state != node.DELETED:
+            index.update(service.id, node.id, node.attributes)
+
+
+def prune(model, env=None):
+    """
+    Removes the rows of the nodes which were removed from the model or deleted.
+
+    :return: IDs of the nodes whose rows were removed
+    """
+    index = from_environment(env)
+    if index is None:
+        return []
+    removed = []
+    for node_id in index.node_ids():
+        try:
+            deleted = model.node.get(node_id).state == models.Node.DELETED
+        except storage_exceptions.NotFoundError:
+            deleted = True
+        if deleted:
+            index.remove(node_id)
+            removed.append(node_id)
+    return removed
+
+
+class RuntimePropertiesIndex(object):
+
+    def __init__(self, path, keys=DEFAULT_KEYS):
+        self._path = path
+        self._keys = tuple(keys)
+        utils.create_sqlite_schema(path, _SCHEMA)
+
+    @property
+    def keys(self):
+        return self._keys
+
+    def update(self, service_id, node_id, runtime_properties):
+        """
+        Replaces the indexed values of the node with those of its runtime properties.
+
+        :param runtime_properties: dict of values, or of attribute models
+        """
+        rows = []
+        for key in self._keys:
+            if key in runtime_properties:
+                value = _encode(runtime_properties[key])
+                if value is not None:
+                    rows.append((str(service_id), key, value, str(node_id)))
+        with self._connect() as connection:
+            connection.execute('DELETE FROM runtime_properties WHERE node_id = ?',
+                               (str(node_id),))
+            connection.executemany('INSERT OR IGNORE INTO runtime_properties '
+                                   '(service_id, key, value, node_id) VALUES (?, ?, ?, ?)', rows)
+
+    def lookup(self, service_id, key, value):
+        """
+        Returns the IDs of the nodes of the service whose runtime property ``key`` is ``value``.
+
+        :raises ValueError: if ``key`` isn't indexed
+        """
+        if key not in self._keys:
+            raise ValueError(u'Runtime property "{0}" is not indexed (indexed: {1})'.format(
+                key, u', '.join(self._keys)))
+        value = _encode(value)
+        if value is None:
+            return []
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT node_id FROM runtime_properties '
+                'WHERE service_id = ? AND key = ? AND value = ? ORDER BY node_id',
+                (str(service_id), key, value)).fetchall()
+        return [_decode_node_id(node_id) for node_id, in rows]
+
+    def node_ids(self):
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT DISTINCT node_id FROM runtime_properties ORDER BY node_id').fetchall()
+        return [_decode_node_id(node_id) for node_id, in rows]
+
+    def remove(self, node_id):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM runtime_properties WHERE node_id = ?',
+                               (str(node_id),))
+
+    def clear(self, service_id):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM runtime_properties WHERE service_id = ?',
+                               (str(service_id),))
+
+    def _connect(self):
+        return utils.sqlite_transaction(self._path)
+
+
+def _encode(value):
+    # Attribute models outside of instrumentation, raw values within it
+    value = getattr(value, 'value', value)
+    if isinstance(value, (basestring, bool, int, long, float)):
+        return json.dumps(value)
+    return None
+
+
+def _decode_node_id(node_id):
+    return int(node_id) if node_id.isdigit() else node_id
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='aria-cloudify-runtime-index',
+        description='Maintain the runtime properties index of the ARIA Cloudify extension '
+                    '(${0}).'.format(RUNTIME_INDEX_ENV_VAR))
+    commands = parser.add_subparsers(dest='command')
+    rebuild_parser = commands.add_parser(
+        'rebuild', help='index the runtime properties of the nodes of services again')
+    rebuild_parser.add_argument('services', nargs='*', metavar='service',
+                                help='names of the services (all of them by default)')
+    commands.add_parser('prune', help='remove the nodes which were removed or deleted')
+    args = parser.parse_args(args)
+
+    if not from_environment():
+        parser.error('${0} is not set'.format(RUNTIME_INDEX_ENV_VAR))
+
+    import aria
+    from aria.cli.env import env
+    aria.install_aria_extensions()
+    model = env.model_storage
+    if args.command == 'rebuild':
+        services = [model.service.get_by_name(name) for name in args.services] if args.services \
+            else model.service.list()
+        for service in services:
+            rebuild(model, service)
+            sys.stdout.write(u'Rebuilt the index of service {0}\n'.format(service.name))
+    elif args.command == 'prune':
+        removed = prune(model)
+        sys.stdout.write('Removed {0} nodes from the index\n'.format(len(removed)))
+    else:
+        parser.error('a command is required')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Fair sharing of the operation workers of a host between executions and tenants.
+
+Every execution is run by an orchestrator process of its own, so the workers of the host are
+shared through a state file, updated under an exclusive file lock. When the
+``ARIA_CLOUDIFY_SCHEDULER`` environment variable names a JSON configuration file, e.g.::
+
+    {
+        "max_workers": 16,
+        "max_workers_per_execution": 8,
+        "default_tenant": {"weight": 1, "max_workers": 12},
+        "tenants": {"small-deployments": {"weight": 4}}
+    }
+
+sending a task blocks until a worker is free for it (and until it has a slot within the
+concurrency limit of its execution, see :mod:`adapters.concurrency`, both being waited for
+together), or until the execution is cancelled. At most ``max_workers`` tasks run on the host,
+at most ``max_workers_per_execution`` for each execution, and at most the ``max_workers`` of its
+tenant for each tenant (all optional). Waiting tasks are served in weighted fair queuing order:
+tenants share the workers in proportion to their weights, and the executions of a tenant share its
+part equally, so the tasks of a small execution don't wait behind all those of a large one, while
+the large one still uses the workers no one else waits for.
+
+The tenant of an execution is the ``ARIA_CLOUDIFY_TENANT`` environment variable of its orchestrator
+process, or else the name of its service.
+"""
+
+import os
+import json
+import time
+import tempfile
+
+from . import (concurrency, utils)
+
+
+SCHEDULER_ENV_VAR = 'ARIA_CLOUDIFY_SCHEDULER'
+TENANT_ENV_VAR = 'ARIA_CLOUDIFY_TENANT'
+
+DEFAULT_POLL_INTERVAL = 0.1
+
+_scheduler = None
+
+
+def get_scheduler(env=None):
+    """
+    Returns the scheduler configured through ``ARIA_CLOUDIFY_SCHEDULER``, or ``None``.
+    """
+    global _scheduler
+    path = (os.environ if env is None else env).get(SCHEDULER_ENV_VAR)
+    if not path:
+        return None
+    if _scheduler is None or _scheduler.config_path != path:
+        _scheduler = FairShareScheduler.from_file(path)
+    return _scheduler
+
+
+def task_sent(task, cancelled=None, env=None):
+    """
+    Waits until the task may run: until it has a slot within the concurrency limit of its
+    execution, and a worker of the scheduler, if either is set.
+
+    :param cancelled: function returning whether the execution was cancelled, checked every
+     :data:`~adapters.concurrency.CANCEL_CHECK_INTERVAL` seconds, in which case the task is let
+     through without waiting any further
+    """
+    limit = concurrency.get_limit(task.execution.id)
+    scheduler = get_scheduler(env)
+    if limit is None and scheduler is None:
+        return
+    slot = _slot(task)
+    execution = _execution(task.execution.id)
+    tenant = _tenant(task, env)
+    poll_interval = scheduler.poll_interval if scheduler is not None \
+        else concurrency.CANCEL_CHECK_INTERVAL
+    has_slot = limit is None
+    checked = None
+    while True:
+        has_slot = has_slot or limit.try_acquire(task.id)
+        if has_slot and (scheduler is None or scheduler.try_acquire(slot, execution, tenant)):
+            return
+        if cancelled is not None and \
+                (checked is None or time.time() - checked >= concurrency.CANCEL_CHECK_INTERVAL):
+            if cancelled():
+                if scheduler is not None:
+                    scheduler.release(slot)
+                return
+            checked = time.time()
+        if has_slot:
+            time.sleep(poll_interval)
+        else:
+            limit.wait(poll_interval)
+
+
+def task_ended(task, env=None):
+    scheduler = get_scheduler(env)
+    if scheduler is not None:
+        scheduler.release(_slot(task))
+
+
+def execution_limit(execution, env=None):
+    """
+    Returns the most tasks of the execution the scheduler lets run at the same time, or ``None``.
+    """
+    scheduler = get_scheduler(env)
+    if scheduler is not None:
+        return scheduler.max_running(_execution_tenant(execution, env))
+
+
+def execution_ended(execution_id, env=None):
+    scheduler = get_scheduler(env)
+    if scheduler is not None:
+        scheduler.release_execution(_execution(execution_id))
+
+
+class FairShareScheduler(object):
+    """
+    Weighted fair queuing of tasks, with quotas, over a state file shared by processes.
+
+    :param state_file: path of the shared state file
+    :param max_workers: maximum number of tasks running at the same time, or ``None``
+    :param max_workers_per_execution: maximum for each execution, or ``None``
+    :param tenants: dict of the ``weight`` and ``max_workers`` of tenants, by name
+    :param default_tenant: ``weight`` and ``max_workers`` of tenants not in ``tenants``
+    """
+
+    def __init__(self, state_file=None, max_workers=None, max_workers_per_execution=None,
+                 tenants=None, default_tenant=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self._state_file = state_file or os.path.join(tempfile.gettempdir(),
+                                                      'aria-cloudify-scheduler.json')
+        self._max_workers = max_workers
+        self._max_workers_per_execution = max_workers_per_execution
+        self._tenants = tenants or {}
+        self._default_tenant = default_tenant or {}
+        self.poll_interval = poll_interval
+        self.config_path = None
+        for tenant in [self._default_tenant] + self._tenants.values():
+            if tenant.get('weight', 1) <= 0:
+                raise ValueError(u'A tenant weight must be positive: {0}'.format(tenant))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        scheduler = cls(state_file=config.get('state_file'),
+                        max_workers=config.get('max_workers'),
+                        max_workers_per_execution=config.get('max_workers_per_execution'),
+                        tenants=config.get('tenants'),
+                        default_tenant=config.get('default_tenant'),
+                        poll_interval=config.get('poll_interval', DEFAULT_POLL_INTERVAL))
+        scheduler.config_path = path
+        return scheduler
+
+    def acquire(self, slot, execution, tenant):
+        """
+        Waits until the task may run.
+
+        :param slot: ID of the task, unique on the host
+        :return: time waited, in seconds
+        """
+        start = time.time()
+        while not self.try_acquire(slot, execution, tenant):
+            time.sleep(self.poll_interval)
+        return time.time() - start
+
+    def try_acquire(self, slot, execution, tenant):
+        """
+        Queues the task, unless it's already queued, and takes a worker for it if it's its turn.
+
+        :return: whether the task may run (also when it was dequeued by
+         :meth:`release_execution`)
+        """
+        with self._state() as state:
+            _purge_dead_processes(state)
+            if slot in state['running']:
+                return True
+            waiting = state['waiting']
+            if slot not in waiting:
+                if slot in state['queued']:
+                    # Dequeued, since its execution ended
+                    del state['queued'][slot]
+                    return True
+                self._enqueue(state, slot, execution, tenant)
+            if self._next(state) != slot:
+                return False
+            entry = waiting.pop(slot)
+            del state['queued'][slot]
+            state['virtual_time'] = max(state['virtual_time'], entry['start'])
+            state['running'][slot] = {'execution': execution, 'tenant': tenant,
+                                      'pid': entry['pid']}
+            return True
+
+    def release(self, slot):
+        """
+        Releases the worker of the task, or dequeues it if it's still waiting for one.
+        """
+        with self._state() as state:
+            state['running'].pop(slot, None)
+            state['waiting'].pop(slot, None)
+            state['queued'].pop(slot, None)
+            _forget_idle_flows(state)
+
+    def release_execution(self, execution):
+        """
+        Releases the workers of all tasks of the execution, and lets its waiting tasks through.
+        """
+        with self._state() as state:
+            for entries in (state['running'], state['waiting']):
+                for slot, entry in entries.items():
+                    if entry['execution'] == execution:
+                        del entries[slot]
+            _forget_idle_flows(state)
+
+    def max_running(self, tenant):
+        """
+        Returns the most tasks an execution of the tenant may run at the same time, or ``None``.
+        """
+        limits = [limit for limit in (self._max_workers, self._max_workers_per_execution,
+                                      self._tenant_config(tenant).get('max_workers')) if limit]
+        return min(limits) if limits else None
+
+    def running(self):
+        """
+        Returns the running tasks, by slot.
+        """
+        with self._state() as state:
+            _purge_dead_processes(state)
+            return dict(state['running'])
+
+    def _enqueue(self, state, slot, execution, tenant):
+        # Start and finish tags of weighted fair queuing, where each execution is a flow, and the
+        # weight of a tenant is shared by its active executions
+        executions = set([execution])
+        for entries in (state['running'], state['waiting']):
+            executions.update(entry['execution'] for entry in entries.itervalues()
+                              if entry['tenant'] == tenant)
+        weight = float(self._tenant_config(tenant).get('weight', 1)) / len(executions)
+        start = max(state['virtual_time'], state['flows'].get(execution, 0))
+        finish = start + 1 / weight
+        state['flows'][execution] = finish
+        state['sequence'] += 1
+        state['waiting'][slot] = {'execution': execution, 'tenant': tenant, 'pid': os.getpid(),
+                                  'start': start, 'finish': finish,
+                                  'sequence': state['sequence']}
+        state['queued'][slot] = os.getpid()
+
+    def _next(self, state):
+        running = state['running'].values()
+        if self._max_workers and len(running) >= self._max_workers:
+            return None
+        candidates = []
+        for slot, entry in state['waiting'].iteritems():
+            execution_limit = self._max_workers_per_execution
+            if execution_limit and sum(1 for r in running
+                                       if r['execution'] == entry['execution']) >= execution_limit:
+                continue
+            tenant_limit = self._tenant_config(entry['tenant']).get('max_workers')
+            if tenant_limit and sum(1 for r in running
+                                    if r['tenant'] == entry['tenant']) >= tenant_limit:
+                continue
+            candidates.append((entry['finish'], entry['sequence'], slot))
+        return min(candidates)[2] if candidates else None
+
+    def _tenant_config(self, tenant):
+        return self._tenants.get(tenant, self._default_tenant)
+
+    def _state(self):
+        return utils.LockedJSONState(self._state_file, default={
+            'virtual_time': 0, 'sequence': 0, 'flows': {}, 'running': {}, 'waiting': {},
+            'queued': {}})
+
+
+def _purge_dead_processes(state):
+    # Tasks of orchestrator processes which died never release their workers
+    for entries in (state['running'], state['waiting']):
+        for slot, entry in entries.items():
+            if not utils.is_alive(entry['pid']):
+                del entries[slot]
+    for slot, pid in state['queued'].items():
+        if not utils.is_alive(pid):
+            del state['queued'][slot]
+    _forget_idle_flows(state)
+
+
+def _forget_idle_flows(state):
+    active = set(entry['execution'] for entries in (state['running'], state['waiting'])
+                 for entry in entries.itervalues())
+    for execution in state['flows'].keys():
+        if execution not in active:
+            del state['flows'][execution]
+
+
+def _execution(execution_id):
+    # Orchestrator processes may use different model storages, with the same execution IDs
+    return '{0}:{1}'.format(os.getpid(), execution_id)
+
+
+def _slot(task):
+    return '{0}:{1}'.format(_execution(task.execution.id), task.id)
+
+
+def _tenant(task, env=None):
+    return _execution_tenant(task.execution, env)
+
+
+def _execution_tenant(execution, env=None):
+    return (os.environ if env is None else env).get(TENANT_ENV_VAR) or execution.service.name
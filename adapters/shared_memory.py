@@ -0,0 +1,182 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Passing large operation inputs and node data to operation processes through shared memory.
+
+ARIA's process executor pickles the arguments of every task into a temporary file, which the
+operation process reads back, and the operation process then loads the properties of its nodes from
+the model storage. :class:`SharedMemoryProcessExecutor` instead writes each large argument value
+(and the properties of each node) once, into a segment file under ``/dev/shm`` (or the system
+temporary directory, where there's no ``/dev/shm``), and passes the operation process a reference
+to it. Segments are content-addressed, so a payload shared by many tasks (e.g. the same cloud-init
+script for every instance of a node) is pickled and written once per execution, instead of once per
+task.
+
+This is not zero-copy: every operation process still unpickles the values it is passed into
+objects of its own (reading the segment through a memory map, rather than a file of its own). What
+is saved is pickling and writing the same payload for every task, and loading node properties from
+the model storage.
+
+Only the tasks of Cloudify-based plugins are passed references, which the executor extension
+resolves before the plugin function is called.
+"""
+
+import os
+import mmap
+import shutil
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from aria.orchestrator.workflows.executor import process
+
+from . import utils
+
+
+DEFAULT_INLINE_LIMIT = 64 * 1024
+NODE_PROPERTIES_ARGUMENT = '_cloudify_node_properties'
+
+_SHARED_MEMORY_DIR = '/dev/shm'
+
+
+class SegmentReference(object):
+    """
+    Reference to a value stored in a segment file.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return pickle.load(segment)
+            finally:
+                segment.close()
+
+    def __repr__(self):
+        return '{0}({1!r}, {2})'.format(self.__class__.__name__, self.path, self.size)
+
+
+class SegmentStore(object):
+    """
+    Content-addressed store of pickled values, each in a segment file of its own.
+    """
+
+    def __init__(self, base_dir=None):
+        if base_dir is None:
+            base_dir = _SHARED_MEMORY_DIR if os.path.isdir(_SHARED_MEMORY_DIR) \
+                else tempfile.gettempdir()
+        self._dir = tempfile.mkdtemp(prefix='aria-cloudify-segments-', dir=base_dir)
+
+    @property
+    def dir(self):
+        return self._dir
+
+    def put(self, value):
+        return self.put_serialized(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def put_serialized(self, serialized):
+        path = os.path.join(self._dir, hashlib.sha1(serialized).hexdigest())
+        if not os.path.exists(path):
+            temp_path = '{0}.{1}'.format(path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(serialized)
+            os.rename(temp_path, path)
+        return SegmentReference(path, len(serialized))
+
+    def close(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class SharedMemoryProcessExecutor(process.ProcessExecutor):
+    """
+    Process executor passing large arguments and node properties of Cloudify-based operations
+    through shared memory.
+
+    :param inline_limit: size (in bytes, pickled) from which an argument is passed by reference
+    :param segments_dir: directory in which segment files are created
+    """
+
+    def __init__(self, inline_limit=DEFAULT_INLINE_LIMIT, segments_dir=None, *args, **kwargs):
+        super(SharedMemoryProcessExecutor, self).__init__(*args, **kwargs)
+        self._inline_limit = inline_limit
+        self._segments = SegmentStore(segments_dir)
+        # Arguments and node properties don't change during an execution (retries included), so
+        # each is serialized once
+        self._argument_references = {}
+        self._node_references = {}
+
+    def close(self):
+        try:
+            super(SharedMemoryProcessExecutor, self).close()
+        finally:
+            self._segments.close()
+
+    def _create_arguments_dict(self, ctx):
+        arguments = super(SharedMemoryProcessExecutor, self)._create_arguments_dict(ctx)
+        task = ctx.task
+        if not utils.is_cloudify_dependent(task):
+            return arguments
+
+        operation_arguments = arguments['operation_arguments']
+        for argument in task.arguments.itervalues():
+            reference = self._argument_reference(argument)
+            if reference is not None:
+                operation_arguments[argument.name] = reference
+        operation_arguments[NODE_PROPERTIES_ARGUMENT] = dict(
+            (node.id, self._node_reference(node)) for node in _actor_nodes(task.actor))
+        return arguments
+
+    def _argument_reference(self, argument):
+        if argument.id not in self._argument_references:
+            serialized = pickle.dumps(argument.value, pickle.HIGHEST_PROTOCOL)
+            self._argument_references[argument.id] = \
+                self._segments.put_serialized(serialized) \
+                if len(serialized) >= self._inline_limit else None
+        return self._argument_references[argument.id]
+
+    def _node_reference(self, node):
+        if node.id not in self._node_references:
+            self._node_references[node.id] = self._segments.put(
+                dict((name, prop.value) for name, prop in node.properties.iteritems()))
+        return self._node_references[node.id]
+
+
+def resolve_arguments(operation_inputs):
+    """
+    Loads the values passed by reference to an operation process.
+
+    :return: tuple of the operation inputs, and of the properties of the nodes passed by
+     reference, by node ID
+    """
+    operation_inputs = dict(operation_inputs)
+    node_properties = dict(
+        (node_id, reference.load())
+        for node_id, reference in operation_inputs.pop(NODE_PROPERTIES_ARGUMENT, {}).iteritems())
+    for name, value in operation_inputs.iteritems():
+        if isinstance(value, SegmentReference):
+            operation_inputs[name] = value.load()
+    return operation_inputs, node_properties
+
+
+def _actor_nodes(actor):
+    if hasattr(actor, 'source_node'):
+        return [actor.source_node, actor.target_node]
+    return [actor]
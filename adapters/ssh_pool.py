@@ -0,0 +1,223 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Persistent SSH connections, shared by the operations run on the same host.
+
+Every operation runs in a process of its own, so a connection opened by one operation can't be
+handed to the next in memory. Sessions are therefore run over OpenSSH connection multiplexing: the
+first session to a host, user and key starts a master connection in the background, listening on a
+control socket of the pool, and every session with the same key (from any operation process) opens
+a channel over it, without a new handshake. A master connection closes after it has been idle for
+the idle timeout of the pool (``ARIA_CLOUDIFY_SSH_IDLE_TIMEOUT``, 300 seconds by default).
+"""
+
+import os
+import pipes
+import hashlib
+import tempfile
+import subprocess
+
+from aria.orchestrator.execution_plugin.exceptions import ProcessException
+
+from . import utils
+
+
+SSH_CONTROL_DIR_ENV_VAR = 'ARIA_CLOUDIFY_SSH_CONTROL_DIR'
+SSH_IDLE_TIMEOUT_ENV_VAR = 'ARIA_CLOUDIFY_SSH_IDLE_TIMEOUT'
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_PORT = 22
+
+_LOCK_SUFFIX = '.lock'
+
+# Same as ARIA's execution plugin, which disables known hosts and doesn't prompt
+DEFAULT_OPTIONS = {
+    'BatchMode': 'yes',
+    'StrictHostKeyChecking': 'no',
+    'UserKnownHostsFile': '/dev/null',
+    'ConnectTimeout': '10',
+    'ConnectionAttempts': '5',
+    'LogLevel': 'ERROR',
+}
+
+_pool = None
+
+
+def get_pool(env=None):
+    """
+    Returns the session pool of this process, configured by the environment.
+    """
+    global _pool
+    if _pool is None:
+        env = os.environ if env is None else env
+        _pool = SSHSessionPool(
+            control_dir=env.get(SSH_CONTROL_DIR_ENV_VAR) or None,
+            idle_timeout=int(env.get(SSH_IDLE_TIMEOUT_ENV_VAR) or DEFAULT_IDLE_TIMEOUT))
+    return _pool
+
+
+class SSHSessionPool(object):
+    """
+    Pool of SSH master connections, keyed by host, port, user and key.
+
+    :param control_dir: directory of the control sockets, shared by all the processes using the
+     pool (a directory under the system temporary directory by default)
+    :param idle_timeout: seconds after which an idle master connection is closed
+    :param ssh_command: SSH client to run
+    :param options: OpenSSH options, in addition to (or overriding) :data:`DEFAULT_OPTIONS`
+    """
+
+    def __init__(self, control_dir=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, ssh_command='ssh',
+                 options=None):
+        # Control socket paths are limited to ~100 characters, so the default directory is short
+        self._control_dir = control_dir or os.path.join(
+            tempfile.gettempdir(), 'aria-ssh-{0}'.format(os.getuid() if hasattr(os, 'getuid')
+                                                         else 0))
+        self._idle_timeout = idle_timeout
+        self._ssh_command = ssh_command
+        self._options = dict(DEFAULT_OPTIONS)
+        self._options.update(options or {})
+
+    @property
+    def control_dir(self):
+        return self._control_dir
+
+    def session(self, host, user, key_filename=None, port=DEFAULT_PORT):
+        return SSHSession(self, host, user, key_filename, port)
+
+    def close(self):
+        """
+        Closes all master connections of the pool, idle or not.
+        """
+        if not os.path.isdir(self._control_dir):
+            return
+        for name in os.listdir(self._control_dir):
+            if not name.endswith(_LOCK_SUFFIX):
+                self._control(os.path.join(self._control_dir, name), 'exit')
+
+    def _control_path(self, host, user, key_filename, port):
+        key = u'{0}@{1}:{2}:{3}'.format(user, host, port, key_filename or '')
+        return os.path.join(self._control_dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest()[:20])
+
+    def _connect(self, session):
+        """
+        Starts the master connection of the session, unless one is open.
+        """
+        utils.makedirs(self._control_dir)
+        os.chmod(self._control_dir, 0o700)
+        with utils.file_lock(session.control_path + _LOCK_SUFFIX):
+            if session.connected:
+                return
+            # The master is started on its own, rather than by the first session: forked to the
+            # background, it keeps the standard error it inherited, and reading the output of the
+            # session would wait until the master exits. Connection errors are reported by the
+            # session, which connects directly when there's no master.
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(self._ssh_args(session, master=True),
+                                stdin=devnull, stdout=devnull, stderr=devnull)
+
+    def _ssh_args(self, session, master=False):
+        options = dict(self._options)
+        options.update({
+            'ControlMaster': 'yes' if master else 'no',
+            'ControlPath': session.control_path,
+            'ControlPersist': str(self._idle_timeout),
+        })
+        args = [self._ssh_command]
+        for name, value in sorted(options.iteritems()):
+            args.extend(['-o', '{0}={1}'.format(name, value)])
+        args.extend(['-p', str(session.port), '-l', session.user])
+        if session.key_filename:
+            args.extend(['-i', os.path.expanduser(session.key_filename),
+                         '-o', 'IdentitiesOnly=yes'])
+        if master:
+            args.extend(['-N', '-f'])
+        args.append(session.host)
+        return args
+
+    def _control(self, control_path, command):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call([self._ssh_command, '-o', 'ControlPath={0}'.format(control_path),
+                                    '-O', command, 'pooled'],
+                                   stdout=devnull, stderr=devnull) == 0
+
+
+class SSHSession(object):
+    """
+    Commands run on a host, over the pool's master connection to it.
+    """
+
+    def __init__(self, pool, host, user, key_filename=None, port=DEFAULT_PORT):
+        self._pool = pool
+        self.host = host
+        self.user = user
+        self.key_filename = key_filename
+        self.port = port or DEFAULT_PORT
+        self.control_path = pool._control_path(host, user, key_filename, self.port)
+
+    @property
+    def connected(self):
+        """
+        Whether a master connection to the host is open.
+        """
+        return self._pool._control(self.control_path, 'check')
+
+    def run(self, command, env=None, cwd=None, stdin=None, warn_only=False):
+        """
+        Runs a shell command on the host.
+
+        :param env: environment variables to export to the command
+        :param cwd: directory to run the command in
+        :param stdin: data written to the standard input of the command
+        :param warn_only: whether to return the output of failed commands, instead of raising
+        :return: tuple of the exit code, standard output and standard error of the command
+        :raises ProcessException: if the command fails, and not ``warn_only``
+        """
+        remote_command = command
+        if cwd:
+            remote_command = u'cd {0} && {1}'.format(pipes.quote(cwd), remote_command)
+        if env:
+            remote_command = u'{0} {1}'.format(
+                u' '.join(u'export {0}={1};'.format(name, pipes.quote(unicode(value)))
+                          for name, value in sorted(env.iteritems())),
+                remote_command)
+        self._pool._connect(self)
+        proc = subprocess.Popen(self._pool._ssh_args(self) + [remote_command.encode('utf-8')],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate(stdin)
+        if proc.returncode != 0 and not warn_only:
+            raise ProcessException(stderr=stderr, stdout=stdout, command=command,
+                                   exit_code=proc.returncode)
+        return proc.returncode, stdout, stderr
+
+    def put(self, local_path, remote_path, mode=None):
+        """
+        Copies a local file to the host, over the same connection.
+        """
+        with open(local_path, 'rb') as f:
+            content = f.read()
+        command = u'mkdir -p $(dirname {0}) && cat > {0}'.format(pipes.quote(remote_path))
+        if mode is not None:
+            command = u'{0} && chmod {1:o} {2}'.format(command, mode, pipes.quote(remote_path))
+        self.run(command, stdin=content)
+
+    def close(self):
+        """
+        Closes the master connection to the host, instead of waiting for it to be idle.
+        """
+        return self._pool._control(self.control_path, 'exit')
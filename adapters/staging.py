@@ -0,0 +1,146 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Pre-staging of the resources referenced by Cloudify operations.
+
+Before an execution starts, the arguments of its Cloudify operations are scanned for values naming
+a file among the service (or service template) resources, such as ``scripts/configure.sh``. Each
+such resource is read from the resource storage once, and placed under the workdir of every plugin
+that references it, so that ``ctx.get_resource`` and ``ctx.download_resource`` no longer hit the
+storage on the critical path of the operation.
+
+Resources are staged anew for every execution, in a directory of its own, so an execution never
+reads copies staged before the resources were updated; the copies of earlier executions are
+removed when the next one is staged.
+"""
+
+import os
+import shutil
+
+from . import utils
+
+
+STAGED_RESOURCES_DIR = '.staged-resources'
+
+
+def stage_resources(ctx):
+    """
+    Stages the resources referenced by the Cloudify operations of the execution.
+
+    :param ctx: workflow context
+    :return: paths of the resources which were staged
+    """
+    if ctx._workdir is None:
+        # Operations of this execution have no plugin workdir to stage resources into
+        return []
+    # Same lookup order as the operation context: the service first, then its template
+    resources = [(resource_api, entry_id, _list_resources(resource_api, entry_id))
+                 for resource_api, entry_id in (
+                     (ctx.resource.service, ctx.service.id),
+                     (ctx.resource.service_template, ctx.service_template.id))]
+    referenced = {}
+    for task in ctx.execution.tasks:
+        if task._stub_type or not utils.is_cloudify_dependent(task):
+            continue
+        plugin_workdir = utils.plugin_workdir(ctx._workdir, ctx.service.id, task.plugin.name)
+        referenced.setdefault(plugin_workdir, set()).update(
+            _referenced_resource_paths(task, resources))
+
+    downloaded = {}
+    for plugin_workdir, resource_paths in referenced.iteritems():
+        _remove_staged_resources(plugin_workdir)
+        staging_dir = staged_resources_dir(plugin_workdir, ctx.execution.id)
+        for resource_path in resource_paths:
+            destination = os.path.join(staging_dir, resource_path)
+            utils.makedirs(os.path.dirname(destination))
+            if resource_path in downloaded:
+                shutil.copyfile(downloaded[resource_path], destination)
+                continue
+            for resource_api, entry_id, paths in resources:
+                if resource_path in paths:
+                    resource_api.download(entry_id=str(entry_id), destination=destination,
+                                          path=resource_path)
+                    downloaded[resource_path] = destination
+                    break
+    return sorted(downloaded)
+
+
+def staged_resources_dir(plugin_workdir, execution_id):
+    return os.path.join(plugin_workdir, STAGED_RESOURCES_DIR, str(execution_id))
+
+
+def get_staged_resource(plugin_workdir, execution_id, resource_path):
+    """
+    Returns the path of the copy of the resource staged for the execution, or ``None`` if it
+    wasn't staged.
+    """
+    if not plugin_workdir or not _is_relative_path(resource_path):
+        return None
+    staged_path = os.path.join(staged_resources_dir(plugin_workdir, execution_id), resource_path)
+    return staged_path if os.path.isfile(staged_path) else None
+
+
+def _remove_staged_resources(plugin_workdir):
+    shutil.rmtree(os.path.join(plugin_workdir, STAGED_RESOURCES_DIR), ignore_errors=True)
+
+
+def _list_resources(resource_api, entry_id):
+    """
+    Returns the relative paths of the files of a resource storage entry.
+
+    Only the file system resource storage can be listed; no resources of other storages are
+    staged.
+    """
+    base_path = getattr(resource_api, 'base_path', None)
+    if base_path is None:
+        return frozenset()
+    entry_dir = os.path.join(base_path, str(entry_id))
+    paths = set()
+    for root, _, files in os.walk(entry_dir):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), entry_dir)
+            paths.add(path.replace(os.sep, '/'))
+    return paths
+
+
+def _referenced_resource_paths(task, resources):
+    paths = set()
+    for argument in task.arguments.values():
+        for value in _iter_strings(argument.value):
+            if any(value in listed for _, _, listed in resources):
+                paths.add(value)
+    return paths
+
+
+def _iter_strings(value):
+    if isinstance(value, basestring):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            for string in _iter_strings(item):
+                yield string
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for string in _iter_strings(item):
+                yield string
+
+
+def _is_relative_path(value):
+    # Staged copies are only looked up within the staging directory
+    if not isinstance(value, basestring) or not value or os.path.isabs(value):
+        return False
+    return '..' not in value.replace('\\', '/').split('/')
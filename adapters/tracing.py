@@ -0,0 +1,264 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Execution timelines in the Chrome trace-event format.
+
+When the ``ARIA_CLOUDIFY_TRACE_DIR`` environment variable is set, every operation run through the
+executor extension records spans for its process start, adapter setup, plugin function and model
+flush, while the orchestrator records the time each task spent queued or waiting for a retry. The
+spans of each execution end up in ``<trace dir>/<execution id>.json``, which can be opened in any
+trace-event viewer (e.g. ``chrome://tracing``).
+
+Each operation process writes its spans to a fragment file of its own, so no locking is needed
+between processes; the fragments are merged when the execution ends (or explicitly, by calling
+:func:`export`).
+"""
+
+import os
+import time
+import calendar
+import threading
+from contextlib import contextmanager
+
+import psutil
+
+from . import utils
+
+
+TRACE_DIR_ENV_VAR = 'ARIA_CLOUDIFY_TRACE_DIR'
+
+QUEUEING = 'queueing'
+RETRY_WAIT = 'retry wait'
+PROCESS_START = 'process start'
+ADAPTER_SETUP = 'adapter setup'
+RATE_LIMIT_WAIT = 'rate limit wait'
+PLUGIN_FUNCTION = 'plugin function'
+MODEL_FLUSH = 'model flush'
+RETRY = 'retry'
+
+_PID = 1
+
+_orchestrator_tracer = None
+
+
+def get_trace_dir(env=None):
+    return (os.environ if env is None else env).get(TRACE_DIR_ENV_VAR) or None
+
+
+def operation_tracer(ctx, env=None):
+    """
+    Returns the tracer of the operation, or a tracer which records nothing if tracing is disabled.
+    """
+    trace_dir = get_trace_dir(env)
+    if not trace_dir:
+        return NULL_TRACER
+    task = ctx.task
+    tracer = Tracer(trace_dir, execution_id=task.execution.id, tid=task.id,
+                    args=_task_args(task))
+    # The span ends when the operation is about to run, so it covers the interpreter start up and
+    # the loading of the operation context
+    tracer.complete(PROCESS_START, psutil.Process(os.getpid()).create_time(), time.time())
+    return tracer
+
+
+def orchestrator_tracer(env=None):
+    """
+    Returns the tracer of the orchestrator process, or ``None`` if tracing is disabled.
+    """
+    global _orchestrator_tracer
+    trace_dir = get_trace_dir(env)
+    if not trace_dir:
+        return None
+    if _orchestrator_tracer is None or _orchestrator_tracer.trace_dir != trace_dir:
+        _orchestrator_tracer = OrchestratorTracer(trace_dir)
+    return _orchestrator_tracer
+
+
+def export(trace_dir, execution_id):
+    """
+    Merges the fragments recorded for the execution into ``<trace dir>/<execution id>.json``.
+
+    Spans which were already merged are kept, so this may be called more than once.
+
+    :return: path of the trace file
+    """
+    def merge(trace, fragments):
+        events = trace['traceEvents'] if trace else []
+        for fragment in fragments:
+            events.extend(fragment)
+        events.sort(key=lambda e: (e.get('ph') != 'M', e.get('ts', 0)))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    trace_path, _ = utils.merge_fragments(trace_dir, execution_id, merge)
+    return trace_path
+
+
+class Tracer(object):
+    """
+    Records spans of a single task, and writes them as a fragment of the execution trace.
+    """
+
+    def __init__(self, trace_dir, execution_id, tid, args=None):
+        self._trace_dir = trace_dir
+        self._execution_id = execution_id
+        self._tid = tid
+        self._args = args or {}
+        self._events = []
+        self._lock = threading.Lock()
+        if self._args.get('name'):
+            self._add({'name': 'thread_name', 'ph': 'M', 'pid': _PID, 'tid': tid,
+                       'args': {'name': self._args['name']}})
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            self.complete(name, start, time.time(), **args)
+
+    def traced_exit(self, name, context_manager):
+        """
+        Wraps ``context_manager`` so that only its exit (e.g. a flush) is recorded as a span.
+        """
+        return _TracedExit(self, name, context_manager)
+
+    def complete(self, name, start, end, **args):
+        self._add({'name': name, 'cat': 'operation', 'ph': 'X',
+                   'ts': _micros(start), 'dur': max(_micros(end) - _micros(start), 0),
+                   'pid': _PID, 'tid': self._tid, 'args': self._merged_args(args)})
+
+    def instant(self, name, **args):
+        self._add({'name': name, 'cat': 'operation', 'ph': 'i', 's': 't',
+                   'ts': _micros(time.time()), 'pid': _PID, 'tid': self._tid,
+                   'args': self._merged_args(args)})
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        utils.write_fragment(self._trace_dir, self._execution_id, self._tid, events)
+
+    def _merged_args(self, args):
+        merged = dict(self._args)
+        merged.update(args)
+        return merged
+
+    def _add(self, event):
+        with self._lock:
+            self._events.append(event)
+
+
+class _NullTracer(object):
+
+    @contextmanager
+    def span(self, name, **args):
+        yield
+
+    def traced_exit(self, name, context_manager):
+        return context_manager
+
+    def complete(self, name, start, end, **args):
+        pass
+
+    def instant(self, name, **args):
+        pass
+
+    def flush(self):
+        pass
+
+
+NULL_TRACER = _NullTracer()
+
+
+class _TracedExit(object):
+
+    def __init__(self, tracer, name, context_manager):
+        self._tracer = tracer
+        self._name = name
+        self._context_manager = context_manager
+
+    def __enter__(self):
+        return self._context_manager.__enter__()
+
+    def __exit__(self, *exc_info):
+        with self._tracer.span(self._name):
+            return self._context_manager.__exit__(*exc_info)
+
+
+class OrchestratorTracer(object):
+    """
+    Records the time tasks spend between becoming ready and being sent to the executor.
+    """
+
+    def __init__(self, trace_dir):
+        self._trace_dir = trace_dir
+        self._failed_at = {}
+        self._lock = threading.Lock()
+
+    @property
+    def trace_dir(self):
+        return self._trace_dir
+
+    def task_sent(self, task):
+        now = time.time()
+        with self._lock:
+            failed_at = self._failed_at.pop(task.id, None)
+        tracer = Tracer(self._trace_dir, execution_id=task.execution.id, tid=task.id,
+                        args=_task_args(task))
+        if failed_at is not None:
+            tracer.complete(RETRY_WAIT, failed_at, now)
+        else:
+            ended = [_timestamp(dependency.ended_at) for dependency in task.dependencies
+                     if dependency.ended_at]
+            ready_at = max(ended) if ended else _timestamp(task.execution.started_at)
+            if ready_at:
+                tracer.complete(QUEUEING, min(ready_at, now), now)
+        tracer.flush()
+
+    def task_failed(self, task):
+        with self._lock:
+            self._failed_at[task.id] = time.time()
+
+    def execution_ended(self, execution):
+        with self._lock:
+            self._failed_at.clear()
+        return export(self._trace_dir, execution.id)
+
+
+def _task_args(task):
+    actor = task.actor
+    return {
+        'name': task.name,
+        'node': actor.name if actor is not None else None,
+        'operation': '{0}.{1}'.format(task.interface_name, task.operation_name),
+        'attempt': task.attempts_count
+    }
+
+
+def _timestamp(utc_datetime):
+    if utc_datetime is None:
+        return None
+    return calendar.timegm(utc_datetime.utctimetuple()) + utc_datetime.microsecond / 1e6
+
+
+def _micros(timestamp):
+    return int(timestamp * 1e6)
@@ -0,0 +1,341 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import json
+import time
+import errno
+import sqlite3
+from contextlib import contextmanager
+
+from aria.modeling import models
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+def is_cloudify_dependent(task):
+    return bool(task.plugin and any(
+        'cloudify_plugins_common' in w for w in task.plugin.wheels))
+
+
+def plugin_workdir(workdir, service_id, plugin_name):
+    # Mirrors aria.orchestrator.context.operation.BaseOperationContext.plugin_workdir, for code
+    # running in the orchestrator, where no operation context exists
+    return u'{0}/plugins/{1}/{2}'.format(workdir, service_id, plugin_name)
+
+
+def makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another process might have created it in the meantime
+            if not os.path.isdir(path):
+                raise
+
+
+def get_path(source, path):
+    """
+    Returns the value at the dotted path in nested dicts, or ``None``.
+    """
+    value = source
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def node_properties(ctx):
+    """
+    Returns the properties of the node of an operation (the source node, for relationship
+    operations) as a dict of values.
+    """
+    node = getattr(ctx, 'node', None) or getattr(ctx, 'source_node', None)
+    if node is None:
+        return {}
+    return dict((name, plain_value(prop)) for name, prop in dict.iteritems(node.properties))
+
+
+def plain_value(value):
+    """
+    Returns a property or attribute value as plain dicts, lists and scalars.
+
+    Unwraps models (outside of instrumentation), and copies the instrumented collections (within
+    it), whose items are wrapped again on every access.
+    """
+    value = getattr(value, 'value', value)
+    if isinstance(value, dict):
+        return dict((key, plain_value(item)) for key, item in dict.iteritems(value))
+    elif isinstance(value, list):
+        return [plain_value(item) for item in list.__iter__(value)]
+    return value
+
+
+def percentile(values, percentile):
+    """
+    Returns the value at the percentile (between 0 and 1) of sorted values.
+    """
+    return values[min(len(values) - 1, int(round(percentile * (len(values) - 1))))]
+
+
+def is_alive(pid):
+    """
+    Returns whether the process is running (always ``True`` on Windows).
+    """
+    if os.name == 'nt':
+        # os.kill would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def is_cancelled(ctx):
+    """
+    Returns whether the execution of the context is being cancelled.
+    """
+    # Mirrors aria.orchestrator.workflows.core.engine.Engine._is_cancel
+    execution = ctx.model.execution.refresh(ctx.execution)
+    return execution.status in (models.Execution.CANCELLING, models.Execution.CANCELLED)
+
+
+def replace_file(source, destination):
+    """
+    Renames the file over the destination (atomically, except on Windows).
+    """
+    if os.name == 'nt' and os.path.exists(destination):
+        # os.rename doesn't overwrite on Windows
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def write_fragment(directory, execution_id, writer, content):
+    """
+    Writes JSON content as a fragment of ``<directory>/<execution id>.json``, to be merged into it
+    by :func:`merge_fragments`. Each writer (thread or task) of each process writes its own
+    fragments, so no locking is needed.
+    """
+    fragments_dir = _fragments_dir(directory, execution_id)
+    makedirs(fragments_dir)
+    path = os.path.join(fragments_dir, '{0}-{1}-{2}{3}'.format(
+        writer, os.getpid(), int(time.time() * 1e6), _FRAGMENT_SUFFIX))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(content, f)
+    replace_file(temp_path, path)
+
+
+def merge_fragments(directory, execution_id, merge, indent=None):
+    """
+    Merges the fragments written by :func:`write_fragment` into ``<directory>/<execution id>.json``,
+    and removes them.
+
+    ``merge`` is called with the content of the file (``None`` if it doesn't exist) and a list of
+    the contents of the fragments, and returns the merged content. Content which was already
+    merged is kept, so this may be called more than once.
+
+    :return: path of the file and the merged content
+    """
+    path = os.path.join(directory, '{0}.json'.format(execution_id))
+    fragments_dir = _fragments_dir(directory, execution_id)
+
+    merged = None
+    if os.path.isfile(path):
+        with open(path) as f:
+            merged = json.load(f)
+    fragments = []
+    fragment_paths = []
+    if os.path.isdir(fragments_dir):
+        for name in sorted(os.listdir(fragments_dir)):
+            if not name.endswith(_FRAGMENT_SUFFIX):
+                continue
+            fragment_path = os.path.join(fragments_dir, name)
+            with open(fragment_path) as f:
+                fragments.append(json.load(f))
+            fragment_paths.append(fragment_path)
+
+    merged = merge(merged, fragments)
+    makedirs(directory)
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(merged, f, indent=indent)
+    replace_file(temp_path, path)
+
+    for fragment_path in fragment_paths:
+        os.remove(fragment_path)
+    if os.path.isdir(fragments_dir) and not os.listdir(fragments_dir):
+        os.rmdir(fragments_dir)
+    return path, merged
+
+
+def _fragments_dir(directory, execution_id):
+    return os.path.join(directory, '{0}.fragments'.format(execution_id))
+
+
+_FRAGMENT_SUFFIX = '.fragment'
+
+
+def model_storage_id(model):
+    """
+    Returns the location of an SQL model storage (without credentials), or ``None``.
+    """
+    engine = model._all_api_kwargs.get('engine') if model is not None else None
+    if engine is None:
+        return None
+    url = engine.url
+    return u'{0}://{1}/{2}'.format(url.drivername, url.host or '', url.database or '')
+
+
+def create_sqlite_schema(path, schema):
+    """
+    Creates the tables of an SQLite database shared by processes, and its directory, once per
+    process.
+    """
+    key = (os.path.abspath(path), schema)
+    if key in _created_schemas and os.path.exists(path):
+        return
+    makedirs(os.path.dirname(key[0]))
+    with sqlite_transaction(path) as connection:
+        connection.executescript(schema)
+    _created_schemas.add(key)
+
+
+_created_schemas = set()
+
+
+@contextmanager
+def sqlite_transaction(path):
+    """
+    Connects to an SQLite database shared by processes, and commits (or rolls back) on exit.
+    """
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def task_nodes(task):
+    """
+    Returns the nodes an operation task works on: its node, or the source and target nodes of its
+    relationship.
+    """
+    if task.node is not None:
+        return [task.node]
+    elif task.relationship is not None:
+        return [task.relationship.source_node, task.relationship.target_node]
+    return []
+
+
+class LockedJSONState(object):
+    """
+    JSON state file shared by processes, read on entry and written on exit, under an exclusive
+    lock.
+    """
+
+    def __init__(self, path, default):
+        self._path = path
+        self._default = default
+        self._fd = None
+        self._state = None
+
+    def __enter__(self):
+        makedirs(os.path.dirname(self._path))
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            _lock(self._fd)
+            content = _read_all(self._fd)
+            try:
+                self._state = json.loads(content.decode('utf-8')) if content else None
+            except ValueError:
+                # A process crashed while writing the state
+                self._state = None
+            if not self._state:
+                self._state = dict(self._default)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        return self._state
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                content = json.dumps(self._state).encode('utf-8')
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, content)
+                os.ftruncate(self._fd, len(content))
+        finally:
+            _unlock(self._fd)
+            os.close(self._fd)
+        return False
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on the file (created if it doesn't exist), which is released on exit,
+    or when the process dies.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        _lock(fd)
+        try:
+            yield
+        finally:
+            _unlock(fd)
+    finally:
+        os.close(fd)
+
+
+def _lock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except IOError as e:
+            # LK_LOCK gives up after 10 seconds
+            if e.errno != errno.EDEADLOCK:
+                raise
+
+
+def _unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def _read_all(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    chunks = []
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
@@ -0,0 +1,487 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Adapter of ARIA's workflow context to Cloudify's.
+
+Cloudify workflows build task graphs with ``ctx.graph_mode()``; here, the graph is recorded and
+compiled into the ARIA task graph of the workflow when it is executed, keeping the dependencies
+between its tasks. Operations are mapped onto the TOSCA normative interfaces, e.g.
+``cloudify.interfaces.lifecycle.create`` becomes ``Standard.create``, and tasks which have no
+ARIA counterpart (setting the state of an instance, sending an event) become stub tasks, since
+ARIA keeps the node states and task events itself.
+"""
+
+import itertools
+from contextlib import contextmanager
+
+from aria.orchestrator.workflows.api import task as api_task
+from aria.orchestrator.workflows.builtin import workflows
+
+
+# Cloudify interface name -> ARIA interface name, and Cloudify operation name -> ARIA operation
+# name (per relationship side, for relationship operations)
+_NODE_INTERFACES = {
+    'cloudify.interfaces.lifecycle': workflows.NORMATIVE_STANDARD_INTERFACE
+}
+_RELATIONSHIP_INTERFACES = {
+    'cloudify.interfaces.relationship_lifecycle': workflows.NORMATIVE_CONFIGURE_INTERFACE
+}
+_RELATIONSHIP_OPERATIONS = {
+    'preconfigure': (workflows.NORMATIVE_PRE_CONFIGURE_SOURCE,
+                     workflows.NORMATIVE_PRE_CONFIGURE_TARGET),
+    'postconfigure': (workflows.NORMATIVE_POST_CONFIGURE_SOURCE,
+                      workflows.NORMATIVE_POST_CONFIGURE_TARGET),
+    'establish': (workflows.NORMATIVE_ADD_SOURCE, workflows.NORMATIVE_ADD_TARGET),
+    'unlink': (workflows.NORMATIVE_REMOVE_SOURCE, workflows.NORMATIVE_REMOVE_TARGET),
+}
+_SOURCE = 0
+_TARGET = 1
+
+
+class CloudifyWorkflowContextAdapter(object):
+
+    def __init__(self, ctx, graph):
+        self._ctx = ctx
+        self._graph = graph
+        self._nodes = None
+        self._last_phase = None
+
+    def __getattr__(self, item):
+        try:
+            return getattr(self._ctx, item)
+        except AttributeError:
+            return super(CloudifyWorkflowContextAdapter, self).__getattribute__(item)
+
+    @property
+    def execution_id(self):
+        return self._ctx.execution.id
+
+    @property
+    def workflow_id(self):
+        return self._ctx.execution.workflow_name
+
+    @property
+    def blueprint(self):
+        return _IdAdapter(self._ctx.service_template.id)
+
+    @property
+    def deployment(self):
+        return _IdAdapter(self._ctx.service.id)
+
+    @property
+    def logger(self):
+        return self._ctx.logger
+
+    def send_event(self, event, *args, **kwargs):
+        self.logger.info(event)
+
+    @property
+    def nodes(self):
+        if self._nodes is None:
+            service = self._ctx.service
+            self._nodes = [WorkflowNodeAdapter(self, node_template)
+                           for node_template in service.service_template.node_templates.values()]
+        return self._nodes
+
+    @property
+    def node_instances(self):
+        for node in self.nodes:
+            for instance in node.instances:
+                yield instance
+
+    def get_node(self, node_id):
+        for node in self.nodes:
+            if node_id in (node.id, node.name):
+                return node
+        return None
+
+    def get_node_instance(self, node_instance_id):
+        for instance in self.node_instances:
+            if node_instance_id in (instance.id, instance.name):
+                return instance
+        return None
+
+    def graph_mode(self):
+        return TaskGraphAdapter(self)
+
+    def _compile(self, task_graph):
+        """
+        Adds the tasks of a Cloudify task graph to the ARIA task graph. Graphs are executed one
+        after the other, so the tasks of a graph depend on all the tasks of the previous one.
+        """
+        first_tasks, last_tasks = task_graph._compile(self._graph)
+        if self._last_phase is not None and first_tasks:
+            barrier = api_task.StubTask()
+            self._graph.add_tasks(barrier)
+            self._graph.add_dependency(barrier, self._last_phase)
+            self._graph.add_dependency(first_tasks, barrier)
+        if last_tasks:
+            self._last_phase = last_tasks
+
+
+class WorkflowNodeAdapter(object):
+
+    def __init__(self, ctx, node_template):
+        self._ctx = ctx
+        self._node_template = node_template
+        self._instances = None
+
+    @property
+    def id(self):
+        return self._node_template.id
+
+    @property
+    def name(self):
+        return self._node_template.name
+
+    @property
+    def type(self):
+        return self._node_template.type.name
+
+    @property
+    def type_hierarchy(self):
+        # Same as for operations (see context_adapter.NodeAdapter)
+        return [type_.name.replace('aria', 'cloudify')
+                for type_ in self._node_template.type.hierarchy if type_.name is not None]
+
+    @property
+    def properties(self):
+        return dict((name, prop.value)
+                    for name, prop in self._node_template.properties.iteritems())
+
+    @property
+    def number_of_instances(self):
+        return len(self.instances)
+
+    @property
+    def instances(self):
+        if self._instances is None:
+            self._instances = [WorkflowNodeInstanceAdapter(self._ctx, self, node)
+                               for node in self._node_template.nodes
+                               if node.state != node.DELETED]
+        return self._instances
+
+
+class WorkflowNodeInstanceAdapter(object):
+
+    def __init__(self, ctx, node, node_model):
+        self._ctx = ctx
+        self._node = node
+        self._node_model = node_model
+
+    @property
+    def id(self):
+        return self._node_model.id
+
+    @property
+    def name(self):
+        return self._node_model.name
+
+    @property
+    def node_id(self):
+        return self._node.id
+
+    @property
+    def node(self):
+        return self._node
+
+    @property
+    def host_id(self):
+        host = self._node_model.host
+        return host.id if host is not None else None
+
+    @property
+    def runtime_properties(self):
+        return dict((name, attribute.value)
+                    for name, attribute in self._node_model.attributes.iteritems())
+
+    @property
+    def relationships(self):
+        return [WorkflowRelationshipInstanceAdapter(self._ctx, self, relationship)
+                for relationship in self._node_model.outbound_relationships]
+
+    def get_relationship(self, target_id):
+        for relationship in self.relationships:
+            if relationship.target_id == target_id:
+                return relationship
+        return None
+
+    @property
+    def contained_instances(self):
+        return [instance for instance in self._ctx.node_instances
+                if instance._container_id == self.id]
+
+    def get_contained_subgraph(self):
+        subgraph = set([self])
+        for instance in self.contained_instances:
+            subgraph.update(instance.get_contained_subgraph())
+        return subgraph
+
+    def execute_operation(self, operation, kwargs=None, allow_kwargs_override=False,
+                          send_task_events=True):
+        interface_name, operation_name = _split_operation(operation)
+        if interface_name not in self._node_model.interfaces:
+            interface_name = _NODE_INTERFACES.get(interface_name, interface_name)
+        return _create_task(self._node_model, interface_name, operation_name, kwargs)
+
+    def set_state(self, state):
+        return _NOPTask(u'set_state:{0}@{1}'.format(state, self.name))
+
+    def send_event(self, event, additional_context=None):
+        return _NOPTask(u'send_event@{0}'.format(self.name))
+
+    @property
+    def _container_id(self):
+        for relationship in self._node_model.outbound_relationships:
+            target_capability = relationship.target_capability
+            if target_capability is not None and target_capability.type.role == 'host':
+                return relationship.target_node.id
+        return None
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, WorkflowNodeInstanceAdapter) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class WorkflowRelationshipInstanceAdapter(object):
+
+    def __init__(self, ctx, node_instance, relationship):
+        self._ctx = ctx
+        self._node_instance = node_instance
+        self._relationship = relationship
+
+    @property
+    def target_id(self):
+        return self._relationship.target_node.id
+
+    @property
+    def target_node_instance(self):
+        return self._ctx.get_node_instance(self.target_id)
+
+    @property
+    def node_instance(self):
+        return self._node_instance
+
+    @property
+    def type(self):
+        return self._relationship.type.name if self._relationship.type else None
+
+    def execute_source_operation(self, operation, kwargs=None, allow_kwargs_override=False,
+                                 send_task_events=True):
+        return self._execute_operation(operation, _SOURCE, kwargs)
+
+    def execute_target_operation(self, operation, kwargs=None, allow_kwargs_override=False,
+                                 send_task_events=True):
+        return self._execute_operation(operation, _TARGET, kwargs)
+
+    def _execute_operation(self, operation, side, kwargs):
+        interface_name, operation_name = _split_operation(operation)
+        if interface_name not in self._relationship.interfaces and \
+                interface_name in _RELATIONSHIP_INTERFACES:
+            interface_name = _RELATIONSHIP_INTERFACES[interface_name]
+            if operation_name in _RELATIONSHIP_OPERATIONS:
+                operation_name = _RELATIONSHIP_OPERATIONS[operation_name][side]
+        return _create_task(self._relationship, interface_name, operation_name, kwargs)
+
+
+class TaskGraphAdapter(object):
+    """
+    Cloudify's task dependency graph, recorded to be compiled into an ARIA task graph.
+    """
+
+    def __init__(self, ctx, name=None):
+        self._ctx = ctx
+        self._name = name
+        self._tasks = []
+        self._dependencies = {}
+
+    @property
+    def id(self):
+        return id(self)
+
+    @property
+    def name(self):
+        return self._name
+
+    def add_task(self, task):
+        if task not in self._tasks:
+            self._tasks.append(task)
+        return task
+
+    def remove_task(self, task):
+        self._tasks.remove(task)
+        self._dependencies.pop(task, None)
+        for dependencies in self._dependencies.values():
+            dependencies.discard(task)
+
+    def get_task(self, task_id):
+        for task in self._tasks:
+            if task.id == task_id:
+                return task
+        return None
+
+    def tasks_iter(self):
+        return iter(self._tasks)
+
+    def add_dependency(self, src_task, dst_task):
+        """
+        Makes ``src_task`` depend on ``dst_task``.
+        """
+        self.add_task(src_task)
+        self.add_task(dst_task)
+        self._dependencies.setdefault(src_task, set()).add(dst_task)
+
+    def remove_dependency(self, src_task, dst_task):
+        self._dependencies.get(src_task, set()).discard(dst_task)
+
+    def contains_dependency(self, src_task, dst_task):
+        return dst_task in self._dependencies.get(src_task, ())
+
+    def sequence(self):
+        return _TaskSequenceAdapter(self)
+
+    def subgraph(self, name):
+        return self.add_task(TaskGraphAdapter(self._ctx, name))
+
+    def execute(self):
+        self._ctx._compile(self)
+
+    def _compile(self, graph):
+        """
+        :return: the tasks of the graph which have no dependencies, and those which have no
+         dependents
+        """
+        if not self._tasks:
+            # Keeps the ordering between the tasks this graph depends on and its dependents
+            stub = api_task.StubTask()
+            graph.add_tasks(stub)
+            return [stub], [stub]
+
+        compiled = {}
+        for task in self._tasks:
+            if isinstance(task, TaskGraphAdapter):
+                compiled[task] = task._compile(graph)
+            else:
+                aria_task = task._aria_task or api_task.StubTask()
+                graph.add_tasks(aria_task)
+                compiled[task] = ([aria_task], [aria_task])
+
+        dependents = set()
+        for src_task, dst_tasks in self._dependencies.items():
+            for dst_task in dst_tasks:
+                first_tasks, _ = compiled[src_task]
+                _, last_tasks = compiled[dst_task]
+                if first_tasks and last_tasks:
+                    graph.add_dependency(first_tasks, last_tasks)
+                dependents.add(dst_task)
+        first_tasks = list(itertools.chain.from_iterable(
+            compiled[task][0] for task in self._tasks if not self._dependencies.get(task)))
+        last_tasks = list(itertools.chain.from_iterable(
+            compiled[task][1] for task in self._tasks if task not in dependents))
+        return first_tasks, last_tasks
+
+    def is_nop(self):
+        return not self._tasks
+
+
+class _TaskSequenceAdapter(object):
+
+    def __init__(self, graph):
+        self._graph = graph
+        self._last_task = None
+
+    def add(self, *tasks):
+        for task in tasks:
+            self._graph.add_task(task)
+            if self._last_task is not None:
+                self._graph.add_dependency(task, self._last_task)
+            self._last_task = task
+
+
+class _OperationTask(object):
+
+    def __init__(self, aria_task):
+        self._aria_task = aria_task
+
+    @property
+    def id(self):
+        return self._aria_task.id
+
+    @property
+    def name(self):
+        return self._aria_task.name
+
+    def is_nop(self):
+        return False
+
+
+class _NOPTask(object):
+
+    _aria_task = None
+
+    def __init__(self, name):
+        self._name = name
+
+    @property
+    def id(self):
+        return id(self)
+
+    @property
+    def name(self):
+        return self._name
+
+    def is_nop(self):
+        return True
+
+
+class _IdAdapter(object):
+
+    def __init__(self, id_):
+        self.id = id_
+
+
+def _split_operation(operation):
+    interface_name, _, operation_name = operation.rpartition('.')
+    return interface_name, operation_name
+
+
+def _create_task(actor, interface_name, operation_name, kwargs):
+    # As in Cloudify, operations which aren't defined are skipped
+    aria_task = api_task.create_task(actor, interface_name, operation_name, arguments=kwargs)
+    if aria_task is None:
+        return _NOPTask(u'{0}.{1}@{2}'.format(interface_name, operation_name, actor.name))
+    return _OperationTask(aria_task)
+
+
+@contextmanager
+def push_cfy_workflow_ctx(ctx, parameters):
+    """
+    Makes the adapter available as ``cloudify.workflows.ctx``, when Cloudify is installed.
+    """
+    try:
+        from cloudify import state
+        current_workflow_ctx = state.current_workflow_ctx
+    except (ImportError, AttributeError):
+        yield ctx
+        return
+    with current_workflow_ctx.push(ctx, parameters):
+        yield ctx
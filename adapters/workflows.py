@@ -0,0 +1,381 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Cloudify-compatible workflows for services running Cloudify plugins.
+
+The workflows are declared in the service template as ``aria.Workflow`` policies, with their
+parameters as properties of the policy type, e.g.::
+
+    policy_types:
+      Scale:
+        derived_from: aria.Workflow
+        properties:
+          scalable_entity_name: { type: string, required: false }
+          delta: { type: integer, default: 1 }
+          scale_compute: { type: boolean, default: false }
+
+    topology_template:
+      policies:
+        scale:
+          type: Scale
+          properties:
+            implementation: adapters.workflows.scale
+"""
+
+from aria import workflow
+from aria.modeling import models
+from aria.orchestrator import exceptions
+from aria.orchestrator.topology import topology
+from aria.orchestrator.workflows.api import task
+from aria.orchestrator.workflows.builtin import workflows
+from aria.utils.imports import import_fullname
+
+from . import (concurrency, workflow_context_adapter)
+
+
+# Input of scale executions holding the IDs of the nodes they remove, persisted with the execution
+# so that they're marked as deleted once it succeeds, even by the process resuming it
+SCALED_IN_NODES_INPUT = '_scaled_in_nodes'
+
+
+class ScalingError(exceptions.OrchestratorError):
+    """
+    Raised when a scale workflow is requested for an invalid node template or delta.
+    """
+    pass
+
+
+@workflow
+def scale(ctx, graph, scalable_entity_name, delta=1, scale_compute=False):
+    """
+    Adds (positive ``delta``) or removes (negative ``delta``) instances of a node template.
+
+    A scaled unit is a node together with the nodes contained in it. New units are modeled on the
+    newest existing unit, with relationships to nodes outside the unit kept as they are, and are
+    installed in parallel; only the added or removed nodes are operated on.
+
+    :param scalable_entity_name: name of the node template to scale
+    :param delta: number of instances to add or remove
+    :param scale_compute: scale the compute node hosting the node template instead
+    """
+    delta = int(delta)
+    # The topology is modified, so the models are used as is rather than instrumented
+    requested_template = _unwrapped(ctx.model.node_template.get_by_name(scalable_entity_name))
+    node_template = requested_template
+    units = _units(node_template)
+    if scale_compute and units:
+        host = units[-1][0].host
+        if host is not None and host.node_template != node_template:
+            node_template = host.node_template
+            units = _units(node_template)
+
+    _validate_scaling(node_template, len(units), delta)
+    if delta > 0:
+        # New units are modeled on the newest unit which includes the requested node template
+        sample_unit = next((unit for unit in reversed(units)
+                            if any(node.node_template == requested_template for node in unit)),
+                           units[-1] if units else None)
+        _scale_out(ctx, graph, node_template, sample_unit, delta)
+    elif delta < 0:
+        _scale_in(ctx, graph, units[delta:])
+
+
+@workflow
+def heal(ctx, graph, node_instance_id):
+    """
+    Reinstalls a failed node together with the nodes contained in it.
+
+    Only the failed subgraph is operated on: its nodes are uninstalled (ignoring failures, as they
+    are likely to be gone already) and installed again, and the relationships of the remaining
+    nodes to them are unlinked beforehand and established again afterwards.
+
+    :param node_instance_id: ID of the failed node
+    """
+    failed_node = _unwrapped(ctx.model.node.get(node_instance_id))
+    live_nodes = [node for node in failed_node.service.nodes.itervalues()
+                  if not _is_deleted(node)]
+    healed_nodes = [failed_node] + _contained_nodes(failed_node, live_nodes)
+    healed_ids = set(node.id for node in healed_nodes)
+
+    teardown_tasks = []
+    install_tasks = []
+    for node in healed_nodes:
+        teardown_task = task.WorkflowTask(_teardown_node, node=node)
+        install_task = task.WorkflowTask(workflows.install_node, node=node)
+        graph.add_tasks(teardown_task, install_task)
+        teardown_tasks.append((teardown_task, node))
+        install_tasks.append((install_task, node))
+    # A node is reinstalled only once the whole subgraph was torn down
+    for install_task, _ in install_tasks:
+        graph.add_dependency(install_task, [t for t, _ in teardown_tasks])
+    workflows.create_node_task_dependencies(graph, teardown_tasks, reverse=True)
+    workflows.create_node_task_dependencies(graph, install_tasks)
+
+    for (teardown_task, node), (install_task, _) in zip(teardown_tasks, install_tasks):
+        for relationship in node.inbound_relationships:
+            if relationship.source_node.id in healed_ids or \
+                    _is_deleted(relationship.source_node):
+                continue
+            unlink_tasks = task.create_relationship_tasks(
+                relationship,
+                workflows.NORMATIVE_CONFIGURE_INTERFACE,
+                workflows.NORMATIVE_REMOVE_SOURCE,
+                workflows.NORMATIVE_REMOVE_TARGET,
+                ignore_failure=True)
+            if unlink_tasks:
+                graph.add_tasks(*unlink_tasks)
+                graph.add_dependency(teardown_task, unlink_tasks)
+            link_tasks = graph.sequence(*_link_tasks(relationship))
+            if link_tasks:
+                graph.add_dependency(link_tasks[0], install_task)
+
+
+@workflow
+def cloudify_workflow(ctx, graph, function, max_concurrent_tasks=None, **parameters):
+    """
+    Runs a Cloudify workflow function, which builds its task graph with ``ctx.graph_mode()``.
+
+    The function is called with the Cloudify workflow context adapter as ``ctx``, and with the
+    rest of the workflow parameters as keyword arguments; the graphs it executes are compiled into
+    the task graph of this workflow.
+
+    :param function: full name of the workflow function, e.g. ``my_workflows.parallel_install``
+    :param max_concurrent_tasks: maximum number of tasks to run at the same time
+    """
+    workflow_function = import_fullname(function)
+    ctx_adapter = workflow_context_adapter.CloudifyWorkflowContextAdapter(ctx, graph)
+    with workflow_context_adapter.push_cfy_workflow_ctx(ctx_adapter, parameters):
+        workflow_function(ctx=ctx_adapter, **parameters)
+    concurrency.set_limit(ctx.execution.id, max_concurrent_tasks)
+
+
+def mark_scaled_in_nodes(ctx):
+    """
+    Marks the nodes removed by a successful scale execution as deleted.
+
+    Nodes are kept in the model rather than deleted, since their tasks and relationships are
+    part of the execution history.
+    """
+    scaled_in_nodes = ctx.execution.inputs.get(SCALED_IN_NODES_INPUT)
+    if scaled_in_nodes is None:
+        return
+    for node_id in scaled_in_nodes.value:
+        node = _unwrapped(ctx.model.node.get(node_id))
+        for relationship in node.outbound_relationships:
+            if relationship.target_capability is not None:
+                relationship.target_capability.occurrences -= 1
+        node.state = node.DELETED
+        ctx.model.node.update(node)
+
+
+@workflow(suffix_template='{node.name}')
+def _teardown_node(graph, node, **kwargs):
+    sequence = [task.create_task(node,
+                                 workflows.NORMATIVE_STANDARD_INTERFACE,
+                                 workflows.NORMATIVE_STOP,
+                                 ignore_failure=True)]
+    sequence += task.create_relationships_tasks(node,
+                                                workflows.NORMATIVE_CONFIGURE_INTERFACE,
+                                                workflows.NORMATIVE_REMOVE_SOURCE,
+                                                workflows.NORMATIVE_REMOVE_TARGET,
+                                                ignore_failure=True)
+    sequence.append(task.create_task(node,
+                                     workflows.NORMATIVE_STANDARD_INTERFACE,
+                                     workflows.NORMATIVE_DELETE,
+                                     ignore_failure=True))
+    graph.sequence(*sequence)
+
+
+def _link_tasks(relationship):
+    return [task.create_relationship_tasks(relationship,
+                                           workflows.NORMATIVE_CONFIGURE_INTERFACE,
+                                           source_operation_name,
+                                           target_operation_name)
+            for source_operation_name, target_operation_name in (
+                (workflows.NORMATIVE_PRE_CONFIGURE_SOURCE,
+                 workflows.NORMATIVE_PRE_CONFIGURE_TARGET),
+                (workflows.NORMATIVE_POST_CONFIGURE_SOURCE,
+                 workflows.NORMATIVE_POST_CONFIGURE_TARGET),
+                (workflows.NORMATIVE_ADD_SOURCE, workflows.NORMATIVE_ADD_TARGET))]
+
+
+def _validate_scaling(node_template, instances, delta):
+    scaling = node_template.scaling
+    new_instances = instances + delta
+    if new_instances < scaling['min_instances']:
+        raise ScalingError(
+            u'Cannot scale node template "{0}" to {1:d} instances, the minimum is {2:d}'.format(
+                node_template.name, new_instances, scaling['min_instances']))
+    # A negative maximum stands for an unbounded number of instances
+    if 0 <= scaling['max_instances'] < new_instances:
+        raise ScalingError(
+            u'Cannot scale node template "{0}" to {1:d} instances, the maximum is {2:d}'.format(
+                node_template.name, new_instances, scaling['max_instances']))
+
+
+def _scale_out(ctx, graph, node_template, sample_unit, delta):
+    topology_ = topology.Topology()
+    service = _unwrapped(ctx.service)
+    storage_session = ctx.model._all_api_kwargs['session']
+    new_nodes = []
+    # Same as when the service is created: the relationships are set up before anything is flushed
+    with storage_session.no_autoflush:
+        for _ in range(delta):
+            if sample_unit:
+                new_nodes.extend(_copy_unit(topology_, sample_unit))
+            else:
+                new_nodes.append(_instantiate_node(topology_, node_template))
+        for node in new_nodes:
+            service.nodes[node.name] = node
+        for node in new_nodes:
+            node.host = topology_._find_host(node)
+            topology_.configure_operations(node)
+            topology_.coerce(node, report_issues=True)
+        if topology_.has_issues:
+            raise ScalingError(u'Cannot scale node template "{0}": {1}'.format(
+                node_template.name, u'; '.join(issue.message for issue in topology_.issues)))
+    ctx.model.service.update(service)
+
+    tasks_and_nodes = []
+    for node in new_nodes:
+        install_task = task.WorkflowTask(workflows.install_node, node=node)
+        graph.add_tasks(install_task)
+        tasks_and_nodes.append((install_task, node))
+    # Only the nodes of the same unit depend on each other, so the units are installed in parallel
+    workflows.create_node_task_dependencies(graph, tasks_and_nodes)
+
+
+def _scale_in(ctx, graph, units):
+    removed_nodes = [node for unit in units for node in unit]
+    removed_ids = set(node.id for node in removed_nodes)
+
+    tasks_and_nodes = []
+    for node in removed_nodes:
+        uninstall_task = task.WorkflowTask(workflows.uninstall_node, node=node)
+        graph.add_tasks(uninstall_task)
+        tasks_and_nodes.append((uninstall_task, node))
+
+        # Remaining nodes which relate to the node are unlinked from it before it is uninstalled
+        unlink_tasks = []
+        for relationship in node.inbound_relationships:
+            if relationship.source_node.id in removed_ids or _is_deleted(relationship.source_node):
+                continue
+            unlink_tasks.extend(task.create_relationship_tasks(
+                relationship,
+                workflows.NORMATIVE_CONFIGURE_INTERFACE,
+                workflows.NORMATIVE_REMOVE_SOURCE,
+                workflows.NORMATIVE_REMOVE_TARGET))
+        if unlink_tasks:
+            graph.add_tasks(*unlink_tasks)
+            graph.add_dependency(uninstall_task, unlink_tasks)
+    workflows.create_node_task_dependencies(graph, tasks_and_nodes, reverse=True)
+
+    execution = _unwrapped(ctx.execution)
+    execution.inputs[SCALED_IN_NODES_INPUT] = models.Input.wrap(SCALED_IN_NODES_INPUT,
+                                                                sorted(removed_ids))
+    ctx.model.execution.update(execution)
+
+
+def _copy_unit(topology_, sample_unit):
+    copies = {}
+    for node in sample_unit:
+        copies[node.id] = _instantiate_node(topology_, node.node_template, requirements=False)
+    for node in sample_unit:
+        for relationship in node.outbound_relationships:
+            target_node = copies.get(relationship.target_node.id, relationship.target_node)
+            copies[node.id].outbound_relationships.append(
+                _copy_relationship(topology_, relationship, target_node))
+    return [copies[node.id] for node in sample_unit]
+
+
+def _instantiate_node(topology_, node_template, requirements=True):
+    node = topology_.instantiate(node_template)
+    if requirements:
+        # There is no existing node to copy the relationships from, so the requirements are
+        # satisfied the same way they are when the service is created
+        topology_.satisfy_requirements(node)
+    return node
+
+
+def _copy_relationship(topology_, relationship, target_node):
+    if relationship.relationship_template is not None:
+        copy = topology_.instantiate(relationship.relationship_template)
+    else:
+        copy = models.Relationship()
+    copy.name = relationship.name
+    copy.requirement_template = relationship.requirement_template
+    copy.target_node = target_node
+    if relationship.target_capability is not None:
+        target_capability = target_node.capabilities.get(relationship.target_capability.name)
+        if target_capability is None or not target_capability.relate():
+            raise ScalingError(
+                u'Capability "{0}" of node "{1}" cannot take another relationship'.format(
+                    relationship.target_capability.name, target_node.name))
+        copy.target_capability = target_capability
+    return copy
+
+
+def _units(node_template):
+    """
+    Existing units of the node template, oldest first. Each unit is a list of nodes, starting with
+    the node of the template itself, followed by the nodes contained in it.
+    """
+    roots = sorted((node for node in node_template.nodes if not _is_deleted(node)),
+                   key=_node_index)
+    if not roots:
+        return []
+    service_nodes = [node for node in roots[0].service.nodes.itervalues()
+                     if not _is_deleted(node)]
+    return [[root] + _contained_nodes(root, service_nodes) for root in roots]
+
+
+def _contained_nodes(root, nodes):
+    contained = []
+    containers = set([root.id])
+    added = True
+    while added:
+        added = False
+        for node in nodes:
+            if node.id in containers:
+                continue
+            container = _container(node)
+            if container is not None and container.id in containers:
+                containers.add(node.id)
+                contained.append(node)
+                added = True
+    return contained
+
+
+def _container(node):
+    for relationship in node.outbound_relationships:
+        target_capability = relationship.target_capability
+        if target_capability is not None and target_capability.type.role == 'host':
+            return relationship.target_node
+    return node.host if node.host is not None and node.host.id != node.id else None
+
+
+def _node_index(node):
+    index = node.name.rsplit('_', 1)[-1]
+    return (int(index) if index.isdigit() else 0, node.id)
+
+
+def _unwrapped(model):
+    return getattr(model, '_wrapped', model)
+
+
+def _is_deleted(node):
+    return node.state == node.DELETED
@@ -0,0 +1,75 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import pytest
+
+import aria
+from aria import (application_model_storage, application_resource_storage, extension)
+from aria.core import Core
+from aria.orchestrator import execution_preparer
+from aria.orchestrator.workflows.executor import process
+from aria.storage import (sql_mapi, filesystem_rapi)
+
+
+@pytest.fixture
+def core(tmpdir):
+    # Installing the extensions twice fails on the re-definition of the parser presenters
+    if not extension.parser.presenter_class():
+        aria.install_aria_extensions()
+    model = application_model_storage(
+        sql_mapi.SQLAlchemyModelAPI,
+        initiator=sql_mapi.init_storage,
+        initiator_kwargs=dict(base_dir=str(tmpdir)))
+    resource = application_resource_storage(
+        filesystem_rapi.FileSystemResourceAPI,
+        api_kwargs=dict(directory=str(tmpdir.join('resources'))))
+    return Core(model, resource, None)
+
+
+@pytest.fixture
+def service(request, core, tmpdir):
+    """
+    Started service of the ``SERVICE_TEMPLATE`` of the test module.
+    """
+    template_dir = tmpdir.mkdir('template')
+    template_dir.join('service_template.yaml').write(request.module.SERVICE_TEMPLATE)
+    core.create_service_template(str(template_dir.join('service_template.yaml')),
+                                 str(template_dir), 'template')
+    service = core.create_service(
+        core.model_storage.service_template.get_by_name('template').id, {})
+    for node in service.nodes.itervalues():
+        node.state = node.STARTED
+        core.model_storage.node.update(node)
+    return service
+
+
+@pytest.fixture
+def prepare_execution(core, service):
+    """
+    Creates the tasks of a workflow execution, without running them.
+    """
+    def prepare(workflow_name, **inputs):
+        model = core.model_storage
+        preparer = execution_preparer.ExecutionPreparer(
+            model, core.resource_storage, None, service, workflow_name)
+        ctx = preparer.prepare(inputs, executor=process.ProcessExecutor(plugin_manager=None))
+        # Only one execution of the service may be active at a time
+        execution = model.execution.get(ctx.execution.id)
+        execution.status = execution.STARTED
+        execution.status = execution.SUCCEEDED
+        model.execution.update(execution)
+        return ctx
+    return prepare
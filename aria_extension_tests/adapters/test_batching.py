@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import threading
+import subprocess
+
+import pytest
+
+from adapters import (batching, utils)
+
+
+@pytest.fixture
+def coordinator_factory(tmpdir):
+    def factory(**kwargs):
+        kwargs.setdefault('window', 0.5)
+        return batching.BatchCoordinator(str(tmpdir.join('batches', 'batches.db')), **kwargs)
+    return factory
+
+
+def _submit_all(coordinator, submissions):
+    """
+    Submits the items from threads, and returns the results and the batches handled.
+    """
+    batches = []
+    results = {}
+
+    def handle(items):
+        batches.append(sorted(item['id'] for item in items))
+        return [{'handled': item['id']} for item in items]
+
+    def submit(key, item):
+        results[item['id']] = coordinator.submit(key, item, handle)
+
+    threads = [threading.Thread(target=submit, args=submission) for submission in submissions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results, sorted(batches)
+
+
+class TestBatchCoordinator(object):
+
+    def test_batch(self, coordinator_factory):
+        coordinator = coordinator_factory()
+        results, batches = _submit_all(coordinator, [('delete', {'id': i}) for i in range(5)])
+        assert batches == [range(5)]
+        assert results == dict((i, {'handled': i}) for i in range(5))
+
+    def test_keys(self, coordinator_factory):
+        coordinator = coordinator_factory()
+        _, batches = _submit_all(coordinator, [('key{0}'.format(i % 2), {'id': i})
+                                               for i in range(4)])
+        assert batches == [[0, 2], [1, 3]]
+
+    def test_max_size(self, coordinator_factory):
+        coordinator = coordinator_factory(max_size=2)
+        _, batches = _submit_all(coordinator, [('delete', {'id': i}) for i in range(3)])
+        assert sorted(len(batch) for batch in batches) == [1, 2]
+
+    def test_lost_batch(self, coordinator_factory, tmpdir):
+        coordinator = coordinator_factory(window=0)
+        process = subprocess.Popen(['true'])
+        process.wait()
+        with utils.sqlite_transaction(str(tmpdir.join('batches', 'batches.db'))) as connection:
+            batch_id = connection.execute(
+                'INSERT INTO batches (key, leader_pid) VALUES (?, ?)',
+                ('delete', process.pid)).lastrowid
+            item_id = connection.execute(
+                'INSERT INTO items (batch_id, item) VALUES (?, ?)', (batch_id, '{}')).lastrowid
+        assert coordinator._wait(item_id) is None
+
+        # The batch of a dead process isn't joined
+        _, batches = _submit_all(coordinator, [('delete', {'id': 1})])
+        assert batches == [[1]]
+
+    def test_failed_handler(self, coordinator_factory, tmpdir):
+        coordinator = coordinator_factory(window=0)
+
+        def handle(items):
+            raise RuntimeError('handler failed')
+
+        with pytest.raises(RuntimeError):
+            coordinator.submit('delete', {'id': 1}, handle)
+        # Members of the batch find it lost, rather than waiting for it
+        with utils.sqlite_transaction(str(tmpdir.join('batches', 'batches.db'))) as connection:
+            assert connection.execute('SELECT COUNT(*) FROM batches').fetchone() == (0,)
+
+
+class TestHandleBatch(object):
+
+    def test_runtime_properties_changes(self):
+        def delete_all(ctx, instances):
+            assert ctx == 'ctx'
+            for instance in instances:
+                assert instance.inputs == {'force': True}
+                del instance.runtime_properties['aws_resource_id']
+                instance.runtime_properties['deleted'] = instance.properties['name']
+
+        items = [{'id': i, 'properties': {'name': 'vm{0}'.format(i)},
+                  'runtime_properties': {'aws_resource_id': 'i-{0}'.format(i), 'state': 'on'},
+                  'inputs': {'force': True}} for i in range(2)]
+        results = batching.handle_batch(delete_all, 'ctx', items)
+        assert results == [{'changed': {'deleted': 'vm0'}, 'removed': ['aws_resource_id']},
+                           {'changed': {'deleted': 'vm1'}, 'removed': ['aws_resource_id']}]
+        # The items are left as submitted
+        assert items[0]['runtime_properties']['aws_resource_id'] == 'i-0'
+
+    def test_disabled(self):
+        assert batching.from_environment({}) is None
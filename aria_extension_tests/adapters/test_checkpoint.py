@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+
+import pytest
+
+from aria.modeling import models
+from aria.orchestrator import execution_preparer
+from aria.orchestrator.workflows.executor import process
+
+from adapters import checkpoint
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+topology_template:
+  node_templates:
+    vm:
+      type: tosca.nodes.Compute
+      interfaces:
+        Standard:
+          create: cloudify_aws.ec2.instance.create
+          start: cloudify_aws.ec2.instance.start
+"""
+
+
+@pytest.fixture
+def store(tmpdir):
+    return checkpoint.CheckpointStore(str(tmpdir.join('checkpoints')))
+
+
+@pytest.fixture
+def interrupted_execution(core, service):
+    """
+    Install execution left started, as by a crashed orchestrator.
+    """
+    model = core.model_storage
+    ctx = execution_preparer.ExecutionPreparer(
+        model, core.resource_storage, None, service, 'install'
+    ).prepare(executor=process.ProcessExecutor(plugin_manager=None))
+    execution = model.execution.get(ctx.execution.id)
+    execution.status = execution.STARTED
+    model.execution.update(execution)
+    return execution
+
+
+def _operation_task(execution, operation_name):
+    return next(task for task in execution.tasks if task.operation_name == operation_name)
+
+
+class TestCheckpoint(object):
+
+    def test_store(self, store):
+        store.write(1, 10, False, {3: {'state': 'pending'}})
+        store.write(1, 10, True, {3: {'state': 'running'}})
+        store.write(1, 11, True, {})
+        store.write(2, 20, True, {})
+
+        checkpoints = store.read(1)
+        assert sorted(checkpoints) == [10, 11]
+        assert checkpoints[10]['succeeded']
+        assert checkpoints[10]['runtime_properties'] == {'3': {'state': 'running'}}
+        # Nothing is left of the temporary files checkpoints are written to
+        assert sorted(os.listdir(store._execution_dir(1))) == ['10.json', '11.json']
+
+        store.clear(1)
+        assert store.read(1) == {}
+        assert sorted(store.read(2)) == [20]
+
+    def test_restore(self, core, store, interrupted_execution):
+        model = core.model_storage
+        create = _operation_task(interrupted_execution, 'create')
+        start = _operation_task(interrupted_execution, 'start')
+        node = create.node
+        store.write(interrupted_execution.id, create.id, True,
+                    {node.id: {'instance_id': 'i-1234', 'state': 'pending'}})
+        store.write(interrupted_execution.id, start.id, False,
+                    {node.id: {'instance_id': 'i-1234', 'state': 'starting'}})
+        # Changes committed by the start operation when the orchestrator crashed
+        node.attributes['instance_id'] = models.Attribute.wrap('instance_id', 'i-5678')
+        model.node.update(node)
+
+        succeeded, restored = checkpoint.restore(model, interrupted_execution, store)
+
+        assert succeeded == [create.id]
+        assert restored == [node.id]
+        assert model.task.get(create.id).status == create.SUCCESS
+        assert not model.task.get(start.id).has_ended()
+        attributes = model.node.get(node.id).attributes
+        assert (attributes['instance_id'].value, attributes['state'].value) == \
+            ('i-1234', 'starting')
+        assert model.execution.get(interrupted_execution.id).status == \
+            interrupted_execution.CANCELLED
+
+    def test_restore_without_checkpoints(self, core, store, interrupted_execution):
+        assert checkpoint.restore(core.model_storage, interrupted_execution, store) == ([], [])
+        assert all(not task.has_ended() for task in interrupted_execution.tasks
+                   if not task._stub_type)
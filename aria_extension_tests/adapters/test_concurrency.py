@@ -0,0 +1,97 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import time
+import threading
+from collections import namedtuple
+
+import pytest
+
+from adapters import (concurrency, scheduling)
+
+
+_Execution = namedtuple('_Execution', 'id, service')
+_Service = namedtuple('_Service', 'name')
+_Task = namedtuple('_Task', 'id, execution')
+
+
+def _task_sent(task, cancelled=None):
+    # Without a scheduler, only the concurrency limit is waited for
+    scheduling.task_sent(task, cancelled, env={})
+
+
+class TestConcurrencyLimit(object):
+
+    def test_limit(self, execution):
+        concurrency.set_limit(execution.id, 2)
+        tasks = [_Task(i, execution) for i in range(3)]
+        _task_sent(tasks[0])
+        _task_sent(tasks[1])
+
+        sent = threading.Event()
+        thread = threading.Thread(target=lambda: (_task_sent(tasks[2]), sent.set()))
+        thread.daemon = True
+        thread.start()
+        assert not sent.wait(0.2)
+
+        concurrency.task_ended(tasks[0])
+        assert sent.wait(5)
+        assert concurrency.get_limit(execution.id).running == 2
+
+    def test_tasks_which_were_not_sent_are_ignored(self, execution):
+        concurrency.set_limit(execution.id, 1)
+        concurrency.task_ended(_Task('stub', execution))
+        _task_sent(_Task(1, execution))
+        assert concurrency.get_limit(execution.id).running == 1
+
+    def test_clear_limit_releases_waiting_tasks(self, execution):
+        concurrency.set_limit(execution.id, 1)
+        _task_sent(_Task(1, execution))
+        thread = threading.Thread(target=_task_sent, args=(_Task(2, execution), ))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.1)
+        concurrency.clear_limit(execution.id)
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_cancellation_releases_waiting_tasks(self, execution):
+        concurrency.set_limit(execution.id, 1)
+        _task_sent(_Task(1, execution))
+        cancelled = threading.Event()
+        thread = threading.Thread(target=_task_sent,
+                                  args=(_Task(2, execution), cancelled.is_set))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.1)
+        assert thread.is_alive()
+        cancelled.set()
+        thread.join(5)
+        assert not thread.is_alive()
+        # The task was let through without a slot
+        assert concurrency.get_limit(execution.id).running == 1
+
+    def test_no_limit(self, execution):
+        concurrency.set_limit(execution.id, None)
+        assert concurrency.get_limit(execution.id) is None
+        for i in range(10):
+            _task_sent(_Task(i, execution))
+
+    @pytest.fixture
+    def execution(self):
+        execution = _Execution(id=1, service=_Service('service'))
+        yield execution
+        concurrency.clear_limit(execution.id)
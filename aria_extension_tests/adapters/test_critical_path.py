@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import json
+
+import pytest
+
+from aria.orchestrator import execution_preparer
+from aria.orchestrator.workflows.executor import process
+
+from adapters import (concurrency, critical_path, scheduling)
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+topology_template:
+  node_templates:
+    vm:
+      type: tosca.nodes.Compute
+      interfaces:
+        Standard:
+          create: cloudify_aws.ec2.instance.create
+          start: cloudify_aws.ec2.instance.start
+    app1: &app
+      type: tosca.nodes.Root
+      interfaces:
+        Standard:
+          create: scripts/create.sh
+    app2: *app
+    app3: *app
+"""
+
+
+class _Task(object):
+
+    def __init__(self, task_id, *dependencies):
+        self.id = task_id
+        self.dependencies = list(dependencies)
+
+
+@pytest.fixture
+def env(tmpdir):
+    return {critical_path.DURATION_HISTORY_ENV_VAR: str(tmpdir.join('durations.db'))}
+
+
+@pytest.fixture
+def execution(core, service):
+    ctx = execution_preparer.ExecutionPreparer(
+        core.model_storage, core.resource_storage, None, service, 'install'
+    ).prepare(executor=process.ProcessExecutor(plugin_manager=None))
+    concurrency.set_limit(ctx.execution.id, 1)
+    yield ctx.execution
+    concurrency.clear_limit(ctx.execution.id)
+    critical_path.execution_ended(ctx.execution.id)
+
+
+def _released(execution):
+    return sorted(task for task in execution.tasks
+                  if task.function and task.is_waiting() and
+                  task.due_at != critical_path.HELD)
+
+
+class TestCriticalPath(object):
+
+    def test_critical_paths(self):
+        start = _Task('start')
+        short = _Task('short', start)
+        long_ = _Task('long', start)
+        end = _Task('end', short, long_)
+        durations = {'start': 1, 'short': 2, 'long': 10, 'end': 3}
+        paths = critical_path.critical_paths([end, short, long_, start],
+                                             lambda task: durations[task.id])
+        assert paths == {'end': 3, 'short': 5, 'long': 13, 'start': 14}
+
+    def test_duration_history(self, env):
+        history = critical_path.from_environment(env)
+        assert history.median('tosca.nodes.Compute', 'Standard.create') is None
+        for duration in (30, 10, 20):
+            history.record('tosca.nodes.Compute', 'Standard.create', duration)
+        assert history.median('tosca.nodes.Compute', 'Standard.create') == 20
+        assert critical_path.from_environment({}) is None
+
+    def test_longest_chain_first(self, core, env, execution):
+        history = critical_path.from_environment(env)
+        history.record('tosca.nodes.Compute', 'Standard.create', 120)
+        model = core.model_storage
+        critical_path.workflow_started(model, execution, env)
+        released = _released(execution)
+        assert [(task.node.name, task.operation_name) for task in released] == \
+            [('vm_1', 'create')]
+
+        vm_create = released[0]
+        vm_create.status = vm_create.SUCCESS
+        model.task.update(vm_create)
+        critical_path.task_ended(vm_create, env=env)
+        assert len(_released(execution)) == 1
+
+        critical_path.execution_ended(execution.id)
+        assert not any(task.due_at == critical_path.HELD for task in execution.tasks)
+
+    def test_held_tasks_reset(self, core, env, execution):
+        model = core.model_storage
+        for task in execution.tasks:
+            task.due_at = critical_path.HELD
+            model.task.update(task)
+        # Without a duration history, tasks are not prioritized
+        critical_path.workflow_started(model, execution, {})
+        assert not any(task.due_at == critical_path.HELD for task in execution.tasks)
+
+    def test_scheduler_limit(self, core, env, service, tmpdir):
+        ctx = execution_preparer.ExecutionPreparer(
+            core.model_storage, core.resource_storage, None, service, 'install'
+        ).prepare(executor=process.ProcessExecutor(plugin_manager=None))
+        config = tmpdir.join('scheduler.json')
+        config.write(json.dumps({'state_file': str(tmpdir.join('state.json')),
+                                 'max_workers': 8, 'max_workers_per_execution': 2}))
+        env = dict(env, **{scheduling.SCHEDULER_ENV_VAR: str(config)})
+        try:
+            critical_path.workflow_started(core.model_storage, ctx.execution, env)
+            # The four create operations are ready, and the scheduler runs two at a time
+            assert len(_released(ctx.execution)) == 2
+        finally:
+            critical_path.execution_ended(ctx.execution.id)
+
+    def test_gate_releases_by_priority(self):
+        start = _GateTask('start')
+        short = _GateTask('short', start)
+        long_ = _GateTask('long', start)
+        stub = _GateTask('stub', long_, function=None)
+        end = _GateTask('end', short, stub)
+        gate = critical_path.PriorityGate(_Model(), [start, short, long_, stub, end],
+                                          {'start': 3, 'short': 1, 'long': 2, 'end': 1}, 1)
+        gate.start()
+        assert gate.held() == set(['short', 'long', 'end'])
+        gate.task_ended(start)
+        assert gate.held() == set(['short', 'end'])
+        gate.task_ended(long_)
+        # The stub task ended with its dependency, but end still waits for short
+        assert gate.held() == set(['end'])
+        gate.task_ended(short, retrying=True)
+        assert gate.held() == set(['end'])
+        gate.task_ended(short)
+        assert gate.held() == set()
+
+
+class _GateTask(_Task):
+    _stub_type = None
+
+    def __init__(self, task_id, *dependencies, **kwargs):
+        super(_GateTask, self).__init__(task_id, *dependencies)
+        self.function = kwargs.get('function', 'module.function')
+        self.due_at = None
+
+    def has_ended(self):
+        return False
+
+    def is_waiting(self):
+        return self.id != 'start'
+
+
+class _Model(object):
+
+    class task(object):
+
+        @staticmethod
+        def update(task):
+            pass
@@ -0,0 +1,175 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import sys
+import socket
+import subprocess
+
+import pytest
+
+from aria.orchestrator import (execution_preparer, operation)
+from aria.orchestrator.exceptions import TaskRetryException
+from aria.orchestrator.workflows.core import engine
+
+from adapters import distributed
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+topology_template:
+  node_templates:
+    vm1: &vm
+      type: tosca.nodes.Compute
+      interfaces:
+        Standard:
+          create: create.sh
+          start: start.sh
+    vm2: *vm
+"""
+
+SECRET = 'secret'
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@operation
+def _record_worker(ctx, **_):
+    ctx.node.attributes['worker'] = os.getppid()
+
+
+@operation
+def _retry_once(ctx, **_):
+    attempts = ctx.node.attributes.get('attempts', 0) + 1
+    ctx.node.attributes['attempts'] = attempts
+    if attempts == 1:
+        raise TaskRetryException('Not ready yet', retry_interval=0)
+
+
+@operation
+def _fail(ctx, **_):
+    raise RuntimeError('Operation failed')
+
+
+def _start_worker(secret=SECRET):
+    env = dict(os.environ, PYTHONPATH=REPOSITORY_DIR)
+    env[distributed.WORKER_SECRET_ENV_VAR] = secret
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'adapters.distributed', '--port', '0', '--max-processes', '2'],
+        cwd=REPOSITORY_DIR, env=env, stdout=subprocess.PIPE)
+    address = proc.stdout.readline().split()[-1]
+    return proc, address
+
+
+@pytest.fixture
+def workers():
+    started = [_start_worker(), _start_worker()]
+    yield started
+    for proc, _ in started:
+        proc.terminate()
+        proc.wait()
+
+
+def _unused_address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = distributed.format_address(sock.getsockname())
+    sock.close()
+    return address
+
+
+def _run(core, service, executor, function, max_attempts=1):
+    model = core.model_storage
+    ctx = execution_preparer.ExecutionPreparer(
+        model, core.resource_storage, None, service, 'install').prepare(executor=executor)
+    for task in ctx.execution.tasks:
+        if task.function:
+            task.function = '{0}.{1}'.format(__name__, function.__name__)
+            task.arguments.clear()
+            task.max_attempts = max_attempts
+            task.retry_interval = 0
+            model.task.update(task)
+    try:
+        engine.Engine(executor).execute(ctx)
+    finally:
+        executor.close()
+    return model.execution.get(ctx.execution.id)
+
+
+def _executor(addresses, secret=SECRET):
+    return distributed.DistributedProcessExecutor(workers=addresses, secret=secret,
+                                                  distribute=lambda task: True)
+
+
+class TestDistributedProcessExecutor(object):
+
+    def test_operations_run_on_workers(self, core, service, workers):
+        execution = _run(core, service, _executor([address for _, address in workers]),
+                         _record_worker)
+        assert execution.status == execution.SUCCEEDED
+        used = set(node.attributes['worker'].value for node in execution.service.nodes.values())
+        assert used == set(proc.pid for proc, _ in workers)
+
+    def test_retries(self, core, service, workers):
+        execution = _run(core, service, _executor([workers[0][1]]), _retry_once, max_attempts=2)
+        assert execution.status == execution.SUCCEEDED
+        for node in execution.service.nodes.itervalues():
+            # The create operation was retried, the start one was not
+            assert node.attributes['attempts'].value == 3
+
+    def test_failures(self, core, service, workers):
+        # Unreachable workers are skipped
+        with pytest.raises(Exception):
+            _run(core, service, _executor([_unused_address(), workers[0][1]]), _fail)
+        tasks = [task for task in core.model_storage.task.list() if task.function]
+        assert any(task.status == task.FAILED for task in tasks)
+        assert not any(task.status == task.SUCCESS for task in tasks)
+
+    def test_messages_signed(self, core, service, workers):
+        with pytest.raises(Exception):
+            _run(core, service, _executor([workers[0][1]], secret='other'), _record_worker)
+        assert not any('worker' in node.attributes for node in service.nodes.itervalues())
+
+        left, right = socket.socketpair()
+        distributed.send_frame(left, 'message', SECRET)
+        with pytest.raises(ValueError):
+            distributed.recv_frame(right, 'other')
+        distributed.send_frame(left, 'message', SECRET)
+        assert distributed.recv_frame(right, SECRET) == 'message'
+        left.close()
+        assert distributed.recv_frame(right, SECRET) is None
+
+    def test_secret_required(self, monkeypatch):
+        monkeypatch.delenv(distributed.WORKER_SECRET_ENV_VAR, raising=False)
+        with pytest.raises(ValueError):
+            distributed.DistributedProcessExecutor(workers=['127.0.0.1:7711'])
+        with pytest.raises(ValueError):
+            distributed.Worker(port=0, secret='')
+        with pytest.raises(SystemExit):
+            distributed.main(['--port', '0'])
+
+    def test_sqlite_storage_stays_on_host(self, core, service):
+        # Documentation address, which is not of this host
+        with pytest.raises(Exception):
+            _run(core, service, _executor(['192.0.2.1:7711']), _record_worker)
+        failed = [task for task in core.model_storage.task.list() if task.function]
+        assert any(task.status == task.FAILED for task in failed)
+        assert not any('worker' in node.attributes for node in service.nodes.itervalues())
+        assert distributed.is_local_address('localhost')
+        assert not distributed.is_local_address('192.0.2.1')
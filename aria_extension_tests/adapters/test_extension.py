@@ -0,0 +1,64 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import sys
+import json
+import subprocess
+
+import adapters
+
+
+# Time loading the extension may add to every ARIA command, in seconds
+IMPORT_BUDGET = 0.05
+
+_IMPORT_SCRIPT = """
+import sys
+import json
+import time
+
+# Imported by ARIA before it loads the extensions
+import aria.extension
+import aria.orchestrator.events
+
+loaded = set(name for name, module in sys.modules.items() if module is not None)
+start = time.time()
+import adapters.extension
+duration = time.time() - start
+print(json.dumps({
+    'duration': duration,
+    'modules': sorted(name for name, module in sys.modules.items()
+                      if module is not None and name not in loaded)
+}))
+"""
+
+
+def _import_extension():
+    output = subprocess.check_output(
+        [sys.executable, '-c', _IMPORT_SCRIPT],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(adapters.__file__))))
+    return json.loads(output.splitlines()[-1])
+
+
+class TestExtensionLoading(object):
+
+    def test_adapters_not_imported(self):
+        assert _import_extension()['modules'] == ['adapters', 'adapters.extension']
+
+    def test_import_budget(self):
+        # The fastest of a few runs, so a busy host doesn't fail the test
+        duration = min(_import_extension()['duration'] for _ in range(3))
+        assert duration < IMPORT_BUDGET
@@ -0,0 +1,127 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import mmap
+import tempfile
+
+import pytest
+
+from adapters import memory_profiling
+
+
+_leaked = []
+
+
+class _Leak(object):
+    pass
+
+
+def _leak(size):
+    # Mapped memory, as freed heap memory may be reused without growing the RSS
+    memory = mmap.mmap(-1, size)
+    for offset in range(0, size, mmap.PAGESIZE):
+        memory[offset] = 'x'
+    _leaked.append((_Leak(), memory))
+
+
+@pytest.fixture
+def profile_dir(tmpdir):
+    return str(tmpdir.join('profiles'))
+
+
+def _profile(profile_dir, task_id, operation):
+    return memory_profiling.MemoryProfiler(
+        profile_dir, execution_id=1, task_id=task_id,
+        args={'operation': operation, 'function': 'plugin.tasks.run', 'node': 'vm_1'}).profile()
+
+
+class _Logger(object):
+
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+class _Execution(object):
+    id = 1
+
+
+class TestMemoryProfiling(object):
+
+    def test_growing_operation(self, profile_dir):
+        for task_id in range(3):
+            with _profile(profile_dir, task_id, 'Standard.create'):
+                _leak((task_id + 1) * memory_profiling.RETAINED_THRESHOLD)
+            with _profile(profile_dir, task_id + 10, 'Standard.start'):
+                [_Leak() for _ in range(1000)]
+
+        logger = _Logger()
+        profile = memory_profiling.execution_ended(
+            _Execution(), logger, {memory_profiling.MEMORY_PROFILE_DIR_ENV_VAR: profile_dir})
+        assert memory_profiling.growing_operations(profile) == ['Standard.create']
+        create = profile['operations']['Standard.create']
+        assert create['invocations'] == 3
+        assert create['retained_growth'] >= memory_profiling.RETAINED_THRESHOLD
+        assert create['peak_rss'] >= create['median_retained']
+        assert create['object_growth'][u'{0}._Leak'.format(__name__)] == 3
+        assert u'{0}._Leak'.format(__name__) not in profile['operations']['Standard.start'][
+            'object_growth']
+        assert len(logger.warnings) == 1 and 'Standard.create' in logger.warnings[0]
+        del _leaked[:]
+
+        # The report is kept, and merged with records of later operations
+        with _profile(profile_dir, 20, 'Standard.start'):
+            pass
+        profile = memory_profiling.report(profile_dir, 1)
+        assert profile['operations']['Standard.start']['invocations'] == 4
+        assert sorted(os.listdir(profile_dir)) == ['1.json']
+
+    def test_retained_growth(self):
+        threshold = memory_profiling.RETAINED_THRESHOLD
+
+        def aggregate(retained, pids=None):
+            records = [{'operation': 'Standard.create', 'function': None, 'pid': pid,
+                        'retained': amount, 'peak_rss': 0, 'object_growth': {},
+                        'temp_files': []}
+                       for amount, pid in zip(retained, pids or range(len(retained)))]
+            return memory_profiling.aggregate(records)['Standard.create']
+
+        # The same memory retained by every operation process is not a leak
+        constant = aggregate([4 * threshold] * 5)
+        assert constant['retained_growth'] == 0 and not constant['growing']
+        assert aggregate([threshold, 2 * threshold, 3 * threshold])['growing']
+        assert not aggregate([threshold, 2 * threshold])['growing']
+        # Unless the processes run more than one invocation, and it adds up
+        assert aggregate([threshold] * 3, pids=[1] * 3)['growing']
+
+    def test_temp_files(self, profile_dir):
+        with _profile(profile_dir, 1, 'Standard.create'):
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+        try:
+            profile = memory_profiling.report(profile_dir, 1)
+        finally:
+            os.remove(path)
+        assert profile['invocations'][0]['temp_files'] == [path]
+        assert profile['operations']['Standard.create']['temp_files'] == 1
+
+    def test_disabled(self):
+        assert memory_profiling.execution_ended(_Execution(), _Logger(), {}) is None
+        with memory_profiling.operation_profiler(None, {}):
+            pass
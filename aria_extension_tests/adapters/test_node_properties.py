@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import sys
+import copy
+import time
+import pickle
+
+import pytest
+
+from aria.modeling import models
+from aria.orchestrator.context.common import BaseContext
+
+from adapters import context_adapter
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+topology_template:
+  node_templates:
+    group:
+      type: tosca.nodes.Root
+"""
+
+RULES = [{'ip_protocol': 'tcp', 'from_port': port, 'to_port': port,
+          'cidr_ip': '10.0.{0}.0/24'.format(port % 256),
+          'tags': {'owner': {'name': 'team', 'contacts': [{'email': 'team@example.com'}]}}}
+         for port in range(200)]
+
+
+@pytest.fixture
+def model(core, service):
+    model = core.model_storage
+    node = model.node.get_by_name('group_1')
+    node.properties['rules'] = models.Property.wrap('rules', copy.deepcopy(RULES))
+    node.properties['name'] = models.Property.wrap('name', 'web')
+    model.node.update(node)
+    return model
+
+
+RULES_VIEW = {'rules': RULES}
+
+# Timings are too noisy on shared hosts to be asserted on
+BENCHMARK_ENV_VAR = 'ARIA_CLOUDIFY_BENCHMARKS'
+
+
+class _CountingNode(object):
+    """
+    Node counting how many times its properties are read.
+    """
+
+    def __init__(self, node):
+        self._node = node
+        self.properties_reads = 0
+
+    def __getattr__(self, name):
+        return getattr(self._node, name)
+
+    @property
+    def properties(self):
+        self.properties_reads += 1
+        return self._node.properties
+
+
+def _node_adapter(node):
+    return context_adapter.NodeAdapter(None, node.node_template, node)
+
+
+def _read_rules(properties):
+    # Builds a request payload the way security group plugins do
+    payload = []
+    for index in range(len(properties['rules'])):
+        payload.append({
+            'IpProtocol': properties['rules'][index]['ip_protocol'],
+            'FromPort': properties['rules'][index]['from_port'],
+            'ToPort': properties['rules'][index]['to_port'],
+            'CidrIp': properties['rules'][index]['cidr_ip'],
+            'Owner': properties['rules'][index]['tags']['owner']['contacts'][0]['email']})
+    return payload
+
+
+class TestNodeProperties(object):
+
+    def test_plain_values(self, model):
+        properties = _node_adapter(model.node.get_by_name('group_1')).properties
+        assert properties == {'rules': RULES, 'name': 'web'}
+        assert type(properties['rules'][0]['tags']) is dict
+
+        with pytest.raises(TypeError):
+            properties['name'] = 'db'
+        with pytest.raises(TypeError):
+            properties.update(name='db')
+        assert type(copy.deepcopy(properties)) is dict
+        assert pickle.loads(pickle.dumps(properties)) == properties
+
+    def test_cached_until_changed(self, model):
+        with model.instrument(*BaseContext.INSTRUMENTATION_FIELDS):
+            node = model.node.get_by_name('group_1')
+            adapter = _node_adapter(node)
+            properties = adapter.properties
+            assert properties['name'] == 'web'
+            assert adapter.properties is properties
+
+            node.properties['name'] = 'db'
+            assert adapter.properties is not properties
+            assert adapter.properties['name'] == 'db'
+
+            node.properties['zone'] = 'a'
+            assert adapter.properties['zone'] == 'a'
+
+    def test_built_once(self, model, monkeypatch):
+        with model.instrument(*BaseContext.INSTRUMENTATION_FIELDS):
+            node = _CountingNode(model.node.get_by_name('group_1'))
+            views = []
+            monkeypatch.setattr(context_adapter, 'PropertiesView',
+                                lambda values: views.append(values) or dict(values))
+            adapter = _node_adapter(node)
+            for _ in range(20):
+                assert _read_rules(adapter.properties) == _read_rules(RULES_VIEW)
+        assert len(views) == 1
+        assert node.properties_reads == 1
+
+    @pytest.mark.skipif(not os.environ.get(BENCHMARK_ENV_VAR),
+                        reason='benchmarks run only when {0} is set'.format(BENCHMARK_ENV_VAR))
+    def test_benchmark(self, model):
+        with model.instrument(*BaseContext.INSTRUMENTATION_FIELDS):
+            node = model.node.get_by_name('group_1')
+            adapter = _node_adapter(node)
+            assert _read_rules(adapter.properties) == _read_rules(node.properties)
+
+            start = time.time()
+            for _ in range(20):
+                _read_rules(node.properties)
+            instrumented = time.time() - start
+            start = time.time()
+            for _ in range(20):
+                _read_rules(adapter.properties)
+            cached = time.time() - start
+
+        sys.stdout.write(u'Instrumented properties: {0:.3f}s, cached view: {1:.3f}s\n'.format(
+            instrumented, cached))
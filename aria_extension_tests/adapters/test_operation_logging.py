@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import logging
+
+import pytest
+from sqlalchemy import event
+
+from aria import logger as aria_logger
+from aria.modeling import models
+from aria.orchestrator.context import operation
+
+from adapters import operation_logging
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+topology_template:
+  node_templates:
+    vm:
+      type: tosca.nodes.Compute
+      interfaces:
+        Standard:
+          create: create.sh
+"""
+
+
+class _Handler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def handler():
+    handler = _Handler()
+    logger = logging.getLogger(__name__)
+    logger.addHandler(handler)
+    yield handler
+    logger.removeHandler(handler)
+
+
+@pytest.fixture
+def logger_factory(handler):
+    def factory(**kwargs):
+        return operation_logging.BufferedLogger(logging.getLogger(__name__), task_id=1, **kwargs)
+    return factory
+
+
+def _messages(records):
+    return [record.getMessage() for record in records]
+
+
+class TestLevels(object):
+
+    def test_operation_level(self):
+        levels = operation_logging.parse_levels(
+            'info, cloudify-aws-plugin=DEBUG, cloudify_aws.ec2.*=WARNING, Standard.delete=ERROR')
+        assert levels[0] == logging.INFO
+
+        def level(function, operation='Standard.create', plugin='cloudify-aws-plugin'):
+            return operation_logging.operation_level(levels, function, operation, plugin)
+        assert level('cloudify_aws.ec2.instance.create') == logging.WARNING
+        assert level('cloudify_aws.ec2.instance.delete', 'Standard.delete') == logging.WARNING
+        assert level('cloudify_aws.elb.create') == logging.DEBUG
+        assert level('cloudify_aws.elb.delete', 'Standard.delete') == logging.ERROR
+        assert level('script_runner.tasks.run', plugin='script') == logging.INFO
+
+        assert operation_logging.parse_levels('a=WARNING')[0] == logging.DEBUG
+        with pytest.raises(ValueError):
+            operation_logging.parse_levels('INFO,a=LOUD')
+
+    def test_disabled(self):
+        assert operation_logging.operation_logger(None, {}) is None
+
+
+class TestBufferedLogger(object):
+
+    def test_batches(self, logger_factory, handler):
+        logger = logger_factory(level=logging.INFO, flush_size=3, flush_interval=60)
+        for i in range(4):
+            logger.info('info %d', i)
+            logger.debug('debug %d', i)
+        assert _messages(handler.records) == ['info 0', 'info 1', 'info 2']
+        assert handler.records[0].task_id == 1
+        assert handler.records[0].name == __name__
+
+        logger.flush()
+        assert _messages(handler.records[3:]) == ['info 3']
+        # Records below the level are dropped once the operation succeeded
+        logger.flush(failed=True)
+        assert len(handler.records) == 4
+
+    def test_failure_dumps_buffer(self, logger_factory, handler):
+        logger = logger_factory(level=logging.WARNING, buffer_size=3, flush_interval=60)
+        for i in range(5):
+            logger.debug('debug %d', i)
+        logger.warning('warning')
+        logger.info('info')
+        logger.flush(failed=True)
+        assert _messages(handler.records) == ['debug 3', 'debug 4', 'warning', 'info']
+
+    def test_exception(self, logger_factory, handler):
+        logger = logger_factory()
+        try:
+            raise RuntimeError('failed')
+        except RuntimeError:
+            logger.exception('Operation failed')
+        logger.flush()
+        assert handler.records[0].exc_info[0] is RuntimeError
+        assert 'RuntimeError: failed' in handler.records[0].traceback
+
+
+class TestOperationLogger(object):
+
+    def test_handlers(self, core, prepare_execution, tmpdir, monkeypatch):
+        model = core.model_storage
+        execution_ctx = prepare_execution('install')
+        task = [task for task in execution_ctx.execution.tasks if task.function][0]
+        ctx = operation.NodeOperationContext(
+            name='test', model_storage=model, resource_storage=core.resource_storage,
+            service_id=task.node.service.id, task_id=task.id, actor_id=task.node.id,
+            execution_id=execution_ctx.execution.id, workdir=str(tmpdir))
+        # The logger of operation contexts is shared, and its handlers write to the first storage
+        console = _Handler()
+        monkeypatch.setattr(logging.getLogger(aria_logger.TASK_LOGGER_NAME), 'handlers', [
+            aria_logger.create_sqla_log_handler(model, models.Log, ctx.task.execution.id),
+            console])
+        commits = []
+        event.listen(model._all_api_kwargs['engine'], 'commit',
+                     lambda connection: commits.append(connection))
+
+        logger = operation_logging.operation_logger(
+            ctx, {operation_logging.LOG_LEVELS_ENV_VAR: 'INFO'})
+        logger.info('Creating %s', 'vm')
+        logger.debug('Not written')
+        try:
+            raise RuntimeError('failed')
+        except RuntimeError:
+            logger.exception('Could not create vm')
+        logger.flush()
+
+        assert len(commits) == 1
+        assert _messages(console.records) == ['Creating vm', 'Could not create vm']
+        logs = sorted(model.log.list(), key=lambda log: log.id)
+        assert [(log.level, log.msg) for log in logs] == [('INFO', 'Creating vm'),
+                                                          ('ERROR', 'Could not create vm')]
+        assert logs[0].task.id == task.id
+        assert 'RuntimeError: failed' in logs[1].traceback
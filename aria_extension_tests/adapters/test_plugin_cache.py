@@ -0,0 +1,178 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import time
+import stat
+import shutil
+from collections import namedtuple
+
+import pytest
+
+from adapters import plugin_cache
+
+
+_Plugin = namedtuple('_Plugin', 'id, name, package_name, package_version, wheels, uploaded_at')
+_Execution = namedtuple('_Execution', 'tasks')
+_Service = namedtuple('_Service', 'id')
+
+
+class _Task(object):
+
+    def __init__(self, stub_type, plugin):
+        self._stub_type = stub_type
+        self.plugin = plugin
+
+
+class _WorkflowContext(object):
+
+    def __init__(self, workdir, tasks):
+        self._workdir = workdir
+        self.execution = _Execution(tasks)
+        self.service = _Service(1)
+
+
+class _OperationContext(object):
+
+    def __init__(self, workdir, plugin):
+        self._workdir = workdir
+        self.task = _Task(None, plugin)
+
+
+def _plugin(plugin_id=1, name='cloudify-aws-plugin', version='1.4.10', uploaded_at='2017-01-01'):
+    return _Plugin(plugin_id, name, name, version, ['cloudify_plugins_common-3.4.whl'],
+                   uploaded_at)
+
+
+class TestPluginEnvironmentCache(object):
+
+    def test_environment_key(self, source, tmpdir):
+        copy = str(tmpdir.join('copy'))
+        shutil.copytree(source, copy)
+        key = plugin_cache.environment_key(source)
+        # Compiled modules are written by whoever loads the plugin
+        tmpdir.join('copy', 'lib', 'module.pyc').write('compiled')
+        assert plugin_cache.environment_key(copy) == key
+        tmpdir.join('copy', 'lib', 'module.py').write('changed')
+        assert plugin_cache.environment_key(copy) != key
+        tmpdir.join('copy', 'lib', 'module.py').write('module')
+        tmpdir.join('copy', 'lib', 'extra.py').write('')
+        assert plugin_cache.environment_key(copy) != key
+
+    def test_add_plugin(self, cache, source, tmpdir, monkeypatch):
+        plugin = _plugin()
+        key = cache.add_plugin(plugin, source)
+        assert cache.plugin_key(plugin, source) == key == plugin_cache.environment_key(source)
+        # The environment of an installation is hashed once
+        monkeypatch.setattr(plugin_cache, 'environment_key', None)
+        assert cache.add_plugin(plugin, source) == key
+        assert cache.plugin_key(_plugin(uploaded_at='2017-02-01'), source) is None
+
+    def test_cache_plugins(self, cache, tmpdir):
+        workdir = tmpdir.mkdir('workdir')
+        aws, openstack = _plugin(1), _plugin(2, name='cloudify-openstack-plugin')
+        for plugin in (aws, openstack):
+            installed_dir = plugin_cache.installed_plugin_dir(str(workdir), plugin)
+            os.makedirs(os.path.join(installed_dir, 'lib'))
+            with open(os.path.join(installed_dir, 'lib', 'module.py'), 'w') as f:
+                f.write('module')
+        ctx = _WorkflowContext(str(workdir), [
+            _Task(None, aws), _Task(None, aws), _Task(None, openstack),
+            _Task('start', None), _Task(None, _plugin(3, name='script')._replace(wheels=[]))])
+        env = {plugin_cache.CACHE_DIR_ENV_VAR: cache.cache_dir}
+
+        # Plugins with the same content share an environment
+        key = plugin_cache.environment_key(plugin_cache.installed_plugin_dir(str(workdir), aws))
+        assert plugin_cache.cache_plugins(ctx, env) == [key, key]
+        assert cache.environments() == [key]
+        assert cache.collect_garbage() == []
+        assert workdir.join('plugins', '1', 'cloudify-aws-plugin').isdir()
+
+        for plugin in (aws, openstack):
+            assert plugin_cache.plugin_prefix(_OperationContext(str(workdir), plugin), env) == \
+                cache.get_environment(key)
+        # Plugins installed after the execution started use their installed environment
+        other = _plugin(4, version='1.5')
+        installed_dir = workdir.mkdir('plugins', 'cloudify-aws-plugin-1.5')
+        assert plugin_cache.plugin_prefix(_OperationContext(str(workdir), other), env) == \
+            str(installed_dir)
+        assert plugin_cache.plugin_prefix(_OperationContext(str(workdir), other), {}) is None
+
+    def test_add_environment_once(self, cache, source):
+        environment_dir = cache.add_environment('key', source)
+        shutil.rmtree(source)
+        assert cache.add_environment('key', source) == environment_dir
+        assert cache.environments() == ['key']
+        with open(os.path.join(environment_dir, 'lib', 'module.py')) as f:
+            assert f.read() == 'module'
+        assert not os.stat(os.path.join(environment_dir, 'lib', 'module.py')).st_mode & stat.S_IWUSR
+
+    def test_add_reference(self, cache, source, tmpdir):
+        cache.add_environment('key', source)
+        workdir = tmpdir.mkdir('workdir')
+        cache.add_reference('key', str(workdir))
+        cache.add_reference('key', str(workdir))
+        # The workdir is the plugin's own
+        assert workdir.listdir() == []
+        assert cache.collect_garbage() == []
+
+    def test_add_reference_to_missing_environment(self, cache, tmpdir):
+        with pytest.raises(ValueError):
+            cache.add_reference('key', str(tmpdir.mkdir('workdir')))
+
+    def test_recently_added_kept(self, cache, source, tmpdir):
+        past = time.time() - 7200
+        os.utime(source, (past, past))
+        cache.add_environment('key', source)
+        assert cache.collect_garbage(min_age=3600) == []
+        os.utime(cache.get_environment('key'), (past, past))
+        cache.add_reference('key', str(tmpdir.mkdir('workdir')))
+        shutil.rmtree(str(tmpdir.join('workdir')))
+        # Referenced recently
+        assert cache.collect_garbage(min_age=3600) == []
+        assert cache.collect_garbage() == ['key']
+
+    def test_collect_garbage(self, cache, source, tmpdir):
+        cache.add_environment('used', source)
+        cache.add_environment('unused', source)
+        cache.add_environment('removed', source)
+        cache.add_reference('used', str(tmpdir.mkdir('workdir1')))
+        cache.add_reference('removed', str(tmpdir.mkdir('workdir2')))
+        shutil.rmtree(str(tmpdir.join('workdir2')))
+
+        assert cache.collect_garbage(dry_run=True) == ['removed', 'unused']
+        assert cache.environments() == ['removed', 'unused', 'used']
+        assert cache.collect_garbage(min_age=3600) == []
+        assert cache.collect_garbage() == ['removed', 'unused']
+        assert cache.environments() == ['used']
+
+    def test_gc_command(self, cache, source, capsys):
+        cache.add_environment('unused', source)
+        assert plugin_cache.main(['--cache-dir', cache.cache_dir, 'gc', '--min-age', '0']) == 0
+        assert capsys.readouterr()[0] == 'removed unused\n'
+        assert cache.environments() == []
+
+    @pytest.fixture
+    def cache(self, tmpdir):
+        return plugin_cache.PluginEnvironmentCache(str(tmpdir.join('cache')))
+
+    @pytest.fixture
+    def source(self, tmpdir):
+        source = tmpdir.mkdir('source')
+        source.join('lib', 'module.py').write('module', ensure=True)
+        source.join('lib', 'other.py').write('other')
+        source.join('bin', 'tool').write('tool', ensure=True)
+        return str(source)
@@ -0,0 +1,164 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import json
+import time
+import urllib2
+import threading
+import collections
+import multiprocessing
+import BaseHTTPServer
+
+import pytest
+
+from adapters import rate_limiting
+
+
+RATE = 20
+BURST = 5
+
+
+class _StandInEndpoint(BaseHTTPServer.HTTPServer):
+    """
+    Stand-in for a cloud API, throttling clients which exceed ``RATE`` calls per second (plus
+    ``BURST``).
+    """
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+        self.calls = collections.deque()
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_port)
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            now = time.time()
+            while server.calls and server.calls[0] < now - 1:
+                server.calls.popleft()
+            throttled = len(server.calls) >= RATE + BURST
+            if throttled:
+                server.throttled += 1
+            else:
+                server.calls.append(now)
+        self.send_response(503 if throttled else 200)
+        self.end_headers()
+        self.wfile.write('RequestLimitExceeded' if throttled else 'OK')
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+def _call_endpoint(config_path, url, calls, results):
+    rate_limiter = rate_limiting.RateLimiter.from_file(config_path)
+    for _ in range(calls):
+        bucket = rate_limiter.get_bucket('cloudify_aws.ec2.instance.create',
+                                         inputs={'aws_config': {'ec2_region_name': 'eu-west-1'}})
+        bucket.acquire()
+        try:
+            urllib2.urlopen(url).read()
+            results.put(200)
+        except urllib2.HTTPError as e:
+            results.put(e.code)
+
+
+@pytest.fixture
+def endpoint():
+    server = _StandInEndpoint()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def config_path(tmpdir):
+    path = str(tmpdir.join('rate_limits.json'))
+    with open(path, 'w') as f:
+        json.dump({
+            'state_dir': str(tmpdir.join('state')),
+            'limits': [
+                {'family': 'ec2', 'functions': ['cloudify_aws.ec2.*'], 'rate': 1},
+                {'family': 'ec2', 'region': 'eu-west-1', 'functions': ['cloudify_aws.ec2.*'],
+                 'rate': RATE, 'burst': BURST},
+            ],
+            'throttle_backoff': 0.2,
+        }, f)
+    return path
+
+
+class TestRateLimiting(object):
+
+    def test_processes_share_limit(self, endpoint, config_path):
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_call_endpoint,
+                                           args=(config_path, endpoint.url, 10, results))
+                   for _ in range(3)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert [results.get() for _ in range(30)] == [200] * 30
+        assert endpoint.throttled == 0
+        assert time.time() - start >= float(30 - BURST) / RATE
+
+    def test_get_bucket(self, config_path):
+        rate_limiter = rate_limiting.RateLimiter.from_file(config_path)
+        assert rate_limiter.get_bucket('cloudify_openstack.nova_plugin.server.create') is None
+
+        regional = rate_limiter.get_bucket('cloudify_aws.ec2.instance.create',
+                                           properties={'region': 'eu-west-1'})
+        other = rate_limiter.get_bucket('cloudify_aws.ec2.instance.create',
+                                        properties={'region': 'us-east-1'})
+        unknown = rate_limiter.get_bucket('cloudify_aws.ec2.instance.create')
+        assert os.path.basename(regional.path) == 'ec2@eu-west-1.bucket'
+        assert os.path.basename(other.path) == 'ec2@us-east-1.bucket'
+        assert os.path.basename(unknown.path) == 'ec2@*.bucket'
+
+    def test_throttling_backs_off(self, config_path):
+        bucket = rate_limiting.RateLimiter.from_file(config_path).get_bucket(
+            'cloudify_aws.ec2.instance.create', properties={'region': 'eu-west-1'})
+        assert bucket.acquire() < 0.05
+
+        assert not bucket.throttled('Instance is not running yet')
+        assert bucket.acquire() < 0.05
+
+        assert bucket.throttled('An error occurred (RequestLimitExceeded)')
+        assert bucket.acquire() >= 0.2
+
+    def test_from_environment(self, config_path):
+        assert rate_limiting.from_environment({}) is None
+        rate_limiter = rate_limiting.from_environment(
+            {rate_limiting.RATE_LIMITS_ENV_VAR: config_path})
+        assert rate_limiter.get_bucket('cloudify_aws.ec2.instance.create') is not None
+
+    def test_invalid_limit(self):
+        with pytest.raises(ValueError):
+            rate_limiting.RateLimiter([{'family': 'ec2'}])
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+from collections import namedtuple
+
+import pytest
+
+from aria.modeling import models
+from aria.orchestrator import exceptions
+
+from adapters import (retry_history, utils)
+from adapters.context_adapter import OperationAdapter
+
+
+OPERATION = 'cloudify_aws.ec2.instance.start'
+DIMENSION = 'eu-west-1/t2.micro'
+
+_Task = namedtuple('_Task', 'id, function, attempts_count')
+
+
+class _RetriedTask(_Task):
+    retry = staticmethod(models.Task.retry)
+
+
+class _Context(object):
+
+    def __init__(self, task):
+        self.task = task
+
+
+@pytest.fixture
+def history(tmpdir):
+    return retry_history.RetryHistory(str(tmpdir.join('history', 'retries.db')))
+
+
+def _record(history, durations, dimension=DIMENSION):
+    for task_id, duration in enumerate(durations):
+        history.attempt_started(task_id, now=1000)
+        history.attempt_started(task_id, now=1010)
+        history.succeeded(task_id, OPERATION, dimension, attempts=3, now=1000 + duration)
+        history.ended(task_id)
+
+
+class TestRetryHistory(object):
+
+    def test_statistics(self, history):
+        assert history.statistics(OPERATION, DIMENSION) is None
+        _record(history, [20, 40, 180])
+        assert history.statistics(OPERATION, DIMENSION) == {
+            'samples': 3, 'attempts': 3, 'duration': 40}
+        assert history.statistics(OPERATION, 'us-east-1/t2.micro') is None
+
+    def test_suggest_retry_after(self, history):
+        _record(history, [20, 20])
+        assert history.suggest_retry_after(OPERATION, DIMENSION, elapsed=0, default=30) == 30
+
+        _record(history, [20, 20, 60, 60, 180, 180])
+        assert history.suggest_retry_after(OPERATION, DIMENSION, elapsed=5, default=30) == 55
+        assert history.suggest_retry_after(OPERATION, DIMENSION, elapsed=160, default=30) == 20
+        assert history.suggest_retry_after(OPERATION, DIMENSION, elapsed=179.5, default=30) == 1
+        assert history.suggest_retry_after(OPERATION, DIMENSION, elapsed=200, default=30) == 30
+
+    def test_ended_attempts_not_recorded(self, history):
+        history.attempt_started('failed', now=1000)
+        history.ended('failed')
+        assert history.elapsed('failed') is None
+        history.succeeded('failed', OPERATION, DIMENSION, attempts=1, now=1020)
+        assert history.statistics(OPERATION, DIMENSION) is None
+
+    @pytest.mark.parametrize('override, retry_after', [(False, 30), (True, 60)])
+    def test_operation_history(self, history, override, retry_after):
+        _record(history, [60, 60, 60])
+        operation_history = retry_history.OperationHistory(
+            history, _Task(id='task', function=OPERATION, attempts_count=1), DIMENSION,
+            override=override)
+        assert operation_history.suggested_retry_after(30) == 30
+
+        operation_history.attempt_started()
+        assert operation_history.retry_after(30) == pytest.approx(retry_after, abs=1)
+
+    def test_schema_created_once(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join('retries.db'))
+        retry_history.from_environment({retry_history.RETRY_HISTORY_ENV_VAR: path})
+        connections = []
+        sqlite_transaction = utils.sqlite_transaction
+        monkeypatch.setattr(utils, 'sqlite_transaction',
+                            lambda path: connections.append(path) or sqlite_transaction(path))
+        history = retry_history.from_environment({retry_history.RETRY_HISTORY_ENV_VAR: path})
+        assert connections == []
+        assert history.statistics(OPERATION, DIMENSION) is None
+
+    def test_retried_through_operation(self, history, monkeypatch):
+        now = [1000]
+        monkeypatch.setattr(retry_history.time, 'time', lambda: now[0])
+        task = _RetriedTask(id='task', function=OPERATION, attempts_count=3)
+        operation_history = retry_history.OperationHistory(history, task, DIMENSION, key='a:1:2')
+        operation = OperationAdapter(_Context(task), operation_history)
+        for _ in range(2):
+            with pytest.raises(exceptions.TaskRetryException):
+                with retry_history.attempt(operation_history):
+                    operation.retry('Not ready', retry_after=10)
+            now[0] += 10
+        with retry_history.attempt(operation_history):
+            pass
+
+        assert history.elapsed('a:1:2') is None
+        assert history.statistics(OPERATION, DIMENSION) == {
+            'samples': 1, 'attempts': 3, 'duration': 20}
+
+    def test_failed_attempt_ended(self, history):
+        operation_history = retry_history.OperationHistory(
+            history, _Task(id='task', function=OPERATION, attempts_count=1), DIMENSION)
+        with pytest.raises(RuntimeError):
+            with retry_history.attempt(operation_history):
+                raise RuntimeError('failed')
+        assert history.elapsed('task') is None
+        assert history.statistics(OPERATION, DIMENSION) is None
+
+    def test_dimension(self):
+        assert retry_history.dimension(
+            {'aws_config': {'ec2_region_name': 'eu-west-1'}},
+            {'instance_type': 't2.micro'}) == 'eu-west-1/t2.micro'
+        assert retry_history.dimension({}, {'server': {'flavor': 'm1.small'}}) == '*/m1.small'
+        assert retry_history.dimension(None, None) == '*/*'
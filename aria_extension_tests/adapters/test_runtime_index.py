@@ -0,0 +1,129 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import pytest
+
+from aria.modeling import models
+
+from adapters import runtime_index
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+topology_template:
+  node_templates:
+    vm:
+      type: tosca.nodes.Compute
+    db:
+      type: tosca.nodes.Compute
+"""
+
+
+@pytest.fixture
+def env(tmpdir):
+    return {runtime_index.RUNTIME_INDEX_ENV_VAR: str(tmpdir.join('index', 'runtime.db')),
+            runtime_index.RUNTIME_INDEX_KEYS_ENV_VAR: 'aws_resource_id, external_id'}
+
+
+@pytest.fixture
+def index(env):
+    return runtime_index.from_environment(env)
+
+
+class TestRuntimePropertiesIndex(object):
+
+    def test_lookup(self, index):
+        index.update(1, 10, {'aws_resource_id': 'i-1234', 'state': 'running'})
+        index.update(1, 11, {'aws_resource_id': 'i-5678', 'external_id': 42})
+        index.update(2, 20, {'aws_resource_id': 'i-1234'})
+
+        assert index.lookup(1, 'aws_resource_id', 'i-1234') == [10]
+        assert index.lookup(1, 'external_id', 42) == [11]
+        assert index.lookup(1, 'external_id', '42') == []
+        assert index.lookup(2, 'aws_resource_id', 'i-1234') == [20]
+        with pytest.raises(ValueError):
+            index.lookup(1, 'state', 'running')
+
+    def test_update_replaces_values(self, index):
+        index.update(1, 10, {'aws_resource_id': 'i-1234'})
+        index.update(1, 10, {'aws_resource_id': 'i-5678'})
+        assert index.lookup(1, 'aws_resource_id', 'i-1234') == []
+        assert index.lookup(1, 'aws_resource_id', 'i-5678') == [10]
+
+        index.update(1, 10, {'aws_resource_id': {'not': 'a scalar'}})
+        assert index.lookup(1, 'aws_resource_id', 'i-5678') == []
+
+        index.clear(1)
+        index.update(1, 11, {'external_id': 'x'})
+        assert index.lookup(1, 'external_id', 'x') == [11]
+
+    def test_index_nodes(self, core, service, env, index):
+        model = core.model_storage
+        vm = model.node.get_by_name('vm_1')
+        db = model.node.get_by_name('db_1')
+        vm.attributes['aws_resource_id'] = models.Attribute.wrap('aws_resource_id', 'i-1234')
+        model.node.update(vm)
+        db.attributes['aws_resource_id'] = models.Attribute.wrap('aws_resource_id', 'i-5678')
+        model.node.update(db)
+
+        runtime_index.index_nodes(service.id, [vm], env)
+        assert index.lookup(service.id, 'aws_resource_id', 'i-1234') == [vm.id]
+        assert index.lookup(service.id, 'aws_resource_id', 'i-5678') == []
+
+        runtime_index.rebuild(model, service, env)
+        assert index.lookup(service.id, 'aws_resource_id', 'i-5678') == [db.id]
+
+    def test_disabled(self, service):
+        assert runtime_index.from_environment({}) is None
+        runtime_index.index_nodes(service.id, service.nodes.values(), {})
+
+    def test_find_nodes_checks_model(self, core, service, env, index):
+        model = core.model_storage
+        vm = model.node.get_by_name('vm_1')
+        db = model.node.get_by_name('db_1')
+        for node in (vm, db):
+            node.attributes['aws_resource_id'] = models.Attribute.wrap('aws_resource_id', 'i-1234')
+            model.node.update(node)
+        runtime_index.rebuild(model, service, env)
+        index.update(service.id, 'removed', {'aws_resource_id': 'i-1234'})
+        nodes = runtime_index.find_nodes(index, model, service.id, 'aws_resource_id', 'i-1234')
+        assert sorted(node.name for node in nodes) == ['db_1', 'vm_1']
+
+        vm.state = models.Node.DELETED
+        model.node.update(vm)
+        db.attributes['aws_resource_id'].value = 'i-5678'
+        model.node.update(db)
+        assert runtime_index.find_nodes(index, model, service.id, 'aws_resource_id',
+                                        'i-1234') == []
+        assert index.lookup(service.id, 'aws_resource_id', 'i-1234') == []
+        assert index.lookup(service.id, 'aws_resource_id', 'i-5678') == [db.id]
+
+    def test_prune(self, core, service, env, index):
+        model = core.model_storage
+        vm = model.node.get_by_name('vm_1')
+        db = model.node.get_by_name('db_1')
+        index.update(service.id, vm.id, {'aws_resource_id': 'i-1234'})
+        index.update(service.id, db.id, {'aws_resource_id': 'i-5678'})
+        index.update(service.id, 'removed', {'aws_resource_id': 'i-1234'})
+        vm.state = models.Node.DELETED
+        model.node.update(vm)
+
+        assert sorted(runtime_index.prune(model, env)) == sorted([vm.id, 'removed'])
+        assert index.node_ids() == [db.id]
@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import json
+import time
+import threading
+import subprocess
+from collections import namedtuple
+
+import pytest
+
+from adapters import (concurrency, scheduling)
+
+
+_Service = namedtuple('_Service', 'name')
+_Execution = namedtuple('_Execution', 'id, service')
+_Task = namedtuple('_Task', 'id, execution')
+
+
+@pytest.fixture
+def scheduler_factory(tmpdir):
+    def factory(**kwargs):
+        return scheduling.FairShareScheduler(state_file=str(tmpdir.join('scheduler.json')),
+                                             poll_interval=0.01, **kwargs)
+    return factory
+
+
+def _serve(scheduler, waiting):
+    """
+    Releases the running task, until all waiting tasks ran, and returns the order they ran in.
+    """
+    order = []
+    pending = list(waiting)
+    while pending:
+        for slot, execution, tenant in list(pending):
+            if scheduler.try_acquire(slot, execution, tenant):
+                order.append(slot)
+                pending.remove((slot, execution, tenant))
+                scheduler.release(slot)
+                break
+    return order
+
+
+class TestFairShareScheduler(object):
+
+    def test_global_cap(self, scheduler_factory):
+        scheduler = scheduler_factory(max_workers=2)
+        assert scheduler.try_acquire('a1', 'a', 'tenant')
+        assert scheduler.try_acquire('b1', 'b', 'tenant')
+        assert not scheduler.try_acquire('a2', 'a', 'tenant')
+
+        acquired = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (scheduler.acquire('a2', 'a', 'tenant'), acquired.set()))
+        thread.start()
+        assert not acquired.wait(0.1)
+        scheduler.release('b1')
+        thread.join(5)
+        assert acquired.is_set()
+        assert sorted(scheduler.running()) == ['a1', 'a2']
+
+    def test_small_execution_not_starved(self, scheduler_factory):
+        scheduler = scheduler_factory(max_workers=1)
+        assert scheduler.try_acquire('big0', 'big', 'tenant')
+        big = [('big{0}'.format(i), 'big', 'tenant') for i in range(1, 5)]
+        for slot, execution, tenant in big:
+            assert not scheduler.try_acquire(slot, execution, tenant)
+        assert not scheduler.try_acquire('small1', 'small', 'tenant')
+        assert not scheduler.try_acquire('small2', 'small', 'tenant')
+        scheduler.release('big0')
+
+        order = _serve(scheduler, big + [('small1', 'small', 'tenant'),
+                                         ('small2', 'small', 'tenant')])
+        assert order.index('small1') <= 2
+        assert order.index('small2') <= 4
+        assert order[-1] == 'big4'
+
+    def test_tenant_weights(self, scheduler_factory):
+        scheduler = scheduler_factory(max_workers=1, tenants={'heavy': {'weight': 2}})
+        assert scheduler.try_acquire('blocker', 'x', 'other')
+        waiting = [('light{0}'.format(i), 'l', 'light') for i in range(4)] + \
+                  [('heavy{0}'.format(i), 'h', 'heavy') for i in range(4)]
+        for slot, execution, tenant in waiting:
+            scheduler.try_acquire(slot, execution, tenant)
+        scheduler.release('blocker')
+
+        order = _serve(scheduler, waiting)
+        assert sorted(order[:4]) == ['heavy0', 'heavy1', 'heavy2', 'light0']
+
+    def test_quotas(self, scheduler_factory):
+        scheduler = scheduler_factory(max_workers_per_execution=2,
+                                      default_tenant={'max_workers': 3})
+        assert scheduler.try_acquire('a1', 'a', 'tenant')
+        assert scheduler.try_acquire('a2', 'a', 'tenant')
+        assert not scheduler.try_acquire('a3', 'a', 'tenant')
+        assert scheduler.try_acquire('b1', 'b', 'tenant')
+        assert not scheduler.try_acquire('b2', 'b', 'tenant')
+        assert scheduler.try_acquire('c1', 'c', 'other')
+
+        scheduler.release('a1')
+        assert not scheduler.try_acquire('b2', 'b', 'tenant')
+        assert scheduler.try_acquire('a3', 'a', 'tenant')
+
+    def test_release_execution(self, scheduler_factory):
+        scheduler = scheduler_factory(max_workers=1)
+        assert scheduler.try_acquire('a1', 'a', 'tenant')
+        assert not scheduler.try_acquire('a2', 'a', 'tenant')
+        scheduler.release_execution('a')
+        # Tasks of an ended execution are let through
+        assert scheduler.try_acquire('a2', 'a', 'tenant')
+        assert scheduler.running() == {}
+
+    def test_dead_processes_purged(self, scheduler_factory, tmpdir):
+        scheduler = scheduler_factory(max_workers=1)
+        process = subprocess.Popen(['true'])
+        process.wait()
+        state_file = str(tmpdir.join('scheduler.json'))
+        with open(state_file, 'w') as f:
+            json.dump({'virtual_time': 0, 'sequence': 0, 'flows': {}, 'waiting': {},
+                       'queued': {},
+                       'running': {'dead': {'execution': 'x', 'tenant': 't',
+                                            'pid': process.pid}}}, f)
+        assert scheduler.try_acquire('a1', 'a', 'tenant')
+
+    def test_from_environment(self, tmpdir):
+        config_path = str(tmpdir.join('scheduler_config.json'))
+        with open(config_path, 'w') as f:
+            json.dump({'state_file': str(tmpdir.join('state.json')), 'max_workers': 4}, f)
+        assert scheduling.get_scheduler({}) is None
+        scheduler = scheduling.get_scheduler({scheduling.SCHEDULER_ENV_VAR: config_path})
+        assert scheduler.config_path == config_path
+        assert scheduling.get_scheduler({scheduling.SCHEDULER_ENV_VAR: config_path}) is scheduler
+
+        with pytest.raises(ValueError):
+            scheduling.FairShareScheduler(tenants={'broken': {'weight': 0}})
+
+
+class TestTaskSent(object):
+
+    def test_waits_for_both_limits(self, env, execution):
+        concurrency.set_limit(execution.id, 2)
+        scheduling.task_sent(_Task(1, execution), env=env)
+        sent = threading.Event()
+        thread = threading.Thread(target=lambda: (
+            scheduling.task_sent(_Task(2, execution), env=env), sent.set()))
+        thread.daemon = True
+        thread.start()
+        # A concurrency slot is free, but the only worker is not
+        assert not sent.wait(0.2)
+        assert concurrency.get_limit(execution.id).running == 2
+
+        scheduling.task_ended(_Task(1, execution), env=env)
+        concurrency.task_ended(_Task(1, execution))
+        assert sent.wait(5)
+
+    def test_cancellation(self, env, execution):
+        concurrency.set_limit(execution.id, 1)
+        scheduling.task_sent(_Task(1, execution), env=env)
+        cancelled = threading.Event()
+        thread = threading.Thread(target=scheduling.task_sent,
+                                  args=(_Task(2, execution), cancelled.is_set, env))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.1)
+        assert thread.is_alive()
+        cancelled.set()
+        thread.join(5)
+        assert not thread.is_alive()
+        # The cancelled task no longer waits for a worker
+        scheduler = scheduling.get_scheduler(env)
+        scheduler.release(scheduling._slot(_Task(1, execution)))
+        assert scheduler.try_acquire('other', 'other', 'tenant')
+
+    @pytest.fixture
+    def env(self, tmpdir):
+        config_path = str(tmpdir.join('scheduler_config.json'))
+        with open(config_path, 'w') as f:
+            json.dump({'state_file': str(tmpdir.join('state.json')), 'max_workers': 1,
+                       'poll_interval': 0.01}, f)
+        return {scheduling.SCHEDULER_ENV_VAR: config_path}
+
+    @pytest.fixture
+    def execution(self, env):
+        execution = _Execution(id=1, service=_Service('service'))
+        yield execution
+        concurrency.clear_limit(execution.id)
+        scheduling.execution_ended(execution.id, env)
@@ -0,0 +1,102 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+from collections import namedtuple
+
+import pytest
+
+from adapters import shared_memory
+
+
+class _Argument(namedtuple('_Argument', 'id, name, value')):
+
+    @property
+    def unwrapped(self):
+        return self.name, self.value
+
+
+_Property = namedtuple('_Property', 'value')
+_Node = namedtuple('_Node', 'id, properties')
+_Relationship = namedtuple('_Relationship', 'source_node, target_node')
+_Plugin = namedtuple('_Plugin', 'wheels')
+_Task = namedtuple('_Task', 'id, function, arguments, actor, plugin')
+_Context = namedtuple('_Context', 'task, serialization_dict')
+
+CLOUDIFY_PLUGIN = _Plugin(wheels=['cloudify_plugins_common-3.4.2-py27-none-any.whl'])
+USER_DATA = '#cloud-config\n' + 'x' * 1024 * 1024
+
+
+@pytest.fixture
+def executor(tmpdir):
+    executor = shared_memory.SharedMemoryProcessExecutor(segments_dir=str(tmpdir))
+    try:
+        yield executor
+    finally:
+        executor.close()
+
+
+def _task(task_id, actor, plugin=CLOUDIFY_PLUGIN, user_data=USER_DATA):
+    arguments = {
+        'user_data': _Argument(id=task_id * 10, name='user_data', value=user_data),
+        'image': _Argument(id=task_id * 10 + 1, name='image', value='ubuntu'),
+    }
+    return _Context(task=_Task(id=task_id, function='cloudify_aws.ec2.instance.create',
+                               arguments=arguments, actor=actor, plugin=plugin),
+                    serialization_dict={})
+
+
+class TestSharedMemory(object):
+
+    def test_segment_store(self, tmpdir):
+        segments = shared_memory.SegmentStore(str(tmpdir))
+        reference = segments.put({'rules': range(1000)})
+        assert reference.load() == {'rules': range(1000)}
+        assert segments.put({'rules': range(1000)}).path == reference.path
+        assert len(os.listdir(segments.dir)) == 1
+
+        segments.close()
+        assert not os.path.exists(segments.dir)
+
+    def test_large_arguments_passed_by_reference(self, executor):
+        vm = _Node(id=1, properties={'image': _Property('ubuntu')})
+        arguments = executor._create_arguments_dict(_task(1, vm))['operation_arguments']
+        assert isinstance(arguments['user_data'], shared_memory.SegmentReference)
+        assert arguments['image'] == 'ubuntu'
+
+        operation_inputs, node_properties = shared_memory.resolve_arguments(arguments)
+        assert operation_inputs == {'user_data': USER_DATA, 'image': 'ubuntu'}
+        assert node_properties == {1: {'image': 'ubuntu'}}
+
+    def test_payloads_written_once(self, executor):
+        vm_1 = _Node(id=1, properties={'image': _Property('ubuntu')})
+        vm_2 = _Node(id=2, properties={'image': _Property('ubuntu')})
+        db = _Node(id=3, properties={'image': _Property('centos')})
+        first = executor._create_arguments_dict(_task(1, vm_1))['operation_arguments']
+        second = executor._create_arguments_dict(_task(2, vm_2))['operation_arguments']
+        relationship = executor._create_arguments_dict(
+            _task(3, _Relationship(source_node=vm_1, target_node=db)))['operation_arguments']
+
+        assert first['user_data'].path == second['user_data'].path
+        assert sorted(relationship[shared_memory.NODE_PROPERTIES_ARGUMENT]) == [1, 3]
+        # One user data and two distinct property payloads
+        assert len(os.listdir(executor._segments.dir)) == 3
+
+    def test_non_cloudify_tasks_unchanged(self, executor):
+        vm = _Node(id=1, properties={})
+        arguments = executor._create_arguments_dict(
+            _task(1, vm, plugin=None))['operation_arguments']
+        assert arguments == {'user_data': USER_DATA, 'image': 'ubuntu'}
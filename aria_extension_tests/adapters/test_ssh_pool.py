@@ -0,0 +1,256 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import sys
+import time
+import stat
+import socket
+import getpass
+import subprocess
+from distutils import spawn
+
+import pytest
+
+from aria.modeling import models
+from aria.orchestrator.context import operation
+from aria.orchestrator.execution_plugin.exceptions import ProcessException
+
+from adapters import ssh_pool
+from adapters.context_adapter import CloudifyContextAdapter
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+node_types:
+  App:
+    derived_from: tosca.nodes.SoftwareComponent
+    properties:
+      ssh_username: { type: string }
+      private_key_path: { type: string }
+      ssh_port: { type: integer }
+
+topology_template:
+  node_templates:
+    vm:
+      type: tosca.nodes.Compute
+    app:
+      type: App
+      properties:
+        ssh_username: admin
+        private_key_path: ~/.ssh/app_key
+        ssh_port: 2222
+      interfaces:
+        Standard:
+          create: create.sh
+      requirements:
+        - host: vm
+"""
+
+
+# Stand-in for the SSH client and the host's sshd: it runs commands locally, and records a
+# connection whenever a master connection is started, or a command doesn't multiplex over one
+STAND_IN_SSH = """#!{python}
+import os
+import sys
+import subprocess
+
+args = sys.argv[1:]
+options = {{}}
+control = None
+while args[0].startswith('-'):
+    flag = args.pop(0)
+    if flag == '-o':
+        name, value = args.pop(0).split('=', 1)
+        options[name] = value
+    elif flag == '-O':
+        control = args.pop(0)
+    elif flag in ('-p', '-l', '-i'):
+        options[flag] = args.pop(0)
+    else:
+        options[flag] = True
+host = args.pop(0)
+control_path = options['ControlPath']
+
+if control == 'check':
+    sys.exit(0 if os.path.exists(control_path) else 255)
+elif control == 'exit':
+    if not os.path.exists(control_path):
+        sys.exit(255)
+    os.remove(control_path)
+    sys.exit(0)
+
+if options['ControlMaster'] == 'yes' or not os.path.exists(control_path):
+    with open(os.environ['STAND_IN_SSH_LOG'], 'a') as log:
+        log.write('{{0}}@{{1}}:{{2}}\\n'.format(options['-l'], host, options['-p']))
+if options['ControlMaster'] == 'yes':
+    open(control_path, 'w').close()
+    sys.exit(0)
+sys.exit(subprocess.call(['sh', '-c', args[0]]))
+"""
+
+SSHD = '/usr/sbin/sshd'
+
+SSHD_CONFIG = """
+Port {port}
+ListenAddress 127.0.0.1
+HostKey {host_key}
+AuthorizedKeysFile {authorized_keys}
+PidFile {pid_file}
+PasswordAuthentication no
+UsePAM no
+StrictModes no
+"""
+
+
+@pytest.fixture
+def pool(tmpdir, monkeypatch):
+    ssh_command = str(tmpdir.join('ssh'))
+    with open(ssh_command, 'w') as f:
+        f.write(STAND_IN_SSH.format(python=sys.executable))
+    os.chmod(ssh_command, os.stat(ssh_command).st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('STAND_IN_SSH_LOG', str(tmpdir.join('connections.log')))
+    pool = ssh_pool.SSHSessionPool(control_dir=str(tmpdir.join('control')),
+                                   ssh_command=ssh_command)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+
+@pytest.fixture
+def sshd(tmpdir):
+    """
+    Local sshd, accepting the key ``<tmpdir>/id_rsa`` of the current user.
+
+    :return: port and log file of the sshd
+    """
+    if not os.path.exists(SSHD) or not spawn.find_executable('ssh'):
+        pytest.skip('OpenSSH server is not installed')
+    for name in ('host_key', 'id_rsa'):
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'rsa', '-N', '', '-f',
+                               str(tmpdir.join(name))])
+    tmpdir.join('authorized_keys').write(tmpdir.join('id_rsa.pub').read())
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    tmpdir.join('sshd_config').write(SSHD_CONFIG.format(
+        port=port, host_key=tmpdir.join('host_key'),
+        authorized_keys=tmpdir.join('authorized_keys'), pid_file=tmpdir.join('sshd.pid')))
+    log = tmpdir.join('sshd.log')
+    proc = subprocess.Popen([SSHD, '-D', '-f', str(tmpdir.join('sshd_config')), '-E', str(log)])
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+        yield port, log
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _connections(tmpdir):
+    log = tmpdir.join('connections.log')
+    return log.read().splitlines() if log.exists() else []
+
+
+class TestSSHSessionPool(object):
+
+    def test_sessions_share_connection(self, pool, tmpdir):
+        for _ in range(3):
+            session = pool.session('10.0.0.1', 'ubuntu', '~/.ssh/id_rsa')
+            assert session.run('echo configured')[1] == 'configured\n'
+        pool.session('10.0.0.1', 'centos', '~/.ssh/id_rsa').run('true')
+        pool.session('10.0.0.1', 'ubuntu', '~/.ssh/id_rsa', port=2222).run('true')
+
+        assert _connections(tmpdir) == ['ubuntu@10.0.0.1:22', 'centos@10.0.0.1:22',
+                                        'ubuntu@10.0.0.1:2222']
+
+    def test_close(self, pool, tmpdir):
+        session = pool.session('10.0.0.1', 'ubuntu')
+        assert not session.connected
+        session.run('true')
+        assert session.connected
+
+        assert session.close()
+        assert not session.connected
+        session.run('true')
+        assert len(_connections(tmpdir)) == 2
+
+    def test_run(self, pool, tmpdir):
+        session = pool.session('10.0.0.1', 'ubuntu')
+        exit_code, stdout, _ = session.run('echo "$GREETING" && pwd',
+                                           env={'GREETING': "it's me"}, cwd=str(tmpdir))
+        assert (exit_code, stdout) == (0, "it's me\n{0}\n".format(tmpdir))
+
+        with pytest.raises(ProcessException) as e:
+            session.run('echo failed >&2 && exit 3')
+        assert (e.value.exit_code, e.value.stderr) == (3, 'failed\n')
+        assert session.run('exit 3', warn_only=True)[0] == 3
+
+    def test_put(self, pool, tmpdir):
+        local_path = tmpdir.join('configure.sh')
+        local_path.write('#!/bin/sh\necho configure\n')
+        remote_path = tmpdir.join('remote', 'scripts', 'configure.sh')
+
+        pool.session('10.0.0.1', 'ubuntu').put(str(local_path), str(remote_path), mode=0o755)
+        assert remote_path.read() == local_path.read()
+        assert os.stat(str(remote_path)).st_mode & 0o777 == 0o755
+
+    def test_sshd(self, sshd, tmpdir):
+        port, log = sshd
+        pool = ssh_pool.SSHSessionPool(control_dir=str(tmpdir.join('control')), idle_timeout=60)
+        session = pool.session('127.0.0.1', getpass.getuser(), str(tmpdir.join('id_rsa')), port)
+        try:
+            started = time.time()
+            assert session.run('echo configured')[1] == 'configured\n'
+            # The output is read without waiting for the master connection to be idle
+            assert time.time() - started < 30
+            assert session.connected
+            assert pool.session('127.0.0.1', getpass.getuser(), str(tmpdir.join('id_rsa')),
+                                port).run('echo again')[1] == 'again\n'
+        finally:
+            pool.close()
+        assert not session.connected
+        assert log.read().count('Accepted publickey') == 1
+
+    def test_agent_session_defaults(self, pool, tmpdir, core, prepare_execution, monkeypatch):
+        model = core.model_storage
+        vm = model.node.get_by_name('vm_1')
+        vm.attributes['ip'] = models.Attribute.wrap('ip', '10.0.0.5')
+        model.node.update(vm)
+        execution_ctx = prepare_execution('install')
+        task = [task for task in execution_ctx.execution.tasks
+                if task.function and task.node.name == 'app_1'][0]
+        ctx = operation.NodeOperationContext(
+            name='test', model_storage=model, resource_storage=core.resource_storage,
+            service_id=task.node.service.id, task_id=task.id, actor_id=task.node.id,
+            execution_id=execution_ctx.execution.id, workdir=str(tmpdir))
+        monkeypatch.setattr(ssh_pool, '_pool', pool)
+
+        session = CloudifyContextAdapter(ctx).agent.ssh_session()
+        assert (session.host, session.user, session.key_filename, session.port) == \
+            ('10.0.0.5', 'admin', '~/.ssh/app_key', 2222)
+        assert session.run('echo configured')[1] == 'configured\n'
+        assert _connections(tmpdir) == ['admin@10.0.0.5:2222']
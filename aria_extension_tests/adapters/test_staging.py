@@ -0,0 +1,150 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import shutil
+import datetime
+
+import pytest
+
+from aria import workflow
+from aria.modeling import models
+from aria.orchestrator.workflows import api
+from aria.orchestrator.workflows.executor import process
+from aria.orchestrator.workflows.core import graph_compiler
+
+from tests import (mock, storage)
+
+from adapters import (staging, utils)
+
+
+class TestStageResources(object):
+
+    def test_stages_referenced_resources(self, workflow_context, tmpdir):
+        self._upload(workflow_context, tmpdir, 'scripts/configure.sh', 'configure')
+        self._upload(workflow_context, tmpdir, 'index.html', 'index')
+        plugin = self._put_plugin(workflow_context, mock_cfy_plugin=True)
+        self._compile(workflow_context, plugin, arguments={
+            'script_path': 'scripts/configure.sh',
+            'files': ['index.html', 'missing.txt'],
+            'message': 'not a resource',
+            'instance_type': 't2.micro'
+        })
+
+        staged = staging.stage_resources(workflow_context)
+
+        assert staged == ['index.html', 'scripts/configure.sh']
+        workdir = self._plugin_workdir(workflow_context, plugin)
+        execution_id = workflow_context.execution.id
+        with open(staging.get_staged_resource(workdir, execution_id, 'scripts/configure.sh')) as f:
+            assert f.read() == 'configure'
+        with open(staging.get_staged_resource(workdir, execution_id, 'index.html')) as f:
+            assert f.read() == 'index'
+        assert staging.get_staged_resource(workdir, execution_id, 'missing.txt') is None
+
+    def test_stages_for_every_execution(self, workflow_context, tmpdir):
+        plugin = self._put_plugin(workflow_context, mock_cfy_plugin=True)
+        workdir = self._plugin_workdir(workflow_context, plugin)
+        # Staged by an earlier execution, before the resource was updated
+        earlier = tmpdir.join('earlier', 'scripts', 'configure.sh')
+        earlier.write('configure', ensure=True)
+        earlier_dir = staging.staged_resources_dir(workdir, 'earlier')
+        staged_earlier = os.path.join(earlier_dir, 'scripts', 'configure.sh')
+        utils.makedirs(os.path.dirname(staged_earlier))
+        shutil.copyfile(str(earlier), staged_earlier)
+
+        self._upload(workflow_context, tmpdir, 'scripts/configure.sh', 'updated')
+        self._compile(workflow_context, plugin, arguments={'script_path': 'scripts/configure.sh'})
+        staging.stage_resources(workflow_context)
+
+        with open(staging.get_staged_resource(workdir, workflow_context.execution.id,
+                                              'scripts/configure.sh')) as f:
+            assert f.read() == 'updated'
+        assert not os.path.exists(earlier_dir)
+
+    def test_skips_non_cloudify_operations(self, workflow_context, tmpdir):
+        self._upload(workflow_context, tmpdir, 'scripts/configure.sh', 'configure')
+        plugin = self._put_plugin(workflow_context, mock_cfy_plugin=False)
+        self._compile(workflow_context, plugin, arguments={'script_path': 'scripts/configure.sh'})
+
+        assert staging.stage_resources(workflow_context) == []
+        assert staging.get_staged_resource(
+            self._plugin_workdir(workflow_context, plugin), workflow_context.execution.id,
+            'scripts/configure.sh') is None
+
+    @pytest.mark.parametrize('path', ['/etc/passwd', '../outside.sh', ''])
+    def test_rejects_paths_outside_staging_dir(self, tmpdir, path):
+        tmpdir.join('outside.sh').write('outside')
+        staging_dir = tmpdir.join('workdir').mkdir()
+        assert staging.get_staged_resource(str(staging_dir), 1, path) is None
+
+    @staticmethod
+    def _upload(workflow_context, tmpdir, path, content):
+        source = tmpdir.join('source', path)
+        source.write(content, ensure=True)
+        workflow_context.resource.service.upload(
+            entry_id=str(workflow_context.service.id),
+            source=str(source),
+            path=path)
+
+    @staticmethod
+    def _plugin_workdir(workflow_context, plugin):
+        return utils.plugin_workdir(
+            workflow_context._workdir, workflow_context.service.id, plugin.name)
+
+    @staticmethod
+    def _compile(workflow_context, plugin, arguments):
+        interface_name = 'test'
+        operation_name = 'op'
+        node = workflow_context.model.node.get_by_name(mock.models.DEPENDENT_NODE_NAME)
+        node.interfaces[interface_name] = mock.models.create_interface(
+            node.service,
+            interface_name,
+            operation_name,
+            operation_kwargs={'function': 'module.function',
+                              'plugin': plugin,
+                              'arguments': arguments}
+        )
+        workflow_context.model.node.update(node)
+
+        @workflow
+        def mock_workflow(graph, **kwargs):
+            graph.add_tasks(api.task.OperationTask(node, interface_name, operation_name))
+
+        graph_compiler.GraphCompiler(workflow_context, process.ProcessExecutor).compile(
+            mock_workflow(ctx=workflow_context))
+
+    @staticmethod
+    def _put_plugin(workflow_context, mock_cfy_plugin):
+        plugin = models.Plugin(
+            name='PLUGIN',
+            archive_name='ARCHIVE',
+            package_name='PACKAGE',
+            package_version='0.1.1',
+            uploaded_at=datetime.datetime.now(),
+            wheels=['cloudify_plugins_common'] if mock_cfy_plugin else []
+        )
+        workflow_context.model.plugin.put(plugin)
+        return plugin
+
+    @pytest.fixture
+    def workflow_context(self, tmpdir):
+        result = mock.context.simple(
+            str(tmpdir),
+            context_kwargs=dict(workdir=str(tmpdir.join('workdir')))
+        )
+        yield result
+        storage.release_sqlite_storage(result.model)
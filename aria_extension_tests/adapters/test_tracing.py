@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import json
+import datetime
+from collections import namedtuple
+
+import pytest
+
+from adapters import tracing
+
+
+_Execution = namedtuple('_Execution', 'id, started_at')
+_Actor = namedtuple('_Actor', 'name')
+_Task = namedtuple('_Task', 'id, name, execution, actor, interface_name, operation_name, '
+                            'attempts_count, dependencies, ended_at')
+_Context = namedtuple('_Context', 'task')
+
+
+class TestTracing(object):
+
+    def test_disabled(self, task):
+        tracer = tracing.operation_tracer(_Context(task), env={})
+        assert tracer is tracing.NULL_TRACER
+        with tracer.span(tracing.PLUGIN_FUNCTION):
+            pass
+        assert tracing.orchestrator_tracer(env={}) is None
+
+    def test_operation_spans(self, tmpdir, task):
+        trace_dir = str(tmpdir)
+        tracer = tracing.operation_tracer(_Context(task),
+                                          env={tracing.TRACE_DIR_ENV_VAR: trace_dir})
+        with tracer.traced_exit(tracing.MODEL_FLUSH, _Recorder()):
+            with tracer.span(tracing.ADAPTER_SETUP):
+                pass
+            with pytest.raises(ValueError):
+                with tracer.span(tracing.PLUGIN_FUNCTION):
+                    raise ValueError()
+        tracer.instant(tracing.RETRY, retry_after=30)
+        tracer.flush()
+
+        events = self._export(trace_dir, task)
+        assert events[0]['ph'] == 'M'
+        assert events[0]['args']['name'] == task.name
+        spans = dict((e['name'], e) for e in events if e['ph'] == 'X')
+        assert set(spans) == set([tracing.PROCESS_START, tracing.ADAPTER_SETUP,
+                                  tracing.PLUGIN_FUNCTION, tracing.MODEL_FLUSH])
+        assert spans[tracing.PLUGIN_FUNCTION]['args']['error'] == 'ValueError'
+        assert spans[tracing.MODEL_FLUSH]['ts'] >= spans[tracing.PLUGIN_FUNCTION]['ts']
+        for span in spans.values():
+            assert span['tid'] == task.id
+            assert span['args']['node'] == 'node'
+            assert span['args']['operation'] == 'Standard.create'
+            assert span['args']['attempt'] == 1
+        retry = [e for e in events if e['ph'] == 'i'][0]
+        assert retry['args']['retry_after'] == 30
+
+    def test_queueing_and_retry_wait(self, tmpdir, task):
+        trace_dir = str(tmpdir)
+        tracer = tracing.orchestrator_tracer(env={tracing.TRACE_DIR_ENV_VAR: trace_dir})
+        tracer.task_sent(task)
+        tracer.task_failed(task)
+        tracer.task_sent(task._replace(attempts_count=2))
+        tracer.execution_ended(task.execution)
+
+        with open(os.path.join(trace_dir, '{0}.json'.format(task.execution.id))) as f:
+            events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+        assert [e['name'] for e in events] == [tracing.QUEUEING, tracing.RETRY_WAIT]
+        assert events[0]['dur'] >= 2 * 10 ** 6
+        assert events[1]['args']['attempt'] == 2
+        assert not os.path.exists(os.path.join(trace_dir, '{0}.fragments'.format(
+            task.execution.id)))
+
+    def test_export_keeps_merged_spans(self, tmpdir, task):
+        trace_dir = str(tmpdir)
+        for _ in range(2):
+            tracer = tracing.Tracer(trace_dir, task.execution.id, task.id)
+            tracer.instant(tracing.RETRY)
+            tracer.flush()
+            events = self._export(trace_dir, task)
+        assert len(events) == 2
+
+    @staticmethod
+    def _export(trace_dir, task):
+        with open(tracing.export(trace_dir, task.execution.id)) as f:
+            return json.load(f)['traceEvents']
+
+    @pytest.fixture
+    def task(self):
+        now = datetime.datetime.utcnow()
+        dependency = _Task(id=1, name=None, execution=None, actor=None, interface_name=None,
+                           operation_name=None, attempts_count=1, dependencies=[],
+                           ended_at=now - datetime.timedelta(seconds=2))
+        return _Task(id=2,
+                     name='Standard:create@node:node',
+                     execution=_Execution(id=1, started_at=now),
+                     actor=_Actor('node'),
+                     interface_name='Standard',
+                     operation_name='create',
+                     attempts_count=1,
+                     dependencies=[dependency],
+                     ended_at=None)
+
+
+class _Recorder(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
@@ -0,0 +1,145 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+from adapters import concurrency
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+policy_types:
+  CloudifyWorkflow:
+    derived_from: aria.Workflow
+    properties:
+      function:
+        type: string
+        required: false
+      max_concurrent_tasks:
+        type: integer
+        required: false
+      operations:
+        type: list
+        entry_schema: string
+        required: false
+      node_instance_name:
+        type: string
+        required: false
+
+topology_template:
+  node_templates:
+    vm:
+      type: tosca.nodes.Compute
+    web:
+      type: tosca.nodes.WebServer
+      requirements:
+        - host: vm
+        - dependency: db
+    db:
+      type: tosca.nodes.Compute
+
+  policies:
+    cloudify_workflow:
+      type: CloudifyWorkflow
+      properties:
+        implementation: adapters.workflows.cloudify_workflow
+"""
+
+
+def parallel_install(ctx, operations, **kwargs):
+    graph = ctx.graph_mode()
+    subgraphs = {}
+    for instance in ctx.node_instances:
+        subgraph = graph.subgraph(instance.name)
+        sequence = subgraph.sequence()
+        sequence.add(instance.set_state('creating'),
+                     *[instance.execute_operation('cloudify.interfaces.lifecycle.' + operation)
+                       for operation in operations])
+        for relationship in instance.relationships:
+            sequence.add(relationship.execute_source_operation(
+                'cloudify.interfaces.relationship_lifecycle.establish'))
+        subgraphs[instance.id] = subgraph
+    for instance in ctx.node_instances:
+        for relationship in instance.relationships:
+            graph.add_dependency(subgraphs[instance.id], subgraphs[relationship.target_id])
+    graph.execute()
+
+
+def reinstall(ctx, node_instance_name, **kwargs):
+    instance = ctx.get_node_instance(node_instance_name)
+    for operation in ('delete', 'create'):
+        graph = ctx.graph_mode()
+        graph.add_task(instance.execute_operation('cloudify.interfaces.lifecycle.' + operation))
+        graph.add_task(instance.execute_operation('cloudify.interfaces.lifecycle.missing'))
+        graph.execute()
+
+
+class TestCloudifyWorkflowContextAdapter(object):
+
+    def test_dependencies(self, prepare_execution):
+        ctx = prepare_execution('cloudify_workflow',
+                                function=_function_name(parallel_install),
+                                operations=['create', 'start'],
+                                max_concurrent_tasks=2)
+        tasks = self._tasks(ctx)
+        assert set(tasks) == set([
+            'Standard:create@node:vm_1', 'Standard:start@node:vm_1',
+            'Standard:create@node:db_1', 'Standard:start@node:db_1',
+            'Standard:create@node:web_1', 'Standard:start@node:web_1',
+            'Configure:add_source@relationship:host',
+            'Configure:add_source@relationship:dependency'])
+        assert self._dependencies(tasks['Standard:start@node:vm_1']) == set([
+            'Standard:create@node:vm_1'])
+        assert self._dependencies(tasks['Standard:create@node:db_1']) == set()
+        assert self._dependencies(tasks['Standard:create@node:web_1']) == set([
+            'Standard:start@node:vm_1', 'Standard:start@node:db_1'])
+        assert self._dependencies(tasks['Configure:add_source@relationship:host']) == set([
+            'Standard:start@node:web_1'])
+        assert self._dependencies(tasks['Configure:add_source@relationship:dependency']) == set([
+            'Configure:add_source@relationship:host'])
+        assert concurrency.get_limit(ctx.execution.id).max_concurrent_tasks == 2
+        concurrency.clear_limit(ctx.execution.id)
+
+    def test_graphs_run_one_after_the_other(self, prepare_execution):
+        ctx = prepare_execution('cloudify_workflow',
+                                function=_function_name(reinstall),
+                                node_instance_name='vm_1')
+        tasks = self._tasks(ctx)
+        assert set(tasks) == set(['Standard:delete@node:vm_1', 'Standard:create@node:vm_1'])
+        assert self._dependencies(tasks['Standard:create@node:vm_1']) == set([
+            'Standard:delete@node:vm_1'])
+        assert concurrency.get_limit(ctx.execution.id) is None
+
+    @staticmethod
+    def _tasks(ctx):
+        return dict((task.name, task) for task in ctx.execution.tasks if not task._stub_type)
+
+    @classmethod
+    def _dependencies(cls, task):
+        # Dependencies on operation tasks, through any stub tasks in between
+        dependencies = set()
+        for dependency in task.dependencies:
+            if dependency._stub_type:
+                dependencies.update(cls._dependencies(dependency))
+            else:
+                dependencies.add(dependency.name)
+        return dependencies
+
+
+def _function_name(function):
+    return '{0}.{1}'.format(function.__module__, function.__name__)
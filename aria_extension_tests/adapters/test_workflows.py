@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2017 GigaSpaces Technologies Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import pytest
+
+from aria.modeling import models
+from aria.orchestrator import execution_preparer
+
+from adapters import workflows
+
+
+SERVICE_TEMPLATE = """
+tosca_definitions_version: tosca_simple_yaml_1_0
+
+imports:
+  - aria-1.0
+
+policy_types:
+  Scale:
+    derived_from: aria.Workflow
+    properties:
+      scalable_entity_name:
+        type: string
+        required: false
+      delta:
+        type: integer
+        default: 1
+      scale_compute:
+        type: boolean
+        default: false
+  Heal:
+    derived_from: aria.Workflow
+    properties:
+      node_instance_id:
+        type: integer
+        required: false
+
+topology_template:
+  node_templates:
+    vm:
+      type: tosca.nodes.Compute
+      capabilities:
+        scalable:
+          properties:
+            min_instances: 1
+            max_instances: 10
+    web:
+      type: tosca.nodes.WebServer
+      requirements:
+        - host: vm
+        - dependency: db
+    db:
+      type: tosca.nodes.Compute
+
+  policies:
+    scale:
+      type: Scale
+      properties:
+        implementation: adapters.workflows.scale
+    heal:
+      type: Heal
+      properties:
+        implementation: adapters.workflows.heal
+"""
+
+
+class TestWorkflows(object):
+
+    def test_scale_out(self, service, prepare_execution):
+        ctx = prepare_execution('scale', scalable_entity_name='web', delta=2, scale_compute=True)
+
+        new_nodes = [node for node in service.nodes.itervalues()
+                     if node.state == models.Node.INITIAL]
+        assert sorted(node.name for node in new_nodes) == ['vm_2', 'vm_3', 'web_2', 'web_3']
+        for node in new_nodes:
+            if node.node_template.name == 'web':
+                targets = dict((relationship.name, relationship.target_node)
+                               for relationship in node.outbound_relationships)
+                assert targets['dependency'].name == 'db_1'
+                assert targets['host'] == node.host
+                assert targets['host'].name in ('vm_2', 'vm_3')
+        assert self._operated_nodes(ctx) == set(node.name for node in new_nodes)
+
+    def test_scale_in(self, core, service, prepare_execution):
+        model = core.model_storage
+        prepare_execution('scale', scalable_entity_name='vm', delta=2)
+        self._start_all(model, service)
+
+        ctx = prepare_execution('scale', scalable_entity_name='vm', delta=-1)
+        assert self._operated_nodes(ctx) == set(['vm_3', 'web_3'])
+
+        # Marked by the orchestrator process ending the execution, e.g. once it was resumed
+        resumed = execution_preparer.ExecutionPreparer(
+            model, core.resource_storage, None, service, 'scale').prepare(
+                execution_id=ctx.execution.id)
+        workflows.mark_scaled_in_nodes(resumed)
+        assert model.node.get_by_name('vm_3').state == models.Node.DELETED
+        assert model.node.get_by_name('vm_2').state == models.Node.STARTED
+
+    @pytest.mark.parametrize('delta', [-1, 10])
+    def test_scaling_bounds(self, service, prepare_execution, delta):
+        with pytest.raises(workflows.ScalingError):
+            prepare_execution('scale', scalable_entity_name='vm', delta=delta)
+        assert len(service.nodes) == 3
+
+    def test_heal(self, core, prepare_execution):
+        ctx = prepare_execution('heal',
+                                node_instance_id=core.model_storage.node.get_by_name('vm_1').id)
+        assert self._operated_nodes(ctx) == set(['vm_1', 'web_1'])
+
+    def test_heal_relinks_remaining_nodes(self, core, prepare_execution):
+        ctx = prepare_execution('heal',
+                                node_instance_id=core.model_storage.node.get_by_name('db_1').id)
+        relationship_tasks = [task for task in ctx.execution.tasks
+                              if isinstance(task.actor, models.Relationship)]
+        assert set(task.actor.source_node.name for task in relationship_tasks) == set(['web_1'])
+        assert set(task.operation_name for task in relationship_tasks) == set([
+            'remove_source', 'remove_target',
+            'pre_configure_source', 'pre_configure_target',
+            'post_configure_source', 'post_configure_target',
+            'add_source', 'add_target'])
+        assert self._operated_nodes(ctx) == set(['db_1', 'web_1'])
+
+    @staticmethod
+    def _operated_nodes(ctx):
+        return set(task.actor.name if isinstance(task.actor, models.Node)
+                   else task.actor.source_node.name
+                   for task in ctx.execution.tasks if not task._stub_type)
+
+    @staticmethod
+    def _start_all(model, service):
+        for node in service.nodes.itervalues():
+            node.state = node.STARTED
+            model.node.update(node)
@@ -42,6 +42,12 @@ setup(
     entry_points={
         'aria_extension': [
             'adapter = adapters.extension'
+        ],
+        'console_scripts': [
+            'aria-plugin-cache = adapters.plugin_cache:main',
+            'aria-cloudify-resume = adapters.checkpoint:main',
+            'aria-cloudify-worker = adapters.distributed:main',
+            'aria-cloudify-runtime-index = adapters.runtime_index:main'
         ]
     }
 )